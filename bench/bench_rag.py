@@ -0,0 +1,158 @@
+# End-to-end RAG benchmark: ingest a corpus into a fresh collection, then replay a set of queries.
+#
+#   python bench/bench_rag.py                          # data/test/corpus1, stub LLM, reranker on
+#   python bench/bench_rag.py --scale=10               # corpus1 copied 10 times, paragraphs shuffled per copy
+#   python bench/bench_rag.py --corpus=C:\Rob\RAG\Resumes --queries=queries.txt --rounds=3
+#   python bench/bench_rag.py --no-rerank --stack=granite-local    # a real model stack from credentials.yaml
+#   python bench/bench_rag.py --cached-text            # read document text from the cache instead of extracting it
+#
+# Ingest reports documents/s, chunks/s and peak memory. Queries report p50/p95/p99 seconds for each part of
+# a query: retrieval (vector search), rerank (cross-encoder), packing (building the context) and generation.
+#
+# The LLM is the offline 'stub' model stack unless --stack is given. Retrieval and reranking use the real
+# chromadb embedding model and bge reranker, so they must have been downloaded once before running offline.
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_startup import peak_rss_mb
+from lib.tools import readYaml, findPath
+from lib.retry import percentile
+from lib.corpus import Corpus, get_text
+from lib.splitter import RecursiveCharacterText_Splitter
+from lib.rag import Rag
+
+CORPUS = 'data/test/corpus1'
+PHASES = ['retrieval', 'rerank', 'packing', 'generation']
+STUB = {'class': 'stub', 'latency': 0.05, 'tokens_per_sec': 500, 'completion_tokens': 100, 'context-window': '16K'}
+QUERIES = [
+    "I want to shift into another plane. What spell should I use?",
+    "Which spell lets a wizard see invisible creatures?",
+    "What did Bilbo find in the goblin tunnels?",
+    "Who is Smaug and where does he live?",
+    "Why does Hamlet hesitate to kill Claudius?",
+    "What does Ophelia give away in her madness?",
+    "Who is John Galt?",
+    "Why does Howard Roark refuse to compromise his designs?",
+    "What happened to Captain Ahab's leg?",
+    "Why is the white whale white?",
+]
+
+
+
+
+def scaled_corpus(folder, scale, seed=1):
+    """
+    A copy of @folder @scale times over. Text files have their paragraphs shuffled in each copy so the
+    copies do not embed to identical vectors; other files are copied as they are.
+    """
+    rnd = random.Random(seed)
+    out = tempfile.mkdtemp(prefix='bench_corpus_')
+    for n in range(scale):
+        for root, dirs, files in os.walk(folder):
+            for file in files:
+                src = os.path.join(root, file)
+                base, ext = os.path.splitext(file)
+                dst = os.path.join(out, f"{base} - copy {n}{ext}")
+                if ext in ['.txt', '.md', '.rst'] and n:
+                    with open(src, encoding='utf-8', errors='replace') as f:
+                        paragraphs = f.read().split('\n\n')
+                    rnd.shuffle(paragraphs)
+                    with open(dst, 'w', encoding='utf-8') as f:
+                        f.write('\n\n'.join(paragraphs))
+                else:
+                    shutil.copyfile(src, dst)
+    return out
+
+
+def ingest(corpus_folder, collection_dir, rerank=True, cached_text=False):
+    "Load @corpus_folder into a new collection. Returns the vector db and the ingest measurements."
+    from lib.vectordb import ChromaVectorDb
+    corpus = Corpus()
+    if not cached_text:
+        # Extract every document, rather than measure how fast the text cache is.
+        corpus.get_text = get_text.__wrapped__
+    corpus.convert_files(corpus_folder)
+    splitter = RecursiveCharacterText_Splitter(chunk_size=1000, chunk_overlap=200)
+    db = ChromaVectorDb(corpus, splitter, collection_path=os.path.join(collection_dir, 'bench'))
+    db.reranking = rerank
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    db.load_corpus(corpus_folder)
+    seconds = time.perf_counter() - start
+    return db, {
+        'documents': db.ingested['documents'],
+        'chunks': db.ingested['chunks'],
+        'seconds': seconds,
+        'documents_per_sec': db.ingested['documents'] / seconds,
+        'chunks_per_sec': db.ingested['chunks'] / seconds,
+        'rss_before_mb': rss_before,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def replay(rag, queries, rounds=1):
+    "Ask every query @rounds times. Returns {phase: [seconds per query]}, with 'total' as well."
+    phases = {phase: [] for phase in PHASES + ['total']}
+    for _ in range(rounds):
+        for query in queries:
+            timings = {}
+            start = time.perf_counter()
+            rag.query(query, timings=timings)
+            timings['total'] = time.perf_counter() - start
+            for phase in phases:
+                phases[phase].append(timings.get(phase, 0.0))
+    return phases
+
+
+
+
+def format_ingest(m):
+    rss = lambda v: '-' if v is None else f"{v:.0f} MB"
+    return (f"Ingest: {m['documents']} documents, {m['chunks']} chunks in {m['seconds']:.1f}s "
+            f"({m['documents_per_sec']:.2f} docs/s, {m['chunks_per_sec']:.1f} chunks/s), "
+            f"peak RSS {rss(m['peak_rss_mb'])} (was {rss(m['rss_before_mb'])} before ingest)")
+
+
+def format_phases(phases):
+    lines = [f"Queries: {len(phases['total'])}", f"  {'phase':12s} {'p50':>8s} {'p95':>8s} {'p99':>8s}"]
+    for phase, values in phases.items():
+        lines.append(f"  {phase:12s} " + ' '.join(f"{percentile(values, p):7.3f}s" for p in [50, 95, 99]))
+    return '\n'.join(lines)
+
+
+def main(args):
+    flags = {a.split('=')[0]: a.split('=')[1] if '=' in a else True for a in args}
+    corpus_folder = flags.get('--corpus', CORPUS)
+    scale = int(flags.get('--scale', 1))
+    rounds = int(flags.get('--rounds', 1))
+    stack = STUB
+    if flags.get('--stack'):
+        stack = readYaml(findPath("credentials.yaml"))['modelstack'][flags['--stack']]
+    queries = QUERIES
+    if flags.get('--queries'):
+        with open(flags['--queries'], encoding='utf-8') as f:
+            queries = [line.strip() for line in f if line.strip()]
+
+    collection_dir = tempfile.mkdtemp(prefix='bench_chroma_')
+    scaled = scaled_corpus(corpus_folder, scale) if scale > 1 else None
+    try:
+        print(f"Corpus {corpus_folder} x{scale}, model stack {stack.get('model', stack['class'])}, reranker {'off' if flags.get('--no-rerank') else 'on'}")
+        db, measurements = ingest(scaled or corpus_folder, collection_dir, rerank=not flags.get('--no-rerank'), cached_text=flags.get('--cached-text'))
+        print(format_ingest(measurements))
+        rag = Rag('bench', corpus_folder, stack, vectordb=db)
+        # One query to load the reranker and embedding models, so the percentiles are of warm queries.
+        rag.query(queries[0])
+        print(format_phases(replay(rag, queries, rounds)))
+    finally:
+        shutil.rmtree(collection_dir, ignore_errors=True)
+        if scaled:
+            shutil.rmtree(scaled, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,149 @@
+# Compare the YAML and JSON readers and writers in lib/tools against the pure-Python ones they replaced,
+# on data shaped like the job outputs (summarized resumes), or on real output files:
+#
+#   python bench/bench_serialization.py                      # 2000 synthetic summarized resumes
+#   python bench/bench_serialization.py summarized.yaml      # a real file (.yaml or .json)
+#
+# For every reader and writer it prints MB/s and whether the data survives the round trip unchanged.
+# The pretty YAML writer must also produce exactly the same text as the pure-Python pretty writer, including
+# for the characters libyaml escapes (emoji and NEL), which are checked on a small extra data set.
+
+import os
+import sys
+import time
+import json
+import random
+import tempfile
+import yaml
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.tools import *
+
+
+def synthetic_records(n=2000, seed=1):
+    rnd = random.Random(seed)
+    words = "python aws sql built led designed migrated reduced latency team platform data pipeline kubernetes terraform".split()
+
+    def sentence(k):
+        return ' '.join(rnd.choice(words) for _ in range(k)).capitalize() + '.'
+
+    return [{
+        'filepath': f'C:/Rob/RAG/Resumes, Work History, Career/resume-{i}.docx',
+        'name': 'Robert Howard',
+        'email': 'rob@example.com',
+        'summary': sentence(60),
+        'experience': [{
+            'company': f'Company {j}',
+            'title': sentence(3),
+            'dates': f'{2000 + j}-{2002 + j}',
+            'description': '\n'.join(sentence(20) for _ in range(3)),
+        } for j in range(5)],
+        'skills': [{
+            'skill': rnd.choice(words),
+            'level': rnd.choice(['Beginner', 'Intermediate', 'Expert']),
+            'where_utilized': [{'company': f'Company {rnd.randrange(5)}'}],
+        } for _ in range(8)],
+        'projects': [{'project': sentence(2), 'skills': rnd.sample(words, 4)}],
+    } for i in range(n)]
+
+
+def special_records():
+    "Text that libyaml would escape, in keys, short and long strings and block scalars."
+    return [{
+        'name': 'Rob 😀',
+        'summary': 'Led the team\x85to ' + 'ship ' * 20 + '🚀',
+        'description': 'First line\nsecond line 𝔘𝔫𝔦𝔠𝔬𝔡𝔢\x85',
+        'skills ✨': ['AWS', 'SQL 🐍'],
+    }, {'plain': 'ASCII only', 'accents': 'Zoë Müller'}]
+
+
+def identical_text(data):
+    "Whether writeYaml writes exactly what the pure-Python pretty writer does."
+    dir = tempfile.mkdtemp()
+    fn_fast, fn_slow = os.path.join(dir, 'fast.yaml'), os.path.join(dir, 'slow.yaml')
+    writeYaml(fn_fast, data)
+    with open(fn_slow, 'w') as f:
+        yaml.dump(data, f, indent=2, default_flow_style=False, allow_unicode=True, width=4096, Dumper=SlowPrettyDumper, sort_keys=False)
+    with open(fn_fast) as a, open(fn_slow) as b:
+        identical = a.read() == b.read()
+    os.remove(fn_fast)
+    os.remove(fn_slow)
+    os.rmdir(dir)
+    return identical
+
+
+def timed(func, repeat=3):
+    "Best of @repeat runs, in seconds, and the last result."
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def bench(data, repeat=3):
+    dir = tempfile.mkdtemp()
+    fn_yaml = os.path.join(dir, 'data.yaml')
+    fn_slow = os.path.join(dir, 'slow.yaml')
+    fn_json = os.path.join(dir, 'data.json')
+    rows = []
+
+    def slow_write_yaml(fn):
+        with open(fn, 'w') as f:
+            yaml.dump(data, f, indent=2, default_flow_style=False, allow_unicode=True, width=4096, Dumper=SlowPrettyDumper, sort_keys=False)
+
+    def slow_read_yaml(fn):
+        with open(fn) as f:
+            return yaml.safe_load(f)
+
+    def slow_read_json(fn):
+        with open(fn) as f:
+            return json.load(f)
+
+    cases = [
+        ('yaml write  pure-Python pretty', lambda: slow_write_yaml(fn_slow), fn_slow, None),
+        ('yaml write  writeYaml', lambda: writeYaml(fn_yaml, data), fn_yaml, None),
+        ('yaml write  writeYaml pretty=False', lambda: writeYaml(fn_yaml + '.plain', data, pretty=False), fn_yaml + '.plain', None),
+        ('yaml read   yaml.safe_load', lambda: slow_read_yaml(fn_slow), fn_slow, True),
+        ('yaml read   readYaml', lambda: readYaml(fn_yaml), fn_yaml, True),
+        ('json write  writeJson', lambda: writeJson(fn_json, data), fn_json, None),
+        ('json write  writeJson pretty=False', lambda: writeJson(fn_json + '.compact', data, pretty=False), fn_json + '.compact', None),
+        ('json read   json.load', lambda: slow_read_json(fn_json), fn_json, True),
+        ('json read   readJson', lambda: readJson(fn_json), fn_json, True),
+    ]
+    for name, func, fn, check in cases:
+        seconds, result = timed(func, repeat)
+        mb = os.path.getsize(fn) / 1e6
+        same = (result == data) if check else None
+        rows.append((name, mb, seconds, same))
+
+    with open(fn_slow) as a, open(fn_yaml) as b:
+        identical = a.read() == b.read()
+    for fn in os.listdir(dir):
+        os.remove(os.path.join(dir, fn))
+    os.rmdir(dir)
+    return rows, identical
+
+
+def main(args):
+    if args:
+        for fn in args:
+            data = readJson(fn) if fn.endswith('.json') else readYaml(fn)
+            report(fn, data)
+    else:
+        report('2000 synthetic summarized resumes', synthetic_records())
+
+
+def report(name, data):
+    rows, identical = bench(data)
+    print(f"{name}: libyaml {'on' if FastLoader is not yaml.SafeLoader else 'off'}, orjson {'on' if orjson else 'off'}")
+    for case, mb, seconds, same in rows:
+        fidelity = '' if same is None else ('  round trip ok' if same else '  ROUND TRIP CHANGED THE DATA')
+        print(f"  {case:36s} {mb:7.2f} MB {seconds:7.3f}s {mb / seconds:7.1f} MB/s{fidelity}")
+    print(f"  pretty YAML text identical to the pure-Python writer: {identical}")
+    print(f"  ... also with emoji and NEL characters: {identical_text(special_records())}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,236 @@
+# Startup benchmarks: how long each lib module and entry point takes to import, and how much memory that
+# costs, each measured in a fresh Python process.
+#
+#   python bench/bench_startup.py run                         # print the results
+#   python bench/bench_startup.py run --save                  # ... and write them to bench/startup_baseline.json
+#   python bench/bench_startup.py compare                     # measure again and check against the baseline
+#   python bench/bench_startup.py compare --tolerance 0.3 other.json
+#   python bench/bench_startup.py first-query --stack granite-local
+#
+# An entry point (main.py, jobs.py, lib/rag.py) is measured by running only its top-level imports, since
+# the rest of those scripts does real work. 'first-query' times a RAG query from a cold start: imports,
+# loading the collection, loading the reranker, the first retrieval and, with --stack, the first answer.
+#
+# compare exits with status 1 when a case is slower or larger than the baseline by more than the
+# tolerance (20% by default, and never less than MIN_SECONDS or MIN_MB), or has no baseline entry, so it can
+# gate a build. Absolute times depend on the machine, so the baseline is not committed (.gitignore): save one
+# on the machine that runs compare.
+
+import os
+import sys
+import ast
+import json
+import time
+import platform
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, 'bench', 'startup_baseline.json')
+ENTRY_POINTS = ['main.py', 'jobs.py', 'lib/rag.py']
+MIN_SECONDS = 0.03
+MIN_MB = 5
+
+
+
+
+def peak_rss_mb():
+    "Peak resident memory of this process, or None where it cannot be read."
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS.
+        return rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+    except (ImportError, AttributeError):
+        return None
+
+
+def entry_imports(path):
+    "The top-level import statements of a script, compiled on their own."
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), path)
+    tree.body = [node for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))]
+    return compile(tree, path, 'exec')
+
+
+def child(kind, name):
+    "Runs in the fresh process: import @name and print the measurement as JSON."
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    before = set(sys.modules)
+    start = time.perf_counter()
+    try:
+        if kind == 'module':
+            __import__(name)
+        else:
+            exec(entry_imports(os.path.join(ROOT, name)), {'__name__': 'bench'})
+        error = None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    seconds = time.perf_counter() - start
+    print(json.dumps({'seconds': seconds, 'rss_mb': peak_rss_mb(), 'modules': len(set(sys.modules) - before), 'error': error}))
+
+
+def measure(kind, name, repeat):
+    "The median import time and the largest peak RSS over @repeat fresh processes."
+    runs = []
+    for _ in range(repeat):
+        r = subprocess.run([sys.executable, os.path.abspath(__file__), 'child', kind, name], capture_output=True, text=True, cwd=ROOT)
+        if r.returncode:
+            return {'error': r.stderr.strip().splitlines()[-1] if r.stderr.strip() else f"exit status {r.returncode}"}
+        runs.append(json.loads(r.stdout.strip().splitlines()[-1]))
+    if runs[0]['error']:
+        return {'error': runs[0]['error']}
+    rss = [run['rss_mb'] for run in runs if run['rss_mb'] is not None]
+    return {
+        'seconds': statistics.median(run['seconds'] for run in runs),
+        'rss_mb': max(rss) if rss else None,
+        'modules': runs[0]['modules'],
+    }
+
+
+def cases():
+    "(name, kind, target) for every lib module and entry point."
+    modules = sorted(f[:-3] for f in os.listdir(os.path.join(ROOT, 'lib')) if f.endswith('.py'))
+    return [(f"lib.{m}", 'module', f"lib.{m}") for m in modules] + [(e, 'entry', e) for e in ENTRY_POINTS]
+
+
+def run(repeat=5):
+    results = {}
+    for name, kind, target in cases():
+        results[name] = measure(kind, target, repeat)
+        print(format_case(name, results[name]), flush=True)
+    return {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+
+
+def format_case(name, result, note=''):
+    if result.get('error'):
+        return f"  {name:22s} ERROR {result['error']}"
+    rss = '      -' if result['rss_mb'] is None else f"{result['rss_mb']:7.1f}"
+    return f"  {name:22s} {result['seconds'] * 1000:8.1f} ms {rss} MB {result['modules']:5d} modules{note}"
+
+
+def compare(baseline, current, tolerance=0.2):
+    "The cases in @current that regressed against @baseline, as (name, message) pairs."
+    regressions = []
+    for name, new in current['results'].items():
+        old = baseline['results'].get(name)
+        if not old:
+            # A module added since the baseline was saved would otherwise never be checked.
+            regressions.append((name, "not in the baseline; save a new one with 'run --save'"))
+            continue
+        if new.get('error') and not old.get('error'):
+            regressions.append((name, f"now fails: {new['error']}"))
+            continue
+        if new.get('error') or old.get('error'):
+            continue
+        if new['seconds'] > old['seconds'] + max(old['seconds'] * tolerance, MIN_SECONDS):
+            regressions.append((name, f"{old['seconds'] * 1000:.0f} -> {new['seconds'] * 1000:.0f} ms"))
+        if new['rss_mb'] and old['rss_mb'] and new['rss_mb'] > old['rss_mb'] + max(old['rss_mb'] * tolerance, MIN_MB):
+            regressions.append((name, f"{old['rss_mb']:.0f} -> {new['rss_mb']:.0f} MB"))
+    return regressions
+
+
+
+
+def first_query(collection='corpus1', stack=None, query="I want to shift into another plane. What spell should I use?"):
+    "Seconds for each step of a cold RAG query. Runs in this process, so call it from a fresh one."
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    steps = {}
+    start = time.perf_counter()
+
+    def step(name):
+        nonlocal start
+        now = time.perf_counter()
+        steps[name] = now - start
+        start = now
+
+    from lib.vectordb import make_rag
+    from lib.modelstack import ModelStack
+    from lib.tools import readYaml, findPath
+    step('import')
+    rag = make_rag(collection, os.path.abspath(f"data/test/{collection}"))
+    step('collection')
+    rag.get_reranker()
+    step('reranker')
+    context = rag.retrive_documents(query, n_results=40)
+    step('retrieval')
+    if stack:
+        llm = ModelStack.from_config(readYaml(findPath("credentials.yaml"))['modelstack'][stack])
+        llm.query(f"QUERY: {query}\n\nCONTEXT: {context}")
+        step('answer')
+    steps['total'] = sum(steps.values())
+    steps['rss_mb'] = peak_rss_mb()
+    return steps
+
+
+
+
+def main(args):
+    command = args[0] if args else 'run'
+    options = [a for a in args[1:] if not a.startswith('--')]
+    flags = {a.split('=')[0]: a.split('=')[1] if '=' in a else True for a in args[1:] if a.startswith('--')}
+    repeat = int(flags.get('--repeat', 5))
+    if command == 'child':
+        child(*options)
+    elif command == 'run':
+        print(f"Startup, median of {repeat} fresh processes:")
+        results = run(repeat)
+        if flags.get('--save'):
+            with open(BASELINE, 'w') as f:
+                json.dump(results, f, indent=2)
+            print(f"Saved {BASELINE}")
+    elif command == 'compare':
+        path = options[0] if options else BASELINE
+        if not os.path.exists(path):
+            print(f"No baseline at {path}: save one on this machine with 'python bench/bench_startup.py run --save'")
+            sys.exit(1)
+        with open(path) as f:
+            baseline = json.load(f)
+        tolerance = float(flags.get('--tolerance', 0.2))
+        print(f"Startup against the baseline of {baseline['created']}, median of {repeat} fresh processes:")
+        regressions = compare(baseline, run(repeat), tolerance)
+        for name, message in regressions:
+            print(f"REGRESSION {name}: {message}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions.")
+    elif command == 'first-query':
+        # A fresh process, so nothing is imported or loaded yet.
+        code = f"import sys, json; sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r}); import bench_startup; " \
+               f"print(json.dumps(bench_startup.first_query(stack={flags.get('--stack')!r})))"
+        r = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=ROOT)
+        if r.returncode:
+            print(r.stderr.strip())
+            sys.exit(1)
+        steps = json.loads(r.stdout.strip().splitlines()[-1])
+        for name, value in steps.items():
+            print(f"  {name:10s} " + (f"{value:8.2f} MB" if name == 'rss_mb' else f"{value:8.2f}s"))
+    else:
+        raise ValueError(f"Unknown command: {command}")
+
+
+def test_compare():
+    baseline = {'results': {'a': {'seconds': 0.1, 'rss_mb': 50}, 'b': {'seconds': 1.0, 'rss_mb': 100}, 'c': {'seconds': 0.1, 'rss_mb': 50}}}
+    current = {'results': {'a': {'seconds': 0.12, 'rss_mb': 54}, 'b': {'seconds': 1.3, 'rss_mb': 100}, 'c': {'error': 'ImportError: x'},
+                           'd': {'seconds': 0.1, 'rss_mb': 50}}}
+    assert compare(baseline, current) == [('b', '1000 -> 1300 ms'), ('c', 'now fails: ImportError: x'),
+                                          ('d', "not in the baseline; save a new one with 'run --save'")]
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -7,10 +7,23 @@
 # from unstructured.partition.auto import partition
 # import textract
 import os
+import sys
+import time
+import functools
 from lib.tools import *
 from lib.modelstack import ModelStack
-from lib.rag import ChromaRAG
-from chromadb.config import Settings
+from lib.corpus import get_text as read_corpus_document
+from lib.executor import JobExecutor
+from lib.aggregate import Aggregator
+from lib.repair import repair_answer, RepairError
+from lib.journal import Journal, replace_file
+from lib.skipindex import SkipIndex, normalize_path, prompt_key, file_hash
+from lib.pipeline import Pipeline
+from lib.telemetry import Telemetry, Timer, format_summary
+from lib.planner import Plan, rates_for, get_tokenizer, format_plan
+from lib.fuse import split_template, compile_template, fill, fused_prompt, fused_schema, split_answer
+from lib.mapreduce import input_limit, split_text, map_reduce, REDUCE_PROMPT
+from lib.retry import RetryableError
 
 
 
@@ -19,113 +32,357 @@ def list_resumes(self):
     results = self.collection.get()
     return [metadata.get('filename') for metadata in results['metadatas']]
 
-def run_job(self, job):
-    system_prompt = job.get('system_prompt', '')
+def job_template(job):
+    "The job's system_prompt, compiled once (see lib/fuse.py) into the parts before and from {{PROMPT}}."
+    return split_template(job.get('system_prompt', 'GIVEN:\n{{GIVEN}}\n\nPROMPT:\n{{PROMPT}}') + "\n\n")
+
+
+def render_prompt(job, filepath, text, prompt):
+    """
+    Fill in the job's system_prompt template for one file and one prompt.
+    Returns (prefix, prompt): everything before {{PROMPT}} is the prefix, which is identical for
+    all prompts of the same file, and the rest is the prompt-specific part.
+    """
+    prefix, suffix = job_template(job)
+    values = {'FILEPATH': filepath, 'GIVEN': text, 'PROMPT': prompt}
+    return fill(prefix, values), fill(suffix, values)
+
+
+def parse_answer(answer, fmt):
+    """
+    Parse a JSON or YAML answer, repairing it where possible (see lib/repair.py).
+    Returns a dict; answers that cannot be salvaged come back as an 'error' entry.
+    """
+    try:
+        o, changes = repair_answer(answer, fmt)
+    except RepairError as e:
+        return {
+            'error': str(e),
+            'reason': answer
+        }
+    if changes:
+        print(f"  Repaired answer: {', '.join(changes)}")
+    if not isinstance(o, dict):
+        o = {'answer': o}
+    return o
+
+
+def job_journal(job):
+    "The append-only journal that run_job writes a job's results to, next to the job's target file."
+    target = job.get('files', {}).get('target', '')
+    options = job.get('journal') or {}
+    return Journal(f"{target}.journal.jsonl", sync_every=options.get('sync_every', 20), sync_seconds=options.get('sync_seconds', 5.0))
+
+
+def write_target(target, answers):
+    "Write the final results file in the format given by the target's extension, replacing it atomically."
+    if target.endswith('.yaml'):
+        replace_file(target, lambda fn: writeYaml(fn, answers))
+    elif target.endswith('.json'):
+        replace_file(target, lambda fn: writeJson(fn, answers))
+    elif target.endswith(('.txt', '.md', '.rst')):
+        replace_file(target, lambda fn: writeText(fn, '\n\n'.join(answers) + '\n'))
+    else:
+        raise ValueError(f"Unsupported target file extension: {target}")
+
+
+def job_index(job):
+    "The skip index of (file, prompt) pairs that run_job has already answered."
+    target = job.get('files', {}).get('target', '')
+    return SkipIndex(f"{target}.index.json")
+
+
+def current_answers(journal, keys=None):
+    """
+    Stream the answers in a journal that are still current: when a file was reprocessed because its content
+    changed, only the answers for its latest content are kept, and only the latest answer for each prompt.
+    @keys are the prompt_key()s of the job's prompts as they are now. Answers to prompts that have since been
+    edited or removed are left out; answers copied from an old target file are kept while any of theirs remains.
+    """
+    keys = None if keys is None else set(keys)
+    latest_hash = {}
+    last = {}
+    for n, record in enumerate(journal.read()):
+        path = normalize_path(record['filepath']) if record.get('filepath') else None
+        if record.get('hash'):
+            latest_hash[path] = record['hash']
+        last[(path, record.get('key'), record.get('prompt'))] = n
+    for n, record in enumerate(journal.read()):
+        path = normalize_path(record['filepath']) if record.get('filepath') else None
+        if path in latest_hash and record.get('hash') != latest_hash[path]:
+            continue
+        if record.get('key') and last[(path, record.get('key'), record.get('prompt'))] != n:
+            continue
+        if keys is not None and record.get('key') and record['key'] not in keys:
+            continue
+        if keys is not None and record.get('keys') and not keys.intersection(record['keys']):
+            continue
+        yield record['answer']
+
+
+def compact_job(job):
+    """
+    Turn the job's journal into its target file (YAML, JSON or text). Safe to run at any time,
+    including after a crash, and returns the list of answers.
+    """
+    target = job.get('files', {}).get('target', '')
+    journal = job_journal(job)
+    answers = list(current_answers(journal, job_keys(job)))
+    if target:
+        write_target(target, answers)
+    return answers
+
+
+def job_keys(job):
+    return [prompt_key(job, prompt) for prompt in job.get('prompts', [])]
+
+
+def seed_journal(job, journal):
+    "Results written by older versions exist only in the target file. Copy them into a new journal."
+    target = job.get('files', {}).get('target', '')
+    if journal.exists() or not target.endswith(('.yaml', '.json')) or not os.path.exists(target):
+        return
+    answers = readYaml(target) or []
+    keys = job_keys(job)
+    hashes = {}
+    with journal:
+        for answer in answers:
+            # Assume the file has not changed since it was answered, with the job's current prompts.
+            filepath = answer.get('filepath')
+            if filepath and filepath not in hashes:
+                hashes[filepath] = file_hash(filepath) if os.path.exists(filepath) else None
+            journal.append({'filepath': filepath, 'keys': keys, 'hash': hashes.get(filepath), 'answer': answer})
+
+
+def job_files(job, index, keys, on_skip=None):
+    """
+    Walk the job's folder and yield (filepath, content_hash, prompt indexes still to run) for each file with work left.
+    @on_skip is called for each file that has none.
+    """
     files = job.get('files', {})
     folder = files.get('folder', '')
-    extensions = files.get('extensions', [])
+    extensions = tuple(files.get('extensions', []))
     exclude_patterns = files.get('exclude_patterns', [])
-    target = files.get('target', '')
-    prompts = job.get('prompts', [])
+    for root, dirs, filenames in os.walk(folder):
+        for file in filenames:
+            if file.endswith(extensions):
+                filepath = os.path.join(root, file)
+                filepath = filepath.replace('\\', '/')
+                if any(exclude_pattern in filepath for exclude_pattern in exclude_patterns):
+                    continue
+                content_hash = index.hash(filepath)
+                todo = [i for i in range(len(keys)) if not index.is_done(filepath, content_hash, keys[i])]
+                if todo:
+                    yield filepath, content_hash, todo
+                elif on_skip:
+                    on_skip()
+
+
+def job_input_limit(config, job):
+    """
+    How many characters of document fit in one call to the model stack with @config, from its 'context-window'.
+    Larger documents are answered with map-reduce. None when the stack does not give its context window,
+    or the job sets 'map_reduce: false'. A job's 'map_reduce' section can override the context_window,
+    completion_tokens and safety margin (see lib/mapreduce.py).
+    """
+    options = job.get('map_reduce', True)
+    if options is False:
+        return None
+    options = options if isinstance(options, dict) else {}
+    window = options.get('context_window', config.get('context-window'))
+    if not window:
+        return None
+    template = len(job.get('system_prompt', '')) + max((len(p.get('prompt', '')) for p in job.get('prompts', [])), default=0)
+    return input_limit(window, options.get('completion_tokens', config.get('max_tokens', 1024)), template, options.get('safety', 0.8))
+
+
+def prepare_file(job, item, limit=None, cached=True):
+    """
+    CPU stage: extract the file's text and render the prompts that still have to run.
+    Runs in a worker process when the job has 'workers: {cpu: N}'.
+    A text longer than @limit characters is split into pieces that fit, each with its own prefix.
+    With @cached false the text is read without the document text cache, which is then neither read nor written.
+    """
+    filepath, content_hash, todo = item
+    metrics = {'filepath': filepath}
+    with Timer(metrics, 'extract'):
+        text = read_corpus_document(filepath) if cached else read_corpus_document.__wrapped__(filepath)
+    if not text:
+        return None
+
+    # answer = self.query_yes_no(f"Does the text below look like a resume, or describe a set of professional skills, or a professional knowledge base, or a personal study journal?\n\n{text}")
+    # if answer != 'yes':
+    #     journal.append({'filepath': filepath, 'answer': {
+    #         'filepath': filepath,
+    #         'error': 'not a resume',
+    #         'reason': text
+    #     }})
+    #     continue
 
-    if target.endswith('.yaml'):
-        answers = readYaml(target)
-    elif target.endswith('.json'):
-        answers = readYaml(target)
+    prompts = job.get('prompts', [])
+    item = {'filepath': filepath, 'hash': content_hash, 'metrics': metrics}
+    with Timer(metrics, 'render'):
+        # The prefix holds the document and is the same for every prompt, so it is filled in once.
+        prefix, suffix = job_template(job)
+        values = {'FILEPATH': filepath, 'GIVEN': text}
+        if limit and len(text) > limit:
+            # Too large for one call: every prompt is mapped over the pieces and the answers reduced.
+            item['pieces'] = [fill(prefix, dict(values, GIVEN=piece)) for piece in split_text(text, limit)]
+            item['limit'] = limit
+            values['GIVEN'] = ''
+        else:
+            item['prefix'] = fill(prefix, values)
+        item['prompts'] = [(i, fill(suffix, dict(values, PROMPT=prompts[i].get('prompt', ''))), prompts[i].get('schema')) for i in todo]
+        # With 'fuse: true', all the prompts go in one call, with the per-prompt calls kept as the fallback.
+        if job.get('fuse') and len(todo) > 1 and 'prefix' in item:
+            item['fused'] = fill(suffix, dict(values, PROMPT=fused_prompt([(i, prompts[i].get('prompt', '')) for i in todo])))
+    return item
+
+
+def ask(self, job, prefix, prompt, schema, calls, label):
+    "Send one prompt and record its latency and tokens in @calls."
+    call = {'prompt': label, 'backend': self.name()}
+    start = time.perf_counter()
+    # With a schema, the model stack constrains the output and returns a parsed object.
+    if job.get('rag', None):
+        answer = self.query_rag(prefix + prompt)
     else:
-        answers = []
+        answer = self.query(prompt, prefix=prefix, schema=schema, usage=call)
+    call['seconds'] = time.perf_counter() - start
+    calls.append(call)
+    return answer
+
+
+def query_file(self, job, item):
+    """
+    LLM stage: send the file's prompts. They go back to back with the same prefix,
+    so a session-enabled model stack keeps the file's text cached between them.
+    A fused item sends all prompts in one call first; only the prompts whose part of
+    the answer is missing or invalid are then sent on their own.
+    """
+    print(f"Processing {item['filepath']}")
+    calls = item['metrics'].setdefault('calls', [])
+    if 'pieces' in item:
+        return query_pieces(self, job, item, calls)
+    prefix = item.pop('prefix')
+    prompts = item.pop('prompts')
+    answers = {}
+    fused = item.pop('fused', None)
+    if fused:
+        schemas = [(i, schema) for i, p, schema in prompts]
+        try:
+            answers, failed = split_answer(ask(self, job, prefix, fused, fused_schema(schemas), calls, 'fused'), schemas)
+        except RetryableError as e:
+            print(f"  Fused call failed: {e}")
+            failed = [i for i, schema in schemas]
+        if failed:
+            print(f"  Asking prompts {failed} one at a time")
+        prompts = [x for x in prompts if x[0] in failed]
+    for i, p, schema in prompts:
+        answers[i] = ask(self, job, prefix, p, schema, calls, i)
+    item['answers'] = sorted(answers.items())
+    return item
+
+
+def query_pieces(self, job, item, calls):
+    "LLM stage for a document split into pieces: map each prompt over the pieces in parallel, then reduce the answers."
+    pieces = item.pop('pieces')
+    options = job.get('map_reduce') if isinstance(job.get('map_reduce'), dict) else {}
+    reduce_template = compile_template(options.get('reduce_prompt', REDUCE_PROMPT))
+    print(f"  {len(pieces)} pieces")
+    answers = []
+    for i, p, schema in item.pop('prompts'):
+        def ask_map(n, piece):
+            return ask(self, job, piece, p, schema, calls, f"{i}/map{n}")
+
+        def ask_reduce(partials):
+            parts = '\n\n'.join(f"PART {n + 1}:\n{partial}" for n, partial in enumerate(partials))
+            prompt = fill(reduce_template, {'FILEPATH': item['filepath'], 'PROMPT': p.strip(), 'ANSWERS': parts})
+            return ask(self, job, '', prompt, schema, calls, f"{i}/reduce")
+
+        answers.append((i, map_reduce(pieces, ask_map, ask_reduce, item['limit'], options.get('parallel', 4))))
+    item['answers'] = answers
+    return item
+
+
+def parse_file(target, item):
+    "CPU stage: turn the file's raw answers into the records stored for the target format."
+    filepath = item['filepath']
+    results = []
+    start = time.perf_counter()
+    for i, answer in item.pop('answers'):
+        if not isinstance(answer, str):
+            if target.endswith(('.txt', '.md', '.rst')):
+                o = f"FILEPATH: {filepath}\n{json.dumps(answer, indent=2)}"
+            else:
+                o = answer if isinstance(answer, dict) else {'answer': answer}
+                o['filepath'] = filepath
+        elif target.endswith(('.yaml', '.json')):
+            o = parse_answer(answer, 'yaml' if target.endswith('.yaml') else 'json')
+            o['filepath'] = filepath
+        elif target.endswith(('.txt', '.md', '.rst')):
+            answer = answer.replace('```txt', '').replace('```', '')
+            o = answer.strip()
+            o = f"FILEPATH: {filepath}\n{o}"
+        else:
+            o = f"FILEPATH: {filepath}\n{answer}"
+        results.append((i, o))
+    item['metrics']['parse'] = time.perf_counter() - start
+    item['results'] = results
+    return item
 
-    files_processed = set(answer.get('filepath') for answer in answers)
+
+def run_job(self, job):
+    """
+    Run every prompt of @job against every file in its folder that has not been answered yet.
+    Extraction, rendering and parsing run on the CPU tier and the LLM calls on the LLM tier of a
+    JobExecutor; a job's 'workers' section sizes them, e.g. workers: {cpu: 4, llm: 2}.
+    """
+    files = job.get('files', {})
+    target = files.get('target', '')
+    prompts = job.get('prompts', [])
+
+    # Results are appended to a journal as they arrive; the target file is only written by compact_job.
+    journal = job_journal(job)
+    seed_journal(job, journal)
+    # The skip index answers "is this prompt done for this version of this file?" in O(1).
+    index = job_index(job).load(journal.read())
+    keys = job_keys(job)
+    save_every = job.get('index_save_every', 50)
+    processed = 0
+    # Timings and token counts per file go to '<target>.metrics.jsonl'; a summary is printed at the end.
+    telemetry = Telemetry(f"{target}.metrics.jsonl" if target else None)
+
+    def save(item):
+        nonlocal processed
+        with Timer(item['metrics'], 'write'):
+            for i, o in item['results']:
+                journal.append({'filepath': item['filepath'], 'prompt': i, 'key': keys[i], 'hash': item['hash'], 'answer': o})
+                index.mark(item['filepath'], item['hash'], keys[i])
+            processed += 1
+            if processed % save_every == 0:
+                journal.sync()
+                index.save()
+        telemetry.record(item['metrics'])
 
     if files:
-        for root, dirs, files in os.walk(folder):
-            for file in files:
-                if file.endswith(tuple(extensions)):
-                    filepath = os.path.join(root, file)
-                    if not filepath:
-                        pass
-                    if filepath in files_processed:
-                        continue
-                    filepath = filepath.replace('\\', '/')
-                    if any(exclude_pattern in filepath for exclude_pattern in exclude_patterns):
-                        continue
-
-                    if any(answer.get('filepath') == filepath for answer in answers):
-                        continue
-
-                    text = read_corpus_document(filepath)
-                    if not text:
-                        continue
-
-                    # answer = self.query_yes_no(f"Does the text below look like a resume, or describe a set of professional skills, or a professional knowledge base, or a personal study journal?\n\n{text}")
-                    # if answer != 'yes':
-                    #     answers.append({
-                    #         'filepath': filepath,
-                    #         'error': 'not a resume',
-                    #         'reason': text
-                    #     })
-                    #     continue
-                    
-                    print(f"Processing {filepath}")
-                    for prompt in prompts:
-                        p = job.get('system_prompt', f'GIVEN:\n{{GIVEN}}\n\nPROMPT:\n{{PROMPT}}') + "\n\n"
-                        p = p.replace('{{FILEPATH}}', filepath)
-                        p = p.replace('{{GIVEN}}', text)
-                        p = p.replace('{{PROMPT}}', prompt.get('prompt', ''))
-                        p.strip()
-                        if job.get('rag', None):
-                            answer = self.query_rag(p)
-                        else:
-                            answer = self.query(p)
-                        
-                        if target.endswith('.yaml'):
-                            answer = answer.split('```yaml', '')[1]
-                            answer = answer.split('```', '')[0]
-                            try:
-                                o = yaml.safe_load(to_utf8(answer))
-                            except Exception as e:
-                                o = {
-                                    'filepath': filepath,
-                                    'error': str(e),
-                                    'reason': answer
-                                }
-                                o['filepath'] = filepath
-                                answers.append(o)
-                                continue
-                            o['filepath'] = filepath
-                            answers.append(o)
-                        elif target.endswith('.json'):
-                            if '```json' in answer:
-                                answer = answer.split('```json')[1]
-                                answer = answer.split('```')[0]
-                            o = json.loads(answer)
-                            o['filepath'] = filepath
-                            answers.append(o)
-                        elif target.endswith(('.txt', '.md', '.rst')):
-                            answer = answer.replace('```txt', '').replace('```', '')
-                            o = answer.strip()
-                            o = f"FILEPATH: {filepath}\n{o}"
-                            answers.append(o)
-                        else:
-                            o = f"FILEPATH: {filepath}\n{o}"
-                            answers.append(answer)
-
-
-                        if target:
-                            if target.endswith('.yaml'):
-                                writeYaml(target, answers)
-                            elif target.endswith('.json'):
-                                writeJson(target, answers)
-                            elif target.endswith('.txt'):
-                                writeText(target, answers)
-                            elif target.endswith('.md'):
-                                writeText(target, answers)
-                            elif target.endswith('.rst'):
-                                writeText(target, answers)
-                            else:
-                                raise ValueError(f"Unsupported target file extension: {target}")
-                            files_processed.add(filepath)
-    return answers
+        limit = job_input_limit(getattr(self, 'config', {}), job)
+        stages = [
+            ('cpu', functools.partial(prepare_file, job, limit=limit)),
+            ('llm', lambda item: query_file(self, job, item)),
+            ('cpu', functools.partial(parse_file, target)),
+        ]
+        with journal, JobExecutor.from_config(job.get('workers')) as executor:
+            executor.run(job_files(job, index, keys), stages, save)
+        index.save()
+        print(format_summary(telemetry.close()))
+        # Failure rate, retries and tail latency of the model calls (lib/retry.py).
+        if hasattr(self, 'print_report'):
+            self.print_report()
+
+    if target:
+        return compact_job(job)
+    return [record['answer'] for record in journal.read()]
                         
 
 
@@ -133,170 +390,199 @@ def run_job(self, job):
 
 
 
-def summarize_resumes():
-    """Example usage of the ChromaRAG system"""
-    
-    # Load credentials and model
-    credentials = readYaml(findPath("credentials.yaml"))
-    stack = credentials['modelstack']['bedrock-haiku']
-    stack = credentials['modelstack']['ollama-summarization']
-    stack = credentials['modelstack']['ollama-yaml-generation']
-    modelstack = ModelStack.from_config(stack)
-    jobfile = readYaml(findPath("jobs.yaml"))
-    jobs = jobfile.get('jobs', {})
-    job = jobs.get('resume', {})
+def plan_job(job, stack, estimates=None):
+    """
+    Dry run of run_job: walk the files, apply the excludes and the skip index, render every prompt that would be
+    sent and count its tokens. Estimates tokens, time and cost from jobs.yaml 'estimates' (see lib/planner.py)
+    for the model stack config @stack. Makes no LLM calls and writes nothing.
+    """
+    estimates = estimates or {}
+    workers = job.get('workers') or {}
+    model = stack.get('model', stack.get('class'))
+    rates = rates_for(model, estimates.get('models'))
+    plan = Plan(model,
+                context_window=stack.get('context-window'),
+                rates=rates,
+                completion_tokens=rates.get('completion_tokens', estimates.get('completion_tokens', 500)),
+                concurrency=estimates.get('concurrency', workers.get('llm', 1)),
+                count_tokens=get_tokenizer(estimates.get('tokenizer', 'auto')))
 
-    rag = ChromaRAG(modelstack, collection_path=job.get('rag', ''))
-    rag.run_job(job)
+    # Results of runs that predate the journal are not seen here, so those files count as work to do.
+    index = job_index(job).load(job_journal(job).read())
+    keys = job_keys(job)
 
+    def add(item):
+        prompts = [item['fused']] if 'fused' in item else [p for i, p, schema in item['prompts']]
+        # Map calls are counted for documents that need map-reduce; the smaller reduce calls are not.
+        prefixes = item.get('pieces') or [item['prefix']]
+        plan.add(item['filepath'], [prefix + p for prefix in prefixes for p in prompts])
 
-def aggregate_resumes():
-    """Process each resume in the summarized.yaml file"""
-    target = readYaml(findPath("jobs.yaml"))['jobs']['resume']['files']['target']
-    if not os.path.exists(target):
-        print(f"Target file not found: {target}")
-        return
-    
-    resumes = readYaml(target)
-    
-    agg = {
-        'experience': {},
-        'education': {},
-        'skills': {},
-        'certifications': {},
-        'projects': {}
-    }
-
-    def agg_item(resume, agg, key, subkey, fields):
-        agg[key] = agg.get(key, {})
-        rr = resume.get(key) or []
-        for r in rr:
-            sk = r.get(subkey)
-            if not sk:
-                continue
-            if type(sk) == list:
-                continue
-            agg[key][sk] = agg[key].get(sk) or {}
-            for field in fields.split(','): 
-                ft = ''
-                if len(field.split(':')) > 1:
-                    field, ft = field.split(':')
-                if ft == 'str':
-                    agg[key][sk][field] = agg[key][sk].get(field) or ""
-                else:
-                    agg[key][sk][field] = agg[key][sk].get(field) or {}
-                v = r.get(field)
-                if not v:
-                    continue
-                if type(v) == list:
-                    for vItem in v:
-                        if type(vItem) == dict:
-                            for k, v in vItem.items():
-                                agg[key][sk][field][k] = agg[key][sk][field].get(k) or {}
-                                agg[key][sk][field][k][v] = None
-                        else:
-                            if ft == 'str':
-                                agg[key][sk][field] += f"{vItem}\n"
-                            else:
-                                agg[key][sk][field][vItem] = None
-                else:
-                    if ft == 'str':
-                        if not v in agg[key][sk][field]:
-                            agg[key][sk][field] += f"{v}\n"
-                    else:
-                        agg[key][sk][field][v] = None
-        return agg
-
-    for resume in resumes:
-        print(f"Processing resume: {resume.get('name', 'No name')}")
-        agg_item(resume, agg, 'experience', 'company', 'dates,description:str,title')
-        agg_item(resume, agg, 'education', 'school', 'dates,description,degree')
-        agg_item(resume, agg, 'skills', 'skill', 'description,level,where_utilized,how_utilized,why_utilized,how_often_utilized,how_long_utilized,how_much_utilized')
-        agg_item(resume, agg, 'certifications', 'certification', 'dates,description,issuer')
-        agg_item(resume, agg, 'projects', 'project', 'dates,description,skills,technologies')
-
-    writeYaml(target.replace('summarized', 'aggregated'), agg)
-
-
-def condense_resumes():
+    if job.get('files'):
+        # The dry run leaves the text cache alone, so it writes nothing.
+        stage = functools.partial(prepare_file, job, limit=job_input_limit(stack, job), cached=False)
+        with JobExecutor.from_config(workers) as executor:
+            executor.run(job_files(job, index, keys, on_skip=plan.skip), [('cpu', stage)], add)
+    return plan.summary()
+
+
+def run_named_job(job_name, stack_name):
+    "Run a job from jobs.yaml with a model stack from credentials.yaml. Returns the job's answers."
+    credentials = readYaml(findPath("credentials.yaml"))
+    modelstack = ModelStack.from_config(credentials['modelstack'][stack_name])
     jobfile = readYaml(findPath("jobs.yaml"))
-    jCondensed = jobfile.get('condensed')
+    job = jobfile.get('jobs', {}).get(job_name, {})
+    if job.get('rag'):
+        raise ValueError(f"Job '{job_name}' asks for RAG, which run_job does not support yet. Remove 'rag' from the job.")
+    return run_job(modelstack, job)
+
+
+def summarize_resumes(stage=None, records=None):
+    "Summarize every resume (the 'resume' job). Pipeline stage; returns the summarized records."
+    stage = stage or {}
+    return run_named_job(stage.get('job', 'resume'), stage.get('modelstack', 'ollama-yaml-generation'))
+
+
+def job_records(job):
+    "Stream a job's current results: from its journal, or from the target file of a run that predates journals."
+    journal = job_journal(job)
+    if journal.exists():
+        return current_answers(journal, job_keys(job))
+    target = job.get('files', {}).get('target', '')
+    return iter(readYaml(target) or [])
+
+
+def aggregate_resumes(stage=None, records=None):
+    """
+    Fold the summarized resumes into one entry per company, school, skill, etc.
+    Field handling comes from the job's 'aggregate' spec (see lib/aggregate.py). The aggregation state is
+    saved next to the output, so a later run only folds in resumes that are new or changed.
+    Pipeline stage: @records are the summarized resumes when the summarize stage just ran; otherwise they are
+    read from the job's journal or target. Returns the aggregated entries.
+    """
+    job = readYaml(findPath("jobs.yaml"))['jobs'][(stage or {}).get('job', 'resume')]
+    target = job['files']['target']
+    if records is None:
+        if not os.path.exists(target) and not job_journal(job).exists():
+            print(f"Target file not found: {target}")
+            return
+        records = job_records(job)
 
-    """Condense the resumes into a more readable format"""
-    target = readYaml(findPath("jobs.yaml"))['jobs']['resume']['files']['target']
-    if not os.path.exists(target):
-        print(f"Target file not found: {target}")
-        return
+    aggFile = target.replace('summarized', 'aggregated')
+    aggregator = Aggregator(job.get('aggregate'), state_path=f"{aggFile}.state.json").load()
+    stats = aggregator.update(records)
+    print(f"Aggregated resumes: {stats}")
+    aggregator.save()
+    result = aggregator.result()
+    replace_file(aggFile, lambda fn: writeYaml(fn, result))
+    return result
+
+
+def condense_group(modelstack, group):
+    "Ask the model to rewrite one aggregated group. Returns the group with its 'result', or None if the answer was unusable."
+    result = modelstack.query(group['prompt'], max_tokens="8K", schema=group['schema'])
+    if isinstance(result, str):
+        result = parse_answer(result, 'yaml')
+        if 'error' in result:
+            print(f"  Could not condense {group['category']}/{group['key']}: {result['error']}")
+            return None
+    group['result'] = result
+    return group
+
+
+def condense_resumes(stage=None, records=None):
+    """
+    Condense the resumes into a more readable format: one LLM call per (category, key) group of the aggregated file.
+    Each group's input is hashed and its result memoized in '<condensed>.journal.jsonl', so only groups whose
+    input changed are sent again. Those run concurrently, with jobs.yaml 'condensed_workers' threads.
+    Pipeline stage: @records is the aggregate when the aggregate stage just ran. Returns the condensed entries.
+    """
+    stage = stage or {}
+    jobfile = readYaml(findPath("jobs.yaml"))
+    jCondensed = jobfile.get('condensed')
 
+    target = jobfile['jobs'][stage.get('job', 'resume')]['files']['target']
     aggFile = target.replace('summarized', 'aggregated')
-    if not os.path.exists(aggFile):
+    if records is not None:
+        agg = records
+    elif os.path.exists(aggFile):
+        agg = readYaml(aggFile)
+    else:
         print(f"Aggregated file not found: {aggFile}")
         return
-    agg = readYaml(aggFile)
     condenseFile = target.replace('summarized', 'condensed')
 
     credentials = readYaml(findPath("credentials.yaml"))
-    stack = credentials['modelstack']['bedrock-haiku']
-    stack = credentials['modelstack']['ollama-yaml-generation']
-    stack = credentials['modelstack']['ollama-summarization']
+    stack = credentials['modelstack'][stage.get('modelstack', 'ollama-summarization')]
     modelstack = ModelStack.from_config(stack)
-    rag = ChromaRAG(modelstack, collection_path=None)
+    schemas = jobfile.get('condensed_schema') or {}
 
-    out = {}
+    # Earlier results, by (category, key). Later journal lines win.
+    memo = Journal(f"{condenseFile}.journal.jsonl")
+    done = {}
+    for record in memo.read():
+        done[(record['category'], record['key'])] = record
+
+    groups = []
+    todo = []
     for k0, v0 in agg.items():
-        out[k0] = {}
-        for k1, v1 in v0.items():
+        for k1, v1 in (v0 or {}).items():
             prompt = jCondensed.get(k0).replace('{KEY}', k1).replace('{JSON}', json.dumps(v1))
-            result = rag.query(prompt, max_tokens="8K")
-            result = result.replace('```yaml', '').replace('```json', '').replace('```', '')
-            try:
-                o = json.loads(result)
-            except Exception as e:
-                try:
-                    o = yaml.safe_load(to_utf8(result))
-                except Exception as e:
-                    o = {
-                        'error': str(e),
-                        'reason': result
-                    }
-                    continue
-            out[k0][k1] = o
-            writeYaml(condenseFile, out)
-
-
-def summarize_python_codebase():
-    """Example usage of the ChromaRAG system"""
-    
-    # Load credentials and model
-    credentials = readYaml(findPath("credentials.yaml"))
-    stack = credentials['modelstack']['bedrock-haiku']
-    stack = credentials['modelstack']['ollama-summarization']
-    stack = credentials['modelstack']['ollama-code']
-    stack = credentials['modelstack']['bedrock-claude-connet-4-5']
-    modelstack = ModelStack.from_config(stack)
-    jobfile = readYaml(findPath("jobs.yaml"))
-    jobs = jobfile.get('jobs', {})
-    job = jobs.get('python-zinclusive', {})
-
-    rag = ChromaRAG(modelstack, collection_path=job.get('rag', ''))
-    rag.run_job(job)
+            schema = schemas.get(k0)
+            h = md5(json.dumps([prompt, schema, stack.get('model')], sort_keys=True))
+            group = {'category': k0, 'key': k1, 'hash': h, 'prompt': prompt, 'schema': schema}
+            groups.append(group)
+            old = done.get((k0, k1))
+            if not old or old['hash'] != h:
+                todo.append(group)
+    print(f"Condensing {len(todo)} of {len(groups)} groups; the rest are unchanged.")
+
+    def save(group):
+        done[(group['category'], group['key'])] = {'category': group['category'], 'key': group['key'], 'hash': group['hash'], 'result': group['result']}
+        memo.append(done[(group['category'], group['key'])])
+
+    workers = jobfile.get('condensed_workers') or {'llm': 4}
+    with memo, JobExecutor.from_config(workers) as executor:
+        executor.run(todo, [('llm', lambda group: condense_group(modelstack, group))], save)
+    if todo:
+        modelstack.print_report()
+
+    # Write the output from current groups only, and rewrite the memo without stale entries.
+    out = {k0: {} for k0 in agg}
+    current = []
+    for group in groups:
+        record = done.get((group['category'], group['key']))
+        if record and record['hash'] == group['hash']:
+            out[group['category']][group['key']] = record['result']
+            current.append(record)
+    replace_file(condenseFile, lambda fn: writeYaml(fn, out))
+
+    def rewrite(fn):
+        with Journal(fn) as journal:
+            for record in current:
+                journal.append(record)
+    replace_file(memo.path, rewrite)
+    return out
+
+
+def summarize_python_codebase(stage=None, records=None):
+    "List the skills used in each file of the Python codebase (the 'python-zinclusive' job). Pipeline stage."
+    stage = stage or {}
+    return run_named_job(stage.get('job', 'python-zinclusive'), stage.get('modelstack', 'bedrock-claude-connet-4-5'))
 
 
 def test2():    
+    from lib.rag import Rag
     credentials = readYaml(findPath("credentials.yaml"))
     stack = credentials['modelstack']['bedrock-haiku']
-    modelstack = ModelStack.from_config(stack)
-    rag = ChromaRAG(modelstack, collection_path="resumes")
 
     # Load resumes (you'll need to create a 'resumes' folder with .txt or .md files)
     corpus_folder = r"C:\Rob\RAG\Resumes, Work History, Career"
-    if os.path.exists(corpus_folder):
-        rag.load_corpus(corpus_folder)
-    else:
+    if not os.path.exists(corpus_folder):
         print(f"Creating {corpus_folder} folder. Please add corpus files to this folder.")
         os.makedirs(corpus_folder, exist_ok=True)
         print("No resumes loaded. Add files and run again.")
         return
+    rag = Rag("resumes", corpus_folder, stack)
     
     # Example queries
     questions = [
@@ -307,14 +593,43 @@ def test2():
     
     for question in questions:
         print(f"\nQuestion: {question}")
-        result = rag.query(question, n_results=3)
-        print(f"Answer: {result['answer']}")
-        print(f"Sources: {', '.join(result['sources'])}")
+        answer = rag.query(question)
+        print(f"Answer: {answer}")
         print("-" * 80)
 
 
+# The functions that jobs.yaml pipeline stages can 'run'.
+PIPELINE_FUNCTIONS = {
+    'summarize_resumes': summarize_resumes,
+    'aggregate_resumes': aggregate_resumes,
+    'condense_resumes': condense_resumes,
+    'summarize_python_codebase': summarize_python_codebase,
+}
+
+
+def dry_run(jobfile, pipeline, names=None):
+    "Print an estimate for every pipeline stage in @names (default: all) that runs a job."
+    credentials = readYaml(findPath("credentials.yaml"))
+    for name in pipeline.order(names):
+        stage = pipeline.stages[name]
+        job = jobfile.get('jobs', {}).get(stage.get('job'))
+        # Only the stages that run a job's prompts over its files can be estimated up front.
+        if not job or not stage.get('modelstack') or stage['run'] not in ['summarize_resumes', 'summarize_python_codebase']:
+            print(f"Stage {name}: not estimated")
+            continue
+        print(f"Stage {name}:")
+        print(format_plan(plan_job(job, credentials['modelstack'][stage['modelstack']], jobfile.get('estimates'))))
+
+
 if __name__ == "__main__":
-    #summarize_resumes()
-    # aggregate_resumes()
-    # condense_resumes()
-    summarize_python_codebase()
+    # python jobs.py                       run every stale stage of the jobs.yaml pipeline
+    # python jobs.py aggregate condense    run those stages (and what they depend on) if stale
+    # python jobs.py condense --force      run them even if they are up to date
+    # python jobs.py --dry-run             estimate tokens, time and cost of the job stages without running them
+    jobfile = readYaml(findPath("jobs.yaml"))
+    pipeline = Pipeline(jobfile['pipeline'], PIPELINE_FUNCTIONS, config=jobfile)
+    names = [a for a in sys.argv[1:] if not a.startswith('--')]
+    if '--dry-run' in sys.argv:
+        dry_run(jobfile, pipeline, names or None)
+    else:
+        pipeline.run(names or None, force='--force' in sys.argv)
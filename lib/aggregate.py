@@ -0,0 +1,252 @@
+import os
+import json
+from lib.tools import readJson, writeJson, md5
+from lib.journal import replace_file
+
+
+# Group records (e.g. summarized resumes) by category and key, and collect the distinct values of each field.
+#
+# The spec says, per category, which field of each entry is the key and how every other field is collected:
+#
+#   experience:
+#     key: company
+#     fields:
+#       dates: set          # distinct values, in the order first seen
+#       description: text   # distinct lines, joined into one block of text
+#       title: set
+#
+# Lists of dicts (e.g. [{'language': 'Python'}, ...]) collect the distinct values per dict key.
+#
+# Every value is counted by the number of records that contributed it. That lets a changed or deleted
+# record be taken back out, so the state can be saved and only new or changed records folded in next time.
+
+
+DEFAULT_SPEC = {
+    'experience': {'key': 'company', 'fields': {'dates': 'set', 'description': 'text', 'title': 'set'}},
+    'education': {'key': 'school', 'fields': {'dates': 'set', 'description': 'set', 'degree': 'set'}},
+    'skills': {'key': 'skill', 'fields': {f: 'set' for f in ['description', 'level', 'where_utilized', 'how_utilized', 'why_utilized', 'how_often_utilized', 'how_long_utilized', 'how_much_utilized']}},
+    'certifications': {'key': 'certification', 'fields': {'dates': 'set', 'description': 'set', 'issuer': 'set'}},
+    'projects': {'key': 'project', 'fields': {'dates': 'set', 'description': 'set', 'skills': 'set', 'technologies': 'set'}},
+}
+
+FIELD_TYPES = ['set', 'text']
+
+
+
+
+def check_spec(spec):
+    for category, c in spec.items():
+        if not c.get('key'):
+            raise ValueError(f"Aggregate category '{category}' needs a 'key'")
+        for field, t in (c.get('fields') or {}).items():
+            if t not in FIELD_TYPES:
+                raise ValueError(f"Unsupported type '{t}' for {category}.{field}. Use one of {FIELD_TYPES}")
+    return spec
+
+
+def values_of(v):
+    "Flatten a field value into (subkey, value) pairs; subkey is None for plain values."
+    if v is None or v == '':
+        return
+    if isinstance(v, list):
+        for item in v:
+            if isinstance(item, dict):
+                for k, x in item.items():
+                    for _, y in values_of(x):
+                        yield str(k), y
+            elif item is not None and item != '':
+                yield None, str(item)
+    elif isinstance(v, dict):
+        for k, x in v.items():
+            for _, y in values_of(x):
+                yield str(k), y
+    else:
+        yield None, str(v)
+
+
+
+
+class Aggregator:
+    """
+    Folds a stream of records into per-category, per-key collections of field values.
+
+    aggregator = Aggregator(spec, state_path='aggregated.state.json').load()
+    aggregator.update(records)      # only new or changed records cost anything
+    aggregator.save()
+    writeYaml('aggregated.yaml', aggregator.result())
+    """
+
+    def __init__(self, spec=None, state_path=None):
+        self.spec = check_spec(spec or DEFAULT_SPEC)
+        self.spec_hash = md5(json.dumps(self.spec, sort_keys=True))
+        self.state_path = state_path
+        self.records = {}   # record id -> {'hash': ..., 'contrib': ...}
+        self.agg = {}       # category -> key -> field -> subkey -> value -> count
+        self.refs = {}      # category -> key -> number of records that mention the key
+
+    def load(self):
+        if self.state_path and os.path.exists(self.state_path):
+            state = readJson(self.state_path)
+            # A different spec means the saved counts mean something else.
+            if state.get('spec_hash') == self.spec_hash:
+                self.records = state.get('records', {})
+                self.agg = state.get('agg', {})
+                self.refs = state.get('refs', {})
+        return self
+
+    def save(self):
+        if self.state_path:
+            state = {'spec_hash': self.spec_hash, 'records': self.records, 'agg': self.agg, 'refs': self.refs}
+            replace_file(self.state_path, lambda fn: writeJson(fn, state, pretty=False))
+
+    def contribution(self, record):
+        "What one record adds: category -> key -> field -> subkey ('' for plain values) -> distinct values in order."
+        contrib = {}
+        for category, c in self.spec.items():
+            for entry in record.get(category) or []:
+                if not isinstance(entry, dict):
+                    continue
+                key = entry.get(c['key'])
+                if not key or isinstance(key, (list, dict)):
+                    continue
+                fields = contrib.setdefault(category, {}).setdefault(str(key), {})
+                for field in c.get('fields') or {}:
+                    values = fields.setdefault(field, {})
+                    for subkey, v in values_of(entry.get(field)):
+                        # A dict keeps insertion order and drops duplicates.
+                        values.setdefault(subkey or '', {})[v] = None
+        for fields in (k for cat in contrib.values() for k in cat.values()):
+            for field, values in fields.items():
+                fields[field] = {subkey: list(v) for subkey, v in values.items()}
+        return contrib
+
+    def apply(self, contrib, sign):
+        for category, keys in contrib.items():
+            for key, fields in keys.items():
+                refs = self.refs.setdefault(category, {})
+                refs[key] = refs.get(key, 0) + sign
+                target = self.agg.setdefault(category, {}).setdefault(key, {})
+                for field, values in fields.items():
+                    counts = target.setdefault(field, {})
+                    for subkey, vs in values.items():
+                        bucket = counts.setdefault(subkey, {})
+                        for v in vs:
+                            n = bucket.get(v, 0) + sign
+                            if n > 0:
+                                bucket[v] = n
+                            else:
+                                bucket.pop(v, None)
+                        if not bucket:
+                            counts.pop(subkey)
+                if refs[key] <= 0:
+                    refs.pop(key)
+                    self.agg[category].pop(key)
+
+    def update(self, records, remove_missing=True):
+        """
+        Fold a stream of records into the aggregate. Records are identified by their 'filepath'.
+        Unchanged records are skipped, changed ones are taken out and folded in again, and with
+        @remove_missing, records that are no longer in the stream are taken out.
+        Returns counts of added, changed, removed and unchanged records.
+        """
+        stats = {'added': 0, 'changed': 0, 'removed': 0, 'unchanged': 0}
+        seen = set()
+        for record in records:
+            if not isinstance(record, dict) or 'error' in record:
+                continue
+            body = json.dumps(record, sort_keys=True, default=str)
+            id = record.get('filepath') or md5(body)
+            # Several records for one file are told apart by their order.
+            n = 1
+            base = id
+            while id in seen:
+                n += 1
+                id = f"{base}#{n}"
+            seen.add(id)
+            h = md5(body)
+            old = self.records.get(id)
+            if old and old['hash'] == h:
+                stats['unchanged'] += 1
+                continue
+            if old:
+                self.apply(old['contrib'], -1)
+                stats['changed'] += 1
+            else:
+                stats['added'] += 1
+            contrib = self.contribution(record)
+            self.apply(contrib, +1)
+            self.records[id] = {'hash': h, 'contrib': contrib}
+        if remove_missing:
+            for id in [id for id in self.records if id not in seen]:
+                self.apply(self.records.pop(id)['contrib'], -1)
+                stats['removed'] += 1
+        return stats
+
+    def result(self):
+        "The aggregate as plain data: sets become lists, text fields one block of lines."
+        out = {}
+        for category, c in self.spec.items():
+            fields_spec = c.get('fields') or {}
+            out[category] = {}
+            for key, fields in self.agg.get(category, {}).items():
+                item = {}
+                for field, counts in fields.items():
+                    plain = list(counts.get('', {}))
+                    nested = {subkey: list(vs) for subkey, vs in counts.items() if subkey != ''}
+                    if fields_spec.get(field) == 'text':
+                        lines = plain + [f"{subkey}: {v}" for subkey, vs in nested.items() for v in vs]
+                        item[field] = ''.join(f"{line}\n" for line in lines)
+                    elif nested:
+                        if plain:
+                            nested[''] = plain
+                        item[field] = nested
+                    else:
+                        item[field] = plain
+                out[category][key] = item
+        return out
+
+
+
+
+def test_aggregate():
+    a = {'filepath': 'a.docx', 'experience': [
+        {'company': 'Acme', 'title': 'Dev', 'dates': '2001', 'description': 'Built things.'},
+        {'company': 'Initech', 'title': ['Lead', 'Manager'], 'description': ['Ran things.', 'Hired people.']},
+    ], 'skills': [{'skill': 'Python', 'level': 'Expert', 'where_utilized': [{'company': 'Acme'}]}]}
+    b = {'filepath': 'b.docx', 'experience': [{'company': 'Acme', 'title': 'Senior Dev', 'description': 'Built things.'}]}
+
+    aggregator = Aggregator()
+    assert aggregator.update([a, b]) == {'added': 2, 'changed': 0, 'removed': 0, 'unchanged': 0}
+    out = aggregator.result()
+    assert out['experience']['Acme']['title'] == ['Dev', 'Senior Dev']
+    assert out['experience']['Acme']['description'] == 'Built things.\n'
+    assert out['experience']['Initech']['description'] == 'Ran things.\nHired people.\n'
+    assert out['skills']['Python']['where_utilized'] == {'company': ['Acme']}
+
+    # Only the changed record is refolded, and values it no longer has go away.
+    b2 = dict(b, experience=[{'company': 'Acme', 'title': 'Principal'}])
+    assert aggregator.update([a, b2]) == {'added': 0, 'changed': 1, 'removed': 0, 'unchanged': 1}
+    assert aggregator.result()['experience']['Acme']['title'] == ['Dev', 'Principal']
+
+    # Removing a record removes what only it contributed.
+    aggregator.update([b2])
+    assert list(aggregator.result()['experience']) == ['Acme']
+    assert aggregator.result()['experience']['Acme']['title'] == ['Principal']
+
+
+def test_aggregate_state():
+    from lib.tools import getNewTemporaryFilePath
+    path = getNewTemporaryFilePath('aggregate', '.json')
+    a = {'filepath': 'a.docx', 'projects': [{'project': 'Rocket', 'skills': ['Python', 'C']}]}
+    aggregator = Aggregator(state_path=path)
+    aggregator.update([a])
+    aggregator.save()
+    aggregator = Aggregator(state_path=path).load()
+    assert aggregator.update([a])['unchanged'] == 1
+    assert aggregator.result()['projects']['Rocket']['skills'] == ['Python', 'C']
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    test_aggregate()
+    test_aggregate_state()
@@ -0,0 +1,242 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from lib.tools import DateTimeEncoder
+
+
+# A key-value cache in one SQLite file, shared by threads and processes.
+#
+# SQLite in WAL mode lets readers carry on while one writer commits, and every put is one transaction,
+# so a crash never leaves a half-written value behind. Entries live in namespaces, may expire after a
+# TTL, and the least recently used ones are evicted when the file grows past max_bytes.
+#
+#   cache = Cache('data/cache/cache.sqlite', max_bytes=512 * 1024 * 1024)
+#   cache.put('chroma_rag', {'collections': {...}}, namespace='ingest')
+#   cache.get('chroma_rag', namespace='ingest')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    value BLOB,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL,
+    expires REAL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires) WHERE expires IS NOT NULL;
+"""
+
+# How stale an entry's access time may get before a read updates it. Reads then rarely need the write lock.
+TOUCH_SECONDS = 60
+
+
+
+
+def encode(value):
+    "Store dicts, lists and numbers as JSON, and text and bytes as they are."
+    if isinstance(value, bytes):
+        return 'bytes', value
+    if isinstance(value, str):
+        return 'text', value
+    return 'json', json.dumps(value, cls=DateTimeEncoder, ensure_ascii=False)
+
+
+def decode(kind, value):
+    if kind == 'json':
+        return json.loads(value)
+    return value
+
+
+
+
+class Cache:
+    def __init__(self, path, max_bytes=None, default_ttl=None, evict_every=100):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.evict_every = evict_every
+        self.local = threading.local()
+        self.puts = 0
+        dir = os.path.dirname(path)
+        if dir:
+            os.makedirs(dir, exist_ok=True)
+        self.connect().executescript(SCHEMA)
+
+    def connect(self):
+        "One connection per thread and process; SQLite connections must not cross either."
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('PRAGMA busy_timeout=30000')
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def connection(self):
+        return Transaction(self.connect())
+
+    def get(self, key, namespace='default', default=None):
+        now = time.time()
+        with self.connection() as db:
+            row = db.execute('SELECT kind, value, accessed, expires FROM entries WHERE namespace=? AND key=?', (namespace, key)).fetchone()
+            if row is None:
+                return default
+            kind, value, accessed, expires = row
+            if expires is not None and expires <= now:
+                db.execute('DELETE FROM entries WHERE namespace=? AND key=?', (namespace, key))
+                return default
+            if now - accessed > TOUCH_SECONDS:
+                db.execute('UPDATE entries SET accessed=? WHERE namespace=? AND key=?', (now, namespace, key))
+        return decode(kind, value)
+
+    def put(self, key, value, namespace='default', ttl=None):
+        kind, data = encode(value)
+        size = len(data.encode('utf-8') if isinstance(data, str) else data)
+        now = time.time()
+        ttl = ttl if ttl is not None else self.default_ttl
+        with self.connection() as db:
+            db.execute('INSERT OR REPLACE INTO entries (namespace, key, kind, value, size, created, accessed, expires) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       (namespace, key, kind, data, size, now, now, now + ttl if ttl else None))
+        self.puts += 1
+        if self.max_bytes and self.puts % self.evict_every == 0:
+            self.evict()
+
+    def delete(self, key, namespace='default'):
+        with self.connection() as db:
+            db.execute('DELETE FROM entries WHERE namespace=? AND key=?', (namespace, key))
+
+    def clear(self, namespace=None):
+        with self.connection() as db:
+            if namespace is None:
+                db.execute('DELETE FROM entries')
+            else:
+                db.execute('DELETE FROM entries WHERE namespace=?', (namespace,))
+
+    def keys(self, namespace='default'):
+        with self.connection() as db:
+            return [row[0] for row in db.execute('SELECT key FROM entries WHERE namespace=? ORDER BY key', (namespace,))]
+
+    def evict(self):
+        "Drop expired entries, then the least recently used ones until the cache is under max_bytes. Returns the number dropped."
+        dropped = 0
+        with self.connection() as db:
+            dropped += db.execute('DELETE FROM entries WHERE expires IS NOT NULL AND expires <= ?', (time.time(),)).rowcount
+            if self.max_bytes:
+                total = db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+                if total > self.max_bytes:
+                    victims = []
+                    for namespace, key, size in db.execute('SELECT namespace, key, size FROM entries ORDER BY accessed'):
+                        if total <= self.max_bytes:
+                            break
+                        victims.append((namespace, key))
+                        total -= size
+                    db.executemany('DELETE FROM entries WHERE namespace=? AND key=?', victims)
+                    dropped += len(victims)
+        return dropped
+
+    def stats(self):
+        with self.connection() as db:
+            count, size = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return {'entries': count, 'bytes': size, 'max_bytes': self.max_bytes}
+
+    def close(self):
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            db.close()
+            self.local.db = None
+
+
+
+
+class Transaction:
+    "BEGIN IMMEDIATE ... COMMIT around a block, so each get or put is atomic and writers queue up instead of failing."
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.db.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+
+
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_cache():
+    """
+    The cache behind get_cache/put_cache: data/cache/cache.sqlite, capped by the CACHE_MAX_MB environment
+    variable (default 1024 MB).
+    """
+    global _default
+    with _default_lock:
+        if _default is None or _default.path != os.path.abspath('data/cache/cache.sqlite'):
+            max_mb = int(os.environ.get('CACHE_MAX_MB', 1024))
+            _default = Cache(os.path.abspath('data/cache/cache.sqlite'), max_bytes=max_mb * 1024 * 1024)
+        return _default
+
+
+
+
+def cache_writer(path, n):
+    "Used by test_cache: write from another process."
+    cache = Cache(path)
+    for i in range(n):
+        cache.put(f"k{i}", {'pid': os.getpid(), 'i': i}, namespace='shared')
+
+
+def test_cache():
+    import shutil
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(dir, 'cache.sqlite')
+        cache = Cache(path)
+        cache.put('a', {'x': [1, 2]})
+        cache.put('a', 'text', namespace='other')
+        cache.put('b', b'\x00\x01')
+        assert cache.get('a') == {'x': [1, 2]}
+        assert cache.get('a', namespace='other') == 'text'
+        assert cache.get('b') == b'\x00\x01'
+        assert cache.get('missing', default=0) == 0
+        assert cache.keys() == ['a', 'b']
+
+        # Expired entries are gone.
+        cache.put('short', 1, ttl=-1)
+        assert cache.get('short') is None
+
+        # Over max_bytes, the least recently used entries go first.
+        cache = Cache(path, max_bytes=2500, evict_every=1)
+        cache.clear()
+        cache.put('big0', 'x' * 1000)
+        cache.put('big1', 'x' * 1000)
+        cache.local.db.execute("UPDATE entries SET accessed = accessed - 1000 WHERE key = 'big1'")
+        cache.put('big2', 'x' * 1000)
+        assert cache.keys() == ['big0', 'big2']
+        assert cache.stats()['bytes'] <= 2500
+
+        # Several processes writing at once.
+        with ProcessPoolExecutor(max_workers=3) as pool:
+            list(pool.map(cache_writer, [path] * 3, [50] * 3))
+        assert len(cache.keys('shared')) == 50
+        assert cache.get('k49', namespace='shared')['i'] == 49
+    finally:
+        shutil.rmtree(dir)
+
+
+if __name__ == "__main__":
+    test_cache()
@@ -1,14 +1,17 @@
 import os
 from lib.fileconvert import convert_all_doc_to_docx, docx_to_text
 from lib.tools import *
-import pypdf
+from lib.memo import memoize, file_key
 
 
 file_extensions = [".docx", ".pdf", ".txt", ".md", ".rst"]
 
 
+@memoize('text', key=file_key, maxsize=64)
 def get_text(filepath):
+    "The text of a document, cached until the file changes."
     if filepath.endswith(".pdf"):
+        import pypdf
         return pypdf.PdfReader(filepath).pages[0].extract_text()
     elif filepath.endswith(".docx"):
         return docx_to_text(filepath)
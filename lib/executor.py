@@ -0,0 +1,126 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+
+
+class JobExecutor:
+    """
+    Runs items through a chain of stages on two tiers of workers:
+        'cpu' stages (text extraction, template rendering, output parsing) go to a process pool,
+        'llm' stages (network calls that mostly wait) go to a thread pool.
+
+    Workers pull their next task from the pool's shared queue as soon as they are free, so a worker that
+    drew a quick file moves on instead of waiting behind a slow one. The number of items in flight is
+    bounded, so a large job does not load all of its documents into memory at once.
+
+    with JobExecutor(cpu_workers=4, llm_workers=2) as executor:
+        executor.run(files, [('cpu', extract), ('llm', ask), ('cpu', parse)], save)
+
+    Functions for 'cpu' stages must be picklable (module-level functions or functools.partial of them).
+    With cpu_workers=0 the 'cpu' stages run on a single thread in this process instead.
+    """
+
+    def __init__(self, cpu_workers=0, llm_workers=1, max_in_flight=None):
+        self.cpu_workers = int(cpu_workers)
+        self.llm_workers = max(1, int(llm_workers))
+        self.max_in_flight = max_in_flight or 2 * (max(1, self.cpu_workers) + self.llm_workers)
+        self.cpu = None
+        self.llm = None
+
+    @staticmethod
+    def from_config(config):
+        "Build from a job's 'workers' section. cpu: 'auto' uses one process per core."
+        config = config or {}
+        cpu = config.get('cpu', 0)
+        if cpu == 'auto':
+            cpu = os.cpu_count() or 1
+        return JobExecutor(cpu_workers=cpu, llm_workers=config.get('llm', 1), max_in_flight=config.get('max_in_flight'))
+
+    def __enter__(self):
+        if self.cpu_workers > 0:
+            self.cpu = ProcessPoolExecutor(max_workers=self.cpu_workers)
+        else:
+            self.cpu = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cpu')
+        self.llm = ThreadPoolExecutor(max_workers=self.llm_workers, thread_name_prefix='llm')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        failed = exc_type is not None
+        self.llm.shutdown(wait=not failed, cancel_futures=failed)
+        self.cpu.shutdown(wait=not failed, cancel_futures=failed)
+
+    def run(self, items, stages, sink):
+        """
+        Push every item through @stages, a list of (tier, func). Each func takes the previous stage's
+        output; returning None drops the item. @sink is called in this thread with each final result,
+        in completion order. The first exception raised by a stage is re-raised here.
+        """
+        items = iter(items)
+        pending = {}
+        exhausted = False
+
+        def submit(i, x):
+            tier, func = stages[i]
+            pool = self.cpu if tier == 'cpu' else self.llm
+            pending[pool.submit(func, x)] = i
+
+        def refill():
+            nonlocal exhausted
+            while not exhausted and len(pending) < self.max_in_flight:
+                try:
+                    x = next(items)
+                except StopIteration:
+                    exhausted = True
+                    return
+                submit(0, x)
+
+        refill()
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                i = pending.pop(future)
+                y = future.result()
+                if y is None:
+                    continue
+                if i + 1 < len(stages):
+                    submit(i + 1, y)
+                else:
+                    sink(y)
+            refill()
+
+
+
+
+def square(x):
+    return x * x
+
+
+def test_executor():
+    import time
+    import threading
+    results = []
+    threads = set()
+
+    def slow_double(x):
+        threads.add(threading.current_thread().name)
+        time.sleep(0.01)
+        return None if x == 9 else x * 2
+
+    for cpu in [0, 2]:
+        results.clear()
+        with JobExecutor(cpu_workers=cpu, llm_workers=4) as executor:
+            executor.run(range(10), [('cpu', square), ('llm', slow_double)], results.append)
+        assert sorted(results) == [2 * x * x for x in range(10) if x != 3]
+    assert len(threads) > 1
+
+    try:
+        with JobExecutor(llm_workers=2) as executor:
+            executor.run(range(3), [('llm', lambda x: 1 / x)], results.append)
+        assert False
+    except ZeroDivisionError:
+        pass
+
+
+if __name__ == "__main__":
+    test_executor()
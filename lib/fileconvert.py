@@ -1,59 +1,375 @@
 import subprocess
 import os
-from docx import Document
+import re
+import sys
+import shutil
+import tempfile
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
 from lib.tools import readText
+from lib.skipindex import file_hash
 
 
-def convert_doc_to_docx(doc_path):
+# Converting legacy documents (.doc, .rtf, .odt) to .docx next to the original, so the rest of the code only
+# has to read .docx.
+#
+# A backend converts one file. They are tried in order until one succeeds:
+#   wordconv     Microsoft Office's Wordconv.exe (Windows with Office installed)
+#   libreoffice  soffice --headless (any OS with LibreOffice installed)
+#   text         pure Python: pulls the text out of the file and writes it as plain paragraphs
+#
+# Conversions run in a process pool, and the external converters are killed after a timeout per file.
+# Every result is also kept in a cache folder under the source file's hash, so a file that was converted
+# once (anywhere in any archive) is copied instead of converted again.
+
+LEGACY_EXTENSIONS = ['.doc', '.rtf', '.odt']
+CACHE_FOLDER = 'data/cache/converted'
+WORDCONV = r"C:\Program Files\Microsoft Office\root\Office16\Wordconv.exe"
+
+
+
+
+class ConversionError(Exception):
+    pass
+
+
+
+
+class Backend:
+    name = None
+    extensions = LEGACY_EXTENSIONS
+
+    def available(self):
+        return True
+
+    def convert(self, src_path, docx_path, timeout):
+        "Write @src_path as @docx_path. Raise ConversionError on failure."
+        raise NotImplementedError("Subclasses must implement this method.")
+
+    def run(self, args, timeout, cwd=None):
+        try:
+            subprocess.run(args, check=True, cwd=cwd, capture_output=True, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            raise ConversionError(f"{self.name} timed out after {timeout}s")
+        except subprocess.CalledProcessError as e:
+            raise ConversionError(f"{self.name} failed: {e.stderr.decode(errors='replace').strip()}")
+
+
+class WordconvBackend(Backend):
+    name = 'wordconv'
+    extensions = ['.doc']
+
+    def __init__(self, path=WORDCONV):
+        self.path = path
+
+    def available(self):
+        return os.path.exists(self.path)
+
+    def convert(self, src_path, docx_path, timeout):
+        self.run([self.path, "-oice", "-nme", src_path, docx_path], timeout, cwd=os.path.dirname(src_path) or None)
+
+
+class LibreOfficeBackend(Backend):
+    name = 'libreoffice'
+
+    def __init__(self, path=None):
+        self.path = path or shutil.which('soffice') or shutil.which('libreoffice')
+
+    def available(self):
+        return bool(self.path)
+
+    def convert(self, src_path, docx_path, timeout):
+        # Each conversion gets its own profile, or parallel soffice processes wait on each other's lock.
+        with tempfile.TemporaryDirectory() as tmp:
+            profile = 'file:///' + os.path.join(tmp, 'profile').replace('\\', '/').lstrip('/')
+            self.run([self.path, f"-env:UserInstallation={profile}", '--headless', '--convert-to', 'docx', '--outdir', tmp, src_path], timeout)
+            out = os.path.join(tmp, os.path.splitext(os.path.basename(src_path))[0] + '.docx')
+            if not os.path.exists(out):
+                raise ConversionError(f"libreoffice wrote no output for {src_path}")
+            shutil.move(out, docx_path)
+
+
+class TextBackend(Backend):
+    "Loses all formatting, but runs anywhere and is good enough to index the text."
+    name = 'text'
+
+    def convert(self, src_path, docx_path, timeout):
+        ext = os.path.splitext(src_path)[1].lower()
+        if ext not in ['.doc', '.rtf', '.odt']:
+            raise ConversionError(f"text backend cannot read {ext} files")
+        try:
+            if ext == '.doc':
+                text = doc_text(src_path)
+            elif ext == '.rtf':
+                text = rtf_text(readText(src_path))
+            else:
+                text = odt_text(src_path)
+        except Exception as e:
+            # A corrupt .odt is a bad zip, an unreadable .rtf fails to decode: both are just a failed conversion.
+            raise ConversionError(f"text backend cannot read {src_path}: {type(e).__name__}: {e}")
+        if not text.strip():
+            raise ConversionError(f"no text found in {src_path}")
+        from docx import Document
+        document = Document()
+        for paragraph in text.split('\n'):
+            document.add_paragraph(XML_UNSAFE.sub('', paragraph))
+        try:
+            document.save(docx_path)
+        except Exception as e:
+            raise ConversionError(f"text backend cannot write {docx_path}: {type(e).__name__}: {e}")
+
+
+BACKENDS = {
+    'wordconv': WordconvBackend,
+    'libreoffice': LibreOfficeBackend,
+    'text': TextBackend,
+}
+DEFAULT_BACKENDS = ['wordconv', 'libreoffice', 'text']
+
+
+
+
+XML_UNSAFE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+DOC_RUNS_8BIT = re.compile(rb'[\x20-\x7e\r\t\x91-\x97\xa0-\xff]{8,}')
+DOC_RUNS_16BIT = re.compile(rb'(?:[\x20-\x7e\r\t]\x00){8,}')
+
+
+def doc_text(path):
+    """
+    The text of a Word 97-2003 file, without parsing its structure: Word keeps the text as runs of cp1252 or
+    UTF-16 characters, so the longest printable runs of either kind are the document's text.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    narrow = [run.decode('cp1252', errors='replace') for run in DOC_RUNS_8BIT.findall(data)]
+    wide = [run.decode('utf-16-le', errors='replace') for run in DOC_RUNS_16BIT.findall(data)]
+    runs = narrow if sum(map(len, narrow)) >= sum(map(len, wide)) else wide
+    return '\n'.join(runs).replace('\r', '\n')
+
+
+def rtf_text(rtf):
+    "The text of an RTF document: drops groups like fonts and styles, control words and braces."
+    rtf = re.sub(r'\{\\\*[^{}]*\}|\{\\(fonttbl|colortbl|stylesheet|info)[^{}]*(\{[^{}]*\}[^{}]*)*\}', '', rtf)
+    rtf = re.sub(r"\\'([0-9a-fA-F]{2})", lambda m: bytes([int(m.group(1), 16)]).decode('cp1252', errors='replace'), rtf)
+    rtf = re.sub(r'\\(par|line)\b ?', '\n', rtf)
+    rtf = re.sub(r'\\tab\b ?', '\t', rtf)
+    rtf = re.sub(r'\\[a-zA-Z]+-?\d* ?', '', rtf)
+    rtf = re.sub(r'\\([{}\\])', r'\1', rtf)
+    return rtf.replace('{', '').replace('}', '').strip()
+
+
+def odt_text(path):
+    ns = '{urn:oasis:names:tc:opendocument:xmlns:text:1.0}'
+    with zipfile.ZipFile(path) as z:
+        root = ET.fromstring(z.read('content.xml'))
+    return '\n'.join(''.join(e.itertext()) for e in root.iter() if e.tag in [ns + 'p', ns + 'h'])
+
+
+
+
+def get_backends(names=None):
+    "The available backends among @names (default DEFAULT_BACKENDS), in order."
+    backends = [BACKENDS[name]() for name in (names or DEFAULT_BACKENDS)]
+    return [b for b in backends if b.available()]
+
+
+def docx_path_for(src_path):
+    return os.path.splitext(src_path)[0] + '.docx'
+
+
+def convert_file(src_path, backend_names=None, timeout=120, cache_folder=CACHE_FOLDER):
+    """
+    Convert one legacy file to .docx next to it. Runs in a worker process.
+    Returns (src_path, backend name or 'cache', error or None).
+    """
+    docx_path = docx_path_for(src_path)
+    cached = None
+    if cache_folder:
+        os.makedirs(cache_folder, exist_ok=True)
+        cached = os.path.join(cache_folder, file_hash(src_path) + '.docx')
+    used = 'cache'
+    if not cached or not os.path.exists(cached):
+        ext = os.path.splitext(src_path)[1].lower()
+        errors = []
+        tmp = f"{cached or docx_path}.{os.getpid()}.tmp.docx"
+        for backend in get_backends(backend_names):
+            if ext not in backend.extensions:
+                continue
+            try:
+                backend.convert(src_path, tmp, timeout)
+                used = backend.name
+                break
+            except ConversionError as e:
+                errors.append(str(e))
+            except Exception as e:
+                # Whatever a backend raises, the next one still gets its turn.
+                errors.append(f"{backend.name} failed: {type(e).__name__}: {e}")
+        else:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return src_path, None, '; '.join(errors) or f"no backend can convert {ext} files"
+        os.replace(tmp, cached or docx_path)
+    if cached:
+        shutil.copyfile(cached, docx_path)
+    # The .docx looks as old as its source, so corpus loads keyed on mtime do not see it as new.
+    os.utime(docx_path, (os.path.getatime(src_path), os.path.getmtime(src_path)))
+    return src_path, used, None
+
+
+def convert_doc_to_docx(doc_path, backend_names=None, timeout=120):
     if not os.path.exists(doc_path):
         print(f"Error: Source file not found at '{doc_path}'")
         return None
-        
     doc_path = doc_path.replace('\\', '/')
-    output_dir = os.path.dirname(doc_path)
-    base_name = os.path.splitext(os.path.basename(doc_path))[0]
-    docx_path = os.path.join(output_dir, f"{base_name}.docx")
-    
-    # if os.path.exists(docx_path):
-    #     # Set the last updated time to the doc file
-    #     os.utime(docx_path, (os.path.getatime(doc_path), os.path.getmtime(doc_path)))
-
-    if not os.path.exists(docx_path):
-        try:
-            print(f"Converting '{doc_path}' to text using docx...")
-            subprocess.run([
-                r"C:\Program Files\Microsoft Office\root\Office16\Wordconv.exe",
-                "-oice",
-                "-nme",
-                doc_path,
-                docx_path
-            ], check=True, cwd=output_dir, capture_output=True)
-
-            # Set the last updated time to the docx file
-            os.utime(docx_path, (os.path.getatime(doc_path), os.path.getmtime(doc_path)))
-           
-        except FileNotFoundError:
-            print("❌ CONVERSION FAILED: 'pandoc' command not found. Ensure Pandoc is installed.")
-            return None
-        except subprocess.CalledProcessError as e:
-            print(f"❌ CONVERSION FAILED: Pandoc error. Output: {e.stderr.decode()}")
-            return None
+    if os.path.exists(docx_path_for(doc_path)):
+        return docx_path_for(doc_path)
+    print(f"Converting '{doc_path}' to docx...")
+    _, used, error = convert_file(doc_path, backend_names, timeout)
+    if error:
+        print(f"❌ CONVERSION FAILED: {doc_path}: {error}")
+        return None
+    return docx_path_for(doc_path)
 
 
-def convert_all_doc_to_docx(folder_path):
+def convert_all_doc_to_docx(folder_path, extensions=LEGACY_EXTENSIONS, backend_names=None, workers=None, timeout=120, cache_folder=CACHE_FOLDER):
+    """
+    Convert every legacy file under @folder_path that has no .docx yet, @workers at a time.
+    Returns {backend name: count}, with failures counted under 'failed'.
+    """
+    todo = []
     for root, dirs, files in os.walk(folder_path):
         for file in files:
-            if file.endswith(".doc"):
-                convert_doc_to_docx(os.path.join(root, file))
+            if os.path.splitext(file)[1].lower() in extensions:
+                src_path = os.path.join(root, file).replace('\\', '/')
+                if not os.path.exists(docx_path_for(src_path)):
+                    todo.append(src_path)
+    counts = {}
+    if not todo:
+        return counts
+    workers = workers or min(len(todo), os.cpu_count() or 1)
+    print(f"Converting {len(todo)} files to docx with {workers} workers...")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(convert_file, src_path, backend_names, timeout, cache_folder) for src_path in todo]
+        for src_path, future in zip(todo, futures):
+            try:
+                _, used, error = future.result()
+            except Exception as e:
+                # e.g. the file vanished before it was hashed, or its worker died: count it, keep going.
+                used, error = None, f"{type(e).__name__}: {e}"
+            if error:
+                print(f"❌ CONVERSION FAILED: {src_path}: {error}")
+                used = 'failed'
+            counts[used] = counts.get(used, 0) + 1
+    return counts
+
+
+W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+TEXT_TAGS = {W + 't': None, W + 'tab': '\t', W + 'br': '\n', W + 'cr': '\n'}
+
+
+def paragraph_text(p):
+    return ''.join((e.text or '') if value is None else value for e in p.iter(*TEXT_TAGS) for value in [TEXT_TAGS[e.tag]])
+
+
+def iter_docx_text(docx_path):
+    """
+    Yield the text of a .docx in document order: one string per paragraph outside tables, and one per
+    table cell (its paragraphs joined with newlines). Streams word/document.xml from the zip with lxml's
+    iterparse instead of building python-docx's object tree, and drops each paragraph once it is read.
+    A text box's paragraphs are part of the paragraph that holds the text box.
+    """
+    from lxml import etree
+    depth = 0           # paragraphs being read; a text box nests paragraphs in a paragraph
+    cells = []          # paragraphs of the table cells being read; tables nest too
+    with zipfile.ZipFile(docx_path) as z, z.open('word/document.xml') as f:
+        for event, e in etree.iterparse(f, events=('start', 'end'), tag=(W + 'p', W + 'tc')):
+            if e.tag == W + 'p':
+                if event == 'start':
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth:
+                    continue
+                text = paragraph_text(e)
+                if cells:
+                    cells[-1].append(text)
+                else:
+                    yield text
+            else:
+                if event == 'start':
+                    cells.append([])
+                    continue
+                text = '\n'.join(p for p in cells.pop() if p)
+                if cells:
+                    cells[-1].append(text)
+                else:
+                    yield text
+            if not depth:
+                # Free what has been read: the element and, at the top level, the siblings before it.
+                e.clear()
+                while e.getprevious() is not None and not cells:
+                    del e.getparent()[0]
 
 
 def docx_to_text(docx_path):
-    document = Document(docx_path)
-    text = '\n\n'.join(p.text for p in document.paragraphs)
-    return text
+    return '\n\n'.join(iter_docx_text(docx_path))
+
+
+
+
+def test_fileconvert():
+    from docx import Document
+    dir = tempfile.mkdtemp()
+    try:
+        cache_folder = os.path.join(dir, 'cache')
+        src = os.path.join('data/test/corpus1', 'Tolkien, J R R - The Hobbit.doc')
+        for n in range(3):
+            os.makedirs(os.path.join(dir, str(n)))
+            shutil.copyfile(src, os.path.join(dir, str(n), 'hobbit.doc'))
+        with open(os.path.join(dir, 'note.rtf'), 'w') as f:
+            f.write(r"{\rtf1\ansi{\fonttbl{\f0 Arial;}}\f0 Caf\'e9 \b menu\b0\par Soup}")
+
+        # The first copy is converted, the others come from the cache.
+        _, used, error = convert_file(os.path.join(dir, '0', 'hobbit.doc'), ['text'], cache_folder=cache_folder)
+        assert used == 'text' and error is None
+        counts = {}
+        for n in [1, 2]:
+            _, used, _ = convert_file(os.path.join(dir, str(n), 'hobbit.doc'), ['text'], cache_folder=cache_folder)
+            counts[used] = counts.get(used, 0) + 1
+        assert counts == {'cache': 2}
+        assert 'In a hole in the ground there lived a hobbit' in docx_to_text(os.path.join(dir, '2', 'hobbit.docx'))
+
+        assert rtf_text(r"{\rtf1\ansi{\fonttbl{\f0 Arial;}}\f0 Caf\'e9 \b menu\b0\par Soup}") == "Café menu\nSoup"
+        with open(os.path.join(dir, 'corrupt.odt'), 'wb') as f:
+            f.write(b'PK\x03\x04 not really a zip')
+        _, used, error = convert_file(os.path.join(dir, 'corrupt.odt'), ['text'], cache_folder=cache_folder)
+        assert used is None and 'BadZipFile' in error and not os.path.exists(os.path.join(dir, 'corrupt.docx'))
+        counts = convert_all_doc_to_docx(dir, backend_names=['text'], workers=2, cache_folder=cache_folder)
+        assert counts == {'text': 1, 'failed': 1}
+        assert docx_to_text(os.path.join(dir, 'note.docx')) == "Café menu\n\nSoup"
+
+        # Tables come out cell by cell, in document order; python-docx's paragraphs skip them.
+        document = Document()
+        document.add_paragraph("Before\tthe table")
+        table = document.add_table(rows=2, cols=2)
+        table.cell(0, 0).text = "Skill"
+        table.cell(0, 1).text = "Years"
+        table.cell(1, 0).text = "Python"
+        table.cell(1, 1).paragraphs[0].add_run("12").add_break()
+        table.cell(1, 1).add_paragraph("since 2012")
+        document.add_paragraph("After")
+        path = os.path.join(dir, 'table.docx')
+        document.save(path)
+        assert list(iter_docx_text(path)) == ["Before\tthe table", "Skill", "Years", "Python", "12\n\nsince 2012", "After"]
+        hobbit = os.path.join(dir, '0', 'hobbit.docx')
+        assert docx_to_text(hobbit) == '\n\n'.join(p.text for p in Document(hobbit).paragraphs)
+    finally:
+        shutil.rmtree(dir)
 
 
 if __name__ == "__main__":
-    doc_file = r"C:\Rob\RAG\Resumes, Work History, Career\2006\2003-04-23.doc"
-    extracted_text = convert_doc_to_docx(doc_file)
-    print(extracted_text)
+    if len(sys.argv) > 1:
+        print(convert_all_doc_to_docx(sys.argv[1]))
+    else:
+        test_fileconvert()
@@ -0,0 +1,168 @@
+import re
+import functools
+from lib.repair import repair_json, RepairError
+
+
+# Templates and fused prompts for jobs.
+#
+# A job's system_prompt is compiled once into literal text and {{NAME}} placeholders, then filled in a
+# single pass per file. Values are never scanned for placeholders, so a document that happens to contain
+# '{{PROMPT}}' is left alone.
+#
+# With 'fuse: true' a job sends the file once with all of its prompts, numbered, and a schema with one key
+# per prompt. The answer is split back into one answer per prompt; prompts whose part is missing or does
+# not match the prompt's schema are asked again on their own.
+
+PLACEHOLDER = re.compile(r'\{\{([A-Z_]+)\}\}')
+
+
+
+
+@functools.lru_cache(maxsize=64)
+def compile_template(template):
+    "Split @template into a tuple of literal strings (even positions) and placeholder names (odd positions)."
+    return tuple(PLACEHOLDER.split(template))
+
+
+def fill(parts, values):
+    "Fill a compiled template. Placeholders without a value are kept as they are."
+    out = []
+    for n, part in enumerate(parts):
+        if n % 2 == 0:
+            out.append(part)
+        else:
+            out.append(values[part] if part in values else '{{' + part + '}}')
+    return ''.join(out)
+
+
+def split_template(template, name='PROMPT'):
+    "Compile the parts of @template before and after the first {{NAME}}; the second part starts with it."
+    marker = '{{' + name + '}}'
+    if marker in template:
+        i = template.index(marker)
+        return compile_template(template[:i]), compile_template(template[i:])
+    return compile_template(''), compile_template(template)
+
+
+
+
+def task_key(i):
+    return f"answer_{i + 1}"
+
+
+def fused_prompt(prompts):
+    "One prompt that asks for the answers to several (index, prompt) pairs in one JSON object."
+    lines = [
+        "Answer each of the numbered tasks below about the GIVEN.",
+        "Return one JSON object with one key per task (" + ', '.join(f'"{task_key(i)}"' for i, _ in prompts) + "). "
+        "The value of each key is that task's answer, in the format the task asks for.",
+        "",
+    ]
+    for i, prompt in prompts:
+        lines.append(f"TASK {task_key(i)}:")
+        lines.append(prompt.strip())
+        lines.append("")
+    return '\n'.join(lines)
+
+
+def fused_schema(schemas):
+    "A schema with one key per (index, schema) pair. Prompts without a schema accept any value."
+    return {
+        'type': 'object',
+        'properties': {task_key(i): schema or {} for i, schema in schemas},
+        'required': [task_key(i) for i, _ in schemas],
+    }
+
+
+TYPES = {
+    'object': dict,
+    'array': list,
+    'string': str,
+    'number': (int, float),
+    'integer': int,
+    'boolean': bool,
+    'null': type(None),
+}
+
+
+def check_schema(value, schema, path='$'):
+    "The ways @value does not match @schema (types, required keys, properties and items). Empty if it matches."
+    if not schema:
+        return []
+    problems = []
+    t = schema.get('type')
+    if t:
+        types = t if isinstance(t, list) else [t]
+        ok = any(isinstance(value, TYPES[x]) and not (x in ['number', 'integer'] and isinstance(value, bool)) for x in types if x in TYPES)
+        if not ok:
+            return [f"{path}: expected {t}, got {type(value).__name__}"]
+    if isinstance(value, dict):
+        for key in schema.get('required') or []:
+            if key not in value:
+                problems.append(f"{path}: missing '{key}'")
+        for key, sub in (schema.get('properties') or {}).items():
+            if key in value:
+                problems.extend(check_schema(value[key], sub, f"{path}.{key}"))
+    if isinstance(value, list) and schema.get('items'):
+        for n, item in enumerate(value):
+            problems.extend(check_schema(item, schema['items'], f"{path}[{n}]"))
+    return problems
+
+
+def split_answer(answer, schemas):
+    """
+    Split a fused answer into {index: answer} for the (index, schema) pairs in @schemas.
+    Returns (answers, failed) where failed lists the indexes whose part is missing or invalid.
+    """
+    if isinstance(answer, str):
+        try:
+            answer, changes = repair_json(answer)
+        except RepairError:
+            answer = None
+    if not isinstance(answer, dict):
+        return {}, [i for i, _ in schemas]
+    answers = {}
+    failed = []
+    for i, schema in schemas:
+        key = task_key(i)
+        if key not in answer or answer[key] is None or check_schema(answer[key], schema):
+            failed.append(i)
+        else:
+            answers[i] = answer[key]
+    return answers, failed
+
+
+
+
+def test_template():
+    prefix, suffix = split_template("FILE: {{FILEPATH}}\nGIVEN: {{GIVEN}}\nPROMPT:\n{{PROMPT}}\n")
+    values = {'FILEPATH': 'a.txt', 'GIVEN': 'says {{PROMPT}} literally', 'PROMPT': 'Summarize.'}
+    assert fill(prefix, values) == "FILE: a.txt\nGIVEN: says {{PROMPT}} literally\nPROMPT:\n"
+    assert fill(suffix, values) == "Summarize.\n"
+    assert fill(compile_template("{{OTHER}} stays"), values) == "{{OTHER}} stays"
+    assert split_template("no marker")[0] == ('',)
+
+
+def test_fuse():
+    skills = {'type': 'object', 'properties': {'skills': {'type': 'array', 'items': {'type': 'string'}}}, 'required': ['skills']}
+    schemas = [(0, skills), (2, None)]
+    prompt = fused_prompt([(0, 'List the skills.'), (2, 'Summarize.')])
+    assert 'TASK answer_1:' in prompt and 'TASK answer_3:' in prompt
+    assert fused_schema(schemas)['required'] == ['answer_1', 'answer_3']
+
+    answers, failed = split_answer({'answer_1': {'skills': ['AWS']}, 'answer_3': 'A developer.'}, schemas)
+    assert answers == {0: {'skills': ['AWS']}, 2: 'A developer.'} and failed == []
+
+    # A part that does not match its schema is asked again on its own.
+    answers, failed = split_answer('{"answer_1": {"skills": "AWS"}, "answer_3": {"text": "ok"}}', schemas)
+    assert answers == {2: {'text': 'ok'}} and failed == [0]
+
+    answers, failed = split_answer('I cannot do that.', schemas)
+    assert answers == {} and failed == [0, 2]
+
+    assert check_schema(True, {'type': 'integer'}) == ["$: expected integer, got bool"]
+
+
+if __name__ == "__main__":
+    test_template()
+    test_fuse()
@@ -0,0 +1,160 @@
+import os
+import json
+import time
+from lib.tools import DateTimeEncoder
+
+
+
+
+class Journal:
+    """
+    Append-only JSON Lines file for results that arrive one at a time.
+
+    Appending a record costs one line, not a rewrite of everything so far. Lines are flushed to the OS
+    on every append and fsync'd in batches (every @sync_every records or @sync_seconds seconds), so a
+    crash loses at most the last unsynced batch and can never corrupt earlier records. A line torn by a
+    crash is cut off the next time the journal is opened.
+
+    with Journal('summarized.yaml.journal.jsonl') as journal:
+        for record in journal.read():
+            ...
+        journal.append({'filepath': 'a.docx', 'answer': {...}})
+    """
+
+    def __init__(self, path, sync_every=20, sync_seconds=5.0):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_seconds = sync_seconds
+        self.f = None
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def open(self):
+        if self.f:
+            return self
+        dir = os.path.dirname(self.path)
+        if dir:
+            os.makedirs(dir, exist_ok=True)
+        self.repair_tail()
+        self.f = open(self.path, 'a', encoding='utf-8')
+        return self
+
+    def repair_tail(self):
+        "Cut off a last line that was only partly written when the process died."
+        if not self.exists():
+            return
+        with open(self.path, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b'\n':
+                return
+            # Walk back to the previous newline.
+            pos = size
+            while pos > 0:
+                step = min(4096, pos)
+                pos -= step
+                f.seek(pos)
+                chunk = f.read(step)
+                i = chunk.rfind(b'\n')
+                if i >= 0:
+                    f.truncate(pos + i + 1)
+                    return
+            f.truncate(0)
+
+    def append(self, record):
+        if not self.f:
+            self.open()
+        self.f.write(json.dumps(record, cls=DateTimeEncoder, ensure_ascii=False) + '\n')
+        self.f.flush()
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_seconds:
+            self.sync()
+
+    def sync(self):
+        if self.f and self.unsynced:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        if self.f:
+            self.sync()
+            self.f.close()
+            self.f = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read(self):
+        "Stream the records in the journal, one at a time. A torn last line is skipped."
+        if self.f:
+            self.f.flush()
+        if not self.exists():
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"  Skipping unreadable journal line in {self.path}")
+
+
+
+
+def replace_file(path, write):
+    """
+    Write a file atomically: @write(tmp_path) writes the content to a temporary file,
+    which then replaces @path in one step, so readers never see a half-written file.
+    """
+    tmp = f"{path}.tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    write(tmp)
+    os.replace(tmp, path)
+
+
+
+
+def test_journal():
+    from lib.tools import getNewTemporaryFilePath
+    path = getNewTemporaryFilePath('journal', '.jsonl')
+    with Journal(path, sync_every=2) as journal:
+        for i in range(5):
+            journal.append({'i': i})
+        assert [r['i'] for r in journal.read()] == [0, 1, 2, 3, 4]
+
+    # A crash in the middle of a write leaves a torn line, which is dropped on the next open.
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('{"i": 5, "trunc')
+    assert [r['i'] for r in Journal(path).read()] == [0, 1, 2, 3, 4]
+    with Journal(path) as journal:
+        journal.append({'i': 6})
+    assert [r['i'] for r in Journal(path).read()] == [0, 1, 2, 3, 4, 6]
+    os.remove(path)
+
+    # yaml.safe_load turns dates in YAML answers into datetime.date.
+    from lib.repair import repair_yaml
+    answer, changes = repair_yaml('name: Rob\nstart: 2019-01-15\nupdated: 2020-02-01 10:30:00\n')
+    with Journal(path) as journal:
+        journal.append({'filepath': 'a.docx', 'answer': answer})
+    assert next(Journal(path).read())['answer'] == {'name': 'Rob', 'start': '2019-01-15', 'updated': '2020-02-01T10:30:00'}
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    test_journal()
@@ -0,0 +1,115 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from lib.tools import from_metric
+from lib.planner import CHARS_PER_TOKEN
+from lib.splitter import RecursiveCharacterText_Splitter
+
+
+# Map-reduce for documents that do not fit the model's context window.
+#
+# The document is split into pieces that fit, the prompt is asked of every piece (map), and a reduce prompt
+# merges the partial answers into one (reduce). When the partial answers are themselves too long for one
+# call, they are merged in batches and the merged answers merged again.
+#
+# Sizes are in characters, converted from the stack's 'context-window' (tokens) with CHARS_PER_TOKEN and a
+# safety margin, since a tokenizer is not always available.
+
+REDUCE_PROMPT = """The document {{FILEPATH}} was too long to read at once, so it was split into parts and the
+task below was answered for each part separately.
+
+TASK:
+{{PROMPT}}
+
+PARTIAL ANSWERS:
+{{ANSWERS}}
+
+Merge the partial answers into one answer to the TASK, in the format the TASK asks for.
+Combine duplicates and keep every distinct fact. Answer as if you had read the whole document.
+"""
+
+
+
+
+def input_limit(context_window, completion_tokens=1024, template_chars=0, safety=0.8):
+    "How many characters of document fit in one call, next to the template and the answer."
+    tokens = from_metric(context_window) - from_metric(completion_tokens)
+    chars = int(tokens * CHARS_PER_TOKEN * safety) - template_chars
+    if chars <= 0:
+        raise ValueError(f"A context window of {context_window} leaves no room for the document")
+    return chars
+
+
+def split_text(text, limit):
+    "Split @text into pieces of at most @limit characters, with a little overlap so facts are not cut in half."
+    splitter = RecursiveCharacterText_Splitter(chunk_size=limit, chunk_overlap=min(limit // 20, 1000))
+    return splitter.get_chunks(text)
+
+
+def format_partial(answer):
+    return answer if isinstance(answer, str) else json.dumps(answer, ensure_ascii=False)
+
+
+def batches(texts, limit):
+    """
+    Group @texts into runs whose combined length stays under @limit. Every batch has at least two texts,
+    even if they are longer than @limit together, so each round of reduces makes progress.
+    """
+    out = [[]]
+    size = 0
+    for text in texts:
+        if len(out[-1]) >= 2 and size + len(text) > limit:
+            out.append([])
+            size = 0
+        out[-1].append(text)
+        size += len(text)
+    # A text on its own cannot be merged with anything, so it joins the batch before it.
+    if len(out) > 1 and len(out[-1]) == 1:
+        out[-2].extend(out.pop())
+    return out
+
+
+def map_reduce(pieces, ask_map, ask_reduce, limit, parallel=4):
+    """
+    Answer a prompt over a document that was split into @pieces.
+    @ask_map(n, piece) answers the prompt for one piece; @ask_reduce(partials) merges a list of partial answers
+    (as text) into one. Map calls run @parallel at a time. Reduce calls merge at most @limit characters at once.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, parallel), thread_name_prefix='map') as pool:
+        partials = list(pool.map(ask_map, range(len(pieces)), pieces))
+        while len(partials) > 1:
+            groups = batches([format_partial(p) for p in partials], limit)
+            partials = list(pool.map(ask_reduce, groups))
+    return partials[0]
+
+
+
+
+def test_mapreduce():
+    assert input_limit('8K', 1024, template_chars=200) == int((8192 - 1024) * CHARS_PER_TOKEN * 0.8) - 200
+
+    text = '\n\n'.join(f"Paragraph {n}. " + 'word ' * 40 for n in range(50))
+    pieces = split_text(text, 1000)
+    assert len(pieces) > 5 and all(len(p) <= 1000 for p in pieces)
+    assert 'Paragraph 49.' in pieces[-1]
+
+    assert batches(['a' * 4, 'b' * 4, 'c' * 4], 9) == [['aaaa', 'bbbb', 'cccc']]
+    assert batches(['a' * 4, 'b' * 4, 'c' * 4, 'd' * 4], 9) == [['aaaa', 'bbbb'], ['cccc', 'dddd']]
+    assert batches(['a' * 20, 'b' * 20, 'c' * 20], 9) == [['a' * 20, 'b' * 20, 'c' * 20]]
+
+    # Each map finds the paragraph numbers in its piece; reduces merge the sorted sets.
+    def ask_map(n, piece):
+        return {'paragraphs': sorted({int(w.split()[1].rstrip('.')) for w in piece.split('\n\n') if w.startswith('Paragraph')})}
+
+    reduces = []
+
+    def ask_reduce(partials):
+        reduces.append(len(partials))
+        return {'paragraphs': sorted({n for p in partials for n in json.loads(p)['paragraphs']})}
+
+    answer = map_reduce(pieces, ask_map, ask_reduce, limit=100, parallel=3)
+    assert answer == {'paragraphs': list(range(50))}
+    assert len(reduces) > 1
+
+
+if __name__ == "__main__":
+    test_mapreduce()
@@ -0,0 +1,249 @@
+import os
+import json
+import time
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
+from lib.tools import DateTimeEncoder
+
+
+# Memoization in two tiers: a small LRU in the process, over the SQLite cache on disk (lib/cache.py).
+#
+#   @memoize('text', key=file_key, maxsize=64)
+#   def get_text(filepath): ...
+#
+# The key is derived from the arguments (or from @key(*args, **kwargs) when given) and hashed. Empty
+# results (None, '', [], {}) are cached too, for @negative_ttl seconds, so a document without text is not
+# extracted again on every run. When several threads miss the same key at once, one computes it and the
+# others wait for its result. Exceptions are never cached.
+#
+# That wait only covers threads of one process. Processes (the CPU tier of a JobExecutor, or two jobs run at
+# once) share the disk tier but not the locks, so each of them may compute a missing key once; the last one to
+# finish writes the entry. That costs time, not correctness, since both computed the same value.
+#
+# Values must be JSON serializable to reach the disk tier; use disk=False for anything else.
+
+MISSING = object()
+
+
+
+
+def make_key(value):
+    "A stable hash of @value. Objects without a JSON form are keyed by repr()."
+    data = json.dumps(value, cls=DateTimeEncoder, default=repr, sort_keys=True, ensure_ascii=False)
+    return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+
+def file_key(filepath, *args, **kwargs):
+    "Key a function of a file on its path, size and modification time, so an edited file is read again."
+    st = os.stat(filepath)
+    return [os.path.abspath(filepath), st.st_size, st.st_mtime_ns, args, kwargs]
+
+
+def is_empty(value):
+    return value is None or (hasattr(value, '__len__') and len(value) == 0)
+
+
+
+
+class LRU:
+    "A thread-safe in-process LRU with per-entry expiry."
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return MISSING
+            value, expires = entry
+            if expires is not None and expires <= time.time():
+                del self.entries[key]
+                return MISSING
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, ttl=None):
+        with self.lock:
+            self.entries[key] = (value, time.time() + ttl if ttl else None)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+
+
+class KeyLocks:
+    "One lock per key while anyone holds it, so only one caller computes a missing value."
+
+    def __init__(self):
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, key):
+        with self.lock:
+            entry = self.locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+
+    def release(self, key):
+        with self.lock:
+            entry = self.locks[key]
+            entry[0].release()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+
+
+
+
+class Memo:
+    def __init__(self, func, namespace, key=None, maxsize=256, ttl=None, negative_ttl=None, disk=True, cache=None, verbose=False):
+        self.func = func
+        self.namespace = namespace
+        self.key = key
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl if negative_ttl is not None else ttl
+        self.disk = disk
+        self.cache = cache
+        self.verbose = verbose
+        self.memory = LRU(maxsize)
+        self.locks = KeyLocks()
+        self.hits = {'memory': 0, 'disk': 0}
+        self.misses = 0
+        functools.update_wrapper(self, func)
+
+    def __get__(self, obj, objtype=None):
+        "Decorating a method memoizes it for all instances; the key function sees self like any other argument."
+        return self if obj is None else functools.partial(self, obj)
+
+    def disk_cache(self):
+        if not self.disk:
+            return None
+        if self.cache is None:
+            from lib.cache import default_cache
+            return default_cache()
+        return self.cache
+
+    def lookup(self, k):
+        value = self.memory.get(k)
+        if value is not MISSING:
+            self.hits['memory'] += 1
+            return value
+        cache = self.disk_cache()
+        if cache is not None:
+            # Stored as {'value': ...} so a cached None is not mistaken for a miss.
+            entry = cache.get(k, namespace=self.namespace)
+            if entry is not None:
+                self.hits['disk'] += 1
+                value = entry['value']
+                self.memory.put(k, value, self.negative_ttl if is_empty(value) else self.ttl)
+                return value
+        return MISSING
+
+    def __call__(self, *args, **kwargs):
+        k = make_key(self.key(*args, **kwargs) if self.key else [args, kwargs])
+        value = self.lookup(k)
+        if value is not MISSING:
+            return value
+        self.locks.acquire(k)
+        try:
+            # Someone else may have computed it while we waited for the lock.
+            value = self.lookup(k)
+            if value is not MISSING:
+                return value
+            self.misses += 1
+            if self.verbose:
+                print(f"  Cache miss: {self.namespace} {k}")
+            value = self.func(*args, **kwargs)
+            ttl = self.negative_ttl if is_empty(value) else self.ttl
+            self.memory.put(k, value, ttl)
+            cache = self.disk_cache()
+            if cache is not None:
+                cache.put(k, {'value': value}, namespace=self.namespace, ttl=ttl)
+            return value
+        finally:
+            self.locks.release(k)
+
+    def cache_clear(self):
+        "Forget everything this function cached, in memory and on disk."
+        self.memory.clear()
+        cache = self.disk_cache()
+        if cache is not None:
+            cache.clear(self.namespace)
+
+
+
+
+def memoize(namespace, key=None, maxsize=256, ttl=None, negative_ttl=None, disk=True, cache=None, verbose=False):
+    """
+    Decorator. @namespace separates this function's entries in the disk cache; @key(*args, **kwargs) returns
+    what identifies a call (default: all the arguments). @ttl and @negative_ttl are in seconds (None: forever).
+    """
+    def decorator(func):
+        return Memo(func, namespace, key=key, maxsize=maxsize, ttl=ttl, negative_ttl=negative_ttl, disk=disk, cache=cache, verbose=verbose)
+    return decorator
+
+
+
+
+def test_memo():
+    import shutil
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from lib.cache import Cache
+    dir = tempfile.mkdtemp()
+    try:
+        cache = Cache(os.path.join(dir, 'cache.sqlite'))
+        calls = []
+
+        @memoize('square', cache=cache)
+        def square(x):
+            calls.append(x)
+            time.sleep(0.05)
+            return x * x if x else None
+
+        # Ten threads missing the same key compute it once.
+        with ThreadPoolExecutor(max_workers=10) as pool:
+            assert list(pool.map(square, [3] * 10)) == [9] * 10
+        assert calls == [3]
+
+        # Empty results are cached too.
+        assert square(0) is None and square(0) is None
+        assert calls == [3, 0]
+
+        # A new process (here: a fresh memory tier) finds the values on disk.
+        square.memory.clear()
+        assert square(3) == 9 and square.hits['disk'] == 1
+        assert calls == [3, 0]
+
+        class Scorer:
+            def __init__(self, model):
+                self.model = model
+
+            @memoize('score', key=lambda self, text: [self.model, text], cache=cache, ttl=-1)
+            def score(self, text):
+                calls.append(text)
+                return len(text)
+
+        assert Scorer('a').score('abc') == 3 and Scorer('a').score('abc') == 3
+        assert calls[-2:] == ['abc', 'abc']     # expired at once
+
+        path = os.path.join(dir, 'a.txt')
+        with open(path, 'w') as f:
+            f.write('one')
+        assert file_key(path)[1] == 3
+    finally:
+        shutil.rmtree(dir)
+
+
+if __name__ == "__main__":
+    test_memo()
@@ -1,9 +1,14 @@
 import time
-import boto3
-import requests
+import math
+import threading
 import json
-import yaml
 from lib.tools import *
+from lib.memo import memoize
+from lib.retry import RetryPolicy, RetryableError, ThrottledError, format_report
+from lib.tracing import span
+
+# Seconds a hedged request may run when the stack sets no timeout or deadline.
+HEDGE_TIMEOUT = 300
 
 
 
@@ -11,6 +16,47 @@ from lib.tools import *
 class ModelStack:
     def __init__(self, config):
         self.config = config
+        self.retry = RetryPolicy.from_config(config.get('retry'))
+        self.local = threading.local()
+        self.memoize(config.get('memoize'))
+
+    def memoize(self, options):
+        """
+        With 'memoize: true' (or {ttl: seconds, maxsize: n}) in the stack's config, the same prompt to the same
+        model is answered from the cache (lib/memo.py). Off by default: a sampled answer is not the only answer.
+        A cached answer reports {'cached': True} in @usage with zero tokens, since no tokens were spent on it,
+        and the tokens it took the first time as 'cached_prompt_tokens' and 'cached_completion_tokens'.
+        """
+        if not options:
+            return
+        options = options if isinstance(options, dict) else {}
+        # Only the settings that change the answer; the same model on another host gives the same answer.
+        config = {k: self.config.get(k) for k in ['class', 'model', 'max_tokens', 'temperature', 'top_p']}
+        query = self.query
+
+        def key(prompt, max_tokens=1024, prefix=None, schema=None, fresh=None):
+            # 'usage': entries hold the answer together with the tokens it took.
+            return ['usage', config, prompt, max_tokens, prefix, schema]
+
+        @memoize('llm', key=key, maxsize=options.get('maxsize', 256), ttl=options.get('ttl'))
+        def answer(prompt, max_tokens=1024, prefix=None, schema=None, fresh=None):
+            used = {}
+            result = query(prompt, max_tokens=max_tokens, prefix=prefix, schema=schema, usage=used)
+            fresh.append(True)
+            return {'answer': result, 'usage': used}
+
+        def memoized(prompt, max_tokens=1024, prefix=None, schema=None, usage=None):
+            fresh = []
+            entry = answer(prompt, max_tokens=max_tokens, prefix=prefix, schema=schema, fresh=fresh)
+            if usage is not None:
+                if fresh:
+                    usage.update(entry['usage'])
+                else:
+                    usage.update({'prompt_tokens': 0, 'completion_tokens': 0, 'cached': True},
+                                 **{f"cached_{k}": v for k, v in entry['usage'].items()})
+            return entry['answer']
+        memoized.memo = answer
+        self.query = memoized
         
     def num_tokens(self):
         return from_metric(self.config.get('context-window', '1024'))
@@ -20,13 +66,71 @@ class ModelStack:
         cls = model_config.get('class')
         if cls == 'ollama':
             return OllamaModelStack(model_config)
+        if cls == 'ollama-multi':
+            return MultiHostOllamaModelStack(model_config)
         if cls == 'bedrock':
             return BedrockModelStack(model_config)
+        if cls == 'stub':
+            return StubModelStack(model_config)
         raise ValueError(f"Unsupported model stack class: {cls}")
     
-    def query(self, prompt):
+    def name(self):
+        return self.config.get('model', self.__class__.__name__)
+
+    def query(self, prompt, max_tokens=1024, prefix=None, schema=None, usage=None):
+        """
+        Send @prompt to the model and return the answer text.
+        @prefix is optional text that goes before the prompt. Callers that send many prompts with the same
+        prefix (e.g. the same document with different questions) should pass it separately so stacks that
+        support sessions can keep it cached on the server.
+        @schema is an optional JSON schema. The model is constrained to answer in that shape and the parsed
+        object is returned instead of text.
+        Transient failures are retried according to the stack's 'retry' config (see lib/retry.py).
+        @usage is an optional dict that receives the 'prompt_tokens' and 'completion_tokens' the backend reported.
+        """
+        def attempt():
+            # query_once reports tokens on its own thread, which is a worker thread when the call is hedged.
+            self.local.usage = {}
+            answer = self.query_once(prompt, max_tokens=max_tokens, prefix=prefix, schema=schema)
+            return answer, self.local.usage
+        with span('llm.query', stack=self.config.get('class'), model=self.name(), max_tokens=max_tokens,
+                  prompt_chars=len(prompt) + len(prefix or ''), schema=schema is not None) as s:
+            answer, used = self.retry.call(attempt)
+            s.set(**used)
+        for k, v in used.items():
+            self.retry.stats.count(k, v)
+        if usage is not None:
+            usage.update(used)
+        return answer
+
+    def request_timeout(self, default=None):
+        """
+        Timeout for one request: the 'timeout' config (or @default), cut to what is left of the call's deadline.
+        A hedged request is abandoned, not cancelled, so with hedging it is never unbounded: HEDGE_TIMEOUT at most.
+        """
+        timeout = self.config.get('timeout', default)
+        if timeout is None and self.retry.hedge_percentile:
+            timeout = HEDGE_TIMEOUT
+        left = self.retry.time_left()
+        if left is None:
+            return timeout
+        return left if timeout is None else min(float(timeout), left)
+
+    def query_once(self, prompt, max_tokens=1024, prefix=None, schema=None):
+        "A single attempt at query(). Raise RetryableError or ThrottledError for failures worth retrying."
         raise NotImplementedError("Subclasses must implement this method.")
 
+    def note_usage(self, prompt_tokens, completion_tokens):
+        "Called by query_once with the token counts in the backend's response."
+        self.local.usage = {'prompt_tokens': int(prompt_tokens or 0), 'completion_tokens': int(completion_tokens or 0)}
+
+    def report(self):
+        "Latency percentiles and failure counts for the calls made through this stack."
+        return self.retry.stats.report()
+
+    def print_report(self):
+        print(format_report(self.name(), self.report()))
+
     def query_yes_no(self, prompt):
         # Note: When debugging, this method may timeout in the debugger's expression evaluator
         # due to network calls to LLM APIs. Set PYDEVD_WARN_EVALUATION_TIMEOUT=10 or higher
@@ -43,42 +147,289 @@ class ModelStack:
 
 
 
+def parse_structured(answer):
+    "Parse a schema-constrained answer. A truncated answer is worth asking for again."
+    try:
+        return json.loads(answer)
+    except json.JSONDecodeError as e:
+        raise RetryableError(f"Structured answer is not valid JSON: {e}") from e
+
+
+def check_status(r):
+    "Raise for a non-200 Ollama response, telling throttling and server errors apart from bad requests."
+    if r.status_code == 200:
+        return
+    message = f"Request failed with status code {r.status_code}: {r.text}"
+    if r.status_code in [429, 503]:
+        raise ThrottledError(message)
+    if r.status_code >= 500:
+        raise RetryableError(message)
+    raise Exception(message)
+
+
+
 class OllamaModelStack(ModelStack):
     def __init__(self, config):
         super().__init__(config)
         
-    def query(self, prompt, max_tokens=1024):
+    def post(self, path, payload):
+        # requests and boto3 are imported on first use, so scripts that only need one backend do not
+        # wait for the other to load.
+        import requests
         OLLAMA_HOST = self.config['host']
+        try:
+            r = requests.post(f'{OLLAMA_HOST}{path}', json=payload, timeout=self.request_timeout())
+        except requests.RequestException as e:
+            raise RetryableError(f"Request to {OLLAMA_HOST} failed: {e}") from e
+        check_status(r)
+        return json.loads(r.text)
+
+    def query_once(self, prompt, max_tokens=1024, prefix=None, schema=None):
+        """
+        With 'session: true' in the config, a @prefix is sent as a stable system message to /api/chat,
+        together with 'keep_alive', so Ollama can reuse the KV cache for the prefix across prompts.
+        Otherwise the prefix is simply prepended to the prompt.
+        A @schema is sent as Ollama's 'format' so generation is constrained to valid JSON of that shape.
+        """
         model = self.config['model']
         max_tokens = from_metric(self.config.get('max_tokens', max_tokens))
-        url = f'{OLLAMA_HOST}/api/generate'
+        session = prefix and self.config.get('session', False)
         payload = {
             'model': model, 
-            'prompt': prompt, 
             'stream': False, 
             'max_tokens': max_tokens
         }
+        if session:
+            payload['messages'] = [
+                {'role': 'system', 'content': prefix},
+                {'role': 'user', 'content': prompt}
+            ]
+            payload['keep_alive'] = self.config.get('keep_alive', '10m')
+        else:
+            payload['prompt'] = (prefix or '') + prompt
+            if 'keep_alive' in self.config:
+                payload['keep_alive'] = self.config['keep_alive']
         if 'temperature' in self.config:
             payload['temperature'] = self.config['temperature']
         if 'top_p' in self.config:
             payload['top_p'] = self.config['top_p']
-        r = requests.post(url, json=payload)
-        if r.status_code != 200:
-            raise Exception(f"Request failed with status code {r.status_code}: {r.text}")
-        answer = json.loads(r.text)['response']
+        if schema:
+            payload['format'] = schema
+        if session:
+            response = self.post('/api/chat', payload)
+            answer = response['message']['content']
+        else:
+            response = self.post('/api/generate', payload)
+            answer = response['response']
+        self.note_usage(response.get('prompt_eval_count'), response.get('eval_count'))
+        if schema:
+            return parse_structured(answer)
         return answer
 
 
 
 
 
+class OllamaHost:
+    """Bookkeeping for one Ollama server in a MultiHostOllamaModelStack."""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.outstanding = 0
+        self.ejected_until = 0
+        self.loaded_models = set()
+        self.failures = 0
+
+    def is_healthy(self, now=None):
+        return (now or time.time()) >= self.ejected_until
+
+    def eject(self, seconds):
+        self.failures += 1
+        self.ejected_until = time.time() + seconds
+
+    def restore(self):
+        self.ejected_until = 0
+
+
+
+class MultiHostOllamaModelStack(OllamaModelStack):
+    """
+    Spread requests over several Ollama servers.
+
+    Config:
+        class: ollama-multi
+        hosts: [http://box1:11434, http://box2:11434]
+        model: granite3.2:2b
+        routing: least-outstanding     # or 'loaded-model' to prefer hosts that already have the model in memory
+                                       # session prompts always stick to the host that has their prefix cached
+        health_interval: 15            # seconds between background health checks; 0 disables the checker
+        eject_seconds: 60              # how long a failing host is left out of the rotation
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        hosts = config.get('hosts') or []
+        if isinstance(hosts, str):
+            hosts = [h.strip() for h in hosts.split(',') if h.strip()]
+        if not hosts:
+            raise ValueError("ollama-multi model stack needs at least one entry in 'hosts'")
+        self.hosts = [OllamaHost(h) for h in hosts]
+        self.routing = config.get('routing', 'least-outstanding')
+        if self.routing not in ['least-outstanding', 'loaded-model']:
+            raise ValueError(f"Unsupported routing: {self.routing}")
+        self.eject_seconds = float(config.get('eject_seconds', 60))
+        self.health_interval = float(config.get('health_interval', 15))
+        self.lock = threading.Lock()
+        self.next_index = 0
+        self.affinity = {}   # md5 of a session prefix -> url of the host that last served it
+        self.stopped = threading.Event()
+        self.health_thread = None
+        if self.health_interval > 0:
+            self.health_thread = threading.Thread(target=self.health_loop, daemon=True)
+            self.health_thread.start()
+
+    def close(self):
+        self.stopped.set()
+        if self.health_thread:
+            self.health_thread.join(timeout=5)
+
+    def check_host(self, host):
+        """Ask a host which models it has loaded. A host that does not answer is ejected."""
+        import requests
+        try:
+            r = requests.get(f'{host.url}/api/ps', timeout=self.config.get('health_timeout', 5))
+            if r.status_code != 200:
+                raise Exception(f"Health check failed with status code {r.status_code}")
+            models = json.loads(r.text).get('models') or []
+        except Exception:
+            with self.lock:
+                host.eject(self.eject_seconds)
+            return False
+        with self.lock:
+            host.loaded_models = set(m.get('name') or m.get('model') for m in models)
+            host.restore()
+        return True
+
+    def check_hosts(self):
+        for host in self.hosts:
+            self.check_host(host)
+
+    def health_loop(self):
+        while not self.stopped.is_set():
+            self.check_hosts()
+            self.stopped.wait(self.health_interval)
+
+    def pick_host(self, exclude=(), prefer=None):
+        """Choose the host for the next request, or None if every host has been tried."""
+        with self.lock:
+            now = time.time()
+            candidates = [h for h in self.hosts if h.url not in exclude]
+            if not candidates:
+                return None
+            healthy = [h for h in candidates if h.is_healthy(now)]
+            # When everything is ejected, keep trying rather than failing outright.
+            candidates = healthy or candidates
+            for h in candidates:
+                if h.url == prefer:
+                    h.outstanding += 1
+                    return h
+            if self.routing == 'loaded-model':
+                model = self.config.get('model')
+                warm = [h for h in candidates if model in h.loaded_models]
+                candidates = warm or candidates
+            # Rotate the starting point so ties are spread round-robin.
+            n = len(candidates)
+            start = self.next_index % n
+            self.next_index += 1
+            rotated = candidates[start:] + candidates[:start]
+            host = min(rotated, key=lambda h: h.outstanding)
+            host.outstanding += 1
+            return host
+
+    def release_host(self, host, failed=False):
+        with self.lock:
+            host.outstanding -= 1
+            if failed:
+                host.eject(self.eject_seconds)
+
+    def post(self, path, payload):
+        import requests
+        tried = set()
+        error = None
+        key = None
+        if payload.get('messages'):
+            key = md5(payload['messages'][0]['content'])
+        while True:
+            host = self.pick_host(exclude=tried, prefer=self.affinity.get(key))
+            if host is None:
+                raise RetryableError(f"All Ollama hosts failed. Last error: {error}")
+            tried.add(host.url)
+            try:
+                r = requests.post(f'{host.url}{path}', json=payload, timeout=self.request_timeout())
+            except requests.RequestException as e:
+                self.release_host(host, failed=True)
+                error = e
+                continue
+            if r.status_code >= 500:
+                self.release_host(host, failed=True)
+                error = Exception(f"{host.url} failed with status code {r.status_code}: {r.text}")
+                continue
+            self.release_host(host)
+            check_status(r)
+            with self.lock:
+                if self.routing == 'loaded-model':
+                    host.loaded_models.add(payload.get('model'))
+                if key:
+                    if len(self.affinity) > 10000:
+                        self.affinity.clear()
+                    self.affinity[key] = host.url
+            return json.loads(r.text)
+
+
+
+
+
 class BedrockModelStack(ModelStack):
     def __init__(self, config):
         super().__init__(config)
+        self.client = None
+        self.short_clients = {}
+        self.lock = threading.Lock()
+
+    def new_client(self, read_timeout):
+        import boto3
+        from botocore.config import Config
+        region = self.config.get('region', 'us-west-1')
+        # Retries are handled by self.retry, so botocore should make a single attempt.
+        return boto3.client('bedrock-runtime', region_name=region, config=Config(
+            retries={'total_max_attempts': 1},
+            read_timeout=read_timeout
+        ))
+
+    def get_client(self, timeout=None):
+        """
+        The client, or with a @timeout shorter than the configured one (the call's deadline is near), a client
+        with that read timeout, rounded up to whole seconds. botocore has no timeout per request.
+        """
+        configured = self.config.get('timeout', 60)
+        with self.lock:
+            if not self.client:
+                self.client = self.new_client(configured)
+                self.short_clients[configured] = self.client
+            # A client set from outside (a fake in tests) is always used as it is.
+            if timeout is None or timeout >= configured or self.short_clients.get(configured) is not self.client:
+                return self.client
+            seconds = max(1, math.ceil(timeout))
+            if seconds not in self.short_clients:
+                self.short_clients[seconds] = self.new_client(seconds)
+            return self.short_clients[seconds]
         
-    def query(self, prompt, max_tokens=1024):
+    def query_once(self, prompt, max_tokens=1024, prefix=None, schema=None):
+        """
+        A @schema is enforced by offering the model a single 'answer' tool with that schema as its input
+        and forcing it to call the tool. The tool input is returned as the parsed answer.
+        """
         model = self.config['model']
-        region = self.config.get('region', 'us-west-1')
         max_tokens = from_metric(self.config.get('max_tokens', max_tokens))
         temperature = self.config.get('temperature', 0.7)
         top_p = self.config.get('top_p', 1)
@@ -91,6 +442,23 @@ class BedrockModelStack(ModelStack):
             ]
         }    
         
+        # A shared prefix goes in the system prompt. With 'session: true' it is marked for prompt caching.
+        if prefix:
+            system = {"type": "text", "text": prefix}
+            if self.config.get('session', False):
+                system["cache_control"] = {"type": "ephemeral"}
+            params['system'] = [system]
+
+        # Tool inputs must be objects, so other schemas are wrapped in one.
+        wrapped = schema and schema.get('type') != 'object'
+        if schema:
+            params['tools'] = [{
+                "name": "answer",
+                "description": "Record the answer in the requested structure.",
+                "input_schema": {"type": "object", "properties": {"answer": schema}, "required": ["answer"]} if wrapped else schema
+            }]
+            params['tool_choice'] = {"type": "tool", "name": "answer"}
+
         # Can only be one of these.
         if temperature:
             params['temperature'] = temperature
@@ -99,27 +467,26 @@ class BedrockModelStack(ModelStack):
             
         body = json.dumps(params)
     
-        client = boto3.client('bedrock-runtime', region_name=region)
-        for i in range(3):
-            try:
-                response = client.invoke_model(
-                    modelId=model,
-                    body=body,
-                    contentType='application/json',
-                    accept='application/json'
-                )
-                break
-            except Exception as e:
-                print(f"Error invoking model: {e}")
-                if isinstance(e, TimeoutError) or "timed out" in str(e).lower():
-                    print("Request timed out. Consider increasing timeout or retrying.")
-            if i > 0:
-                time.sleep(1)
-            
+        response = self.get_client(self.request_timeout(60)).invoke_model(
+            modelId=model,
+            body=body,
+            contentType='application/json',
+            accept='application/json'
+        )
             
         # Parse the response body
         response_body = json.loads(response['body'].read())
+        usage = response_body.get('usage') or {}
+        # Cached prefix tokens are reported separately from the rest of the prompt.
+        prompt_tokens = sum(usage.get(k) or 0 for k in ['input_tokens', 'cache_read_input_tokens', 'cache_creation_input_tokens'])
+        self.note_usage(prompt_tokens, usage.get('output_tokens'))
     
+        if schema:
+            for item in response_body.get('content') or []:
+                if item.get('type') == 'tool_use':
+                    return item['input']['answer'] if wrapped else item['input']
+            raise RetryableError("The model did not return a structured answer.")
+
         # Extract generated text (adjust based on model)
         if 'content' in response_body:  # For Anthropic-style
             answer = response_body['content'][0]['text']
@@ -131,11 +498,46 @@ class BedrockModelStack(ModelStack):
         return answer  # Or return full response_body for more details
 
 
+def sample_value(schema):
+    "The simplest value that matches a JSON schema."
+    schema = schema or {}
+    t = schema.get('type')
+    t = t[0] if isinstance(t, list) else t
+    if t == 'object' or 'properties' in schema:
+        return {k: sample_value(v) for k, v in (schema.get('properties') or {}).items()}
+    if t == 'array':
+        return [sample_value(schema.get('items'))]
+    return {'string': 'stub', 'number': 0.0, 'integer': 0, 'boolean': False, 'null': None}.get(t, 'stub')
+
+
+class StubModelStack(ModelStack):
+    """
+    Answers without a model, for benchmarks and tests that must run offline:
+
+      class: stub
+      latency: 0.05          # seconds before the first token
+      tokens_per_sec: 200    # then this many tokens per second
+      completion_tokens: 100
+      answer: "..."          # optional; default: a fixed sentence
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+
+    def query_once(self, prompt, max_tokens=1024, prefix=None, schema=None):
+        completion_tokens = min(int(self.config.get('completion_tokens', 100)), from_metric(max_tokens))
+        time.sleep(float(self.config.get('latency', 0.05)) + completion_tokens / float(self.config.get('tokens_per_sec', 200)))
+        self.note_usage(len((prefix or '') + prompt) // 4, completion_tokens)
+        if schema:
+            return sample_value(schema)
+        return self.config.get('answer', "This is a stub answer.")
+
+
 class TEMPLATE_ModelStack(ModelStack):
     def __init__(self, config):
         super().__init__(config)
         
-    def query(self, prompt):
+    def query_once(self, prompt, max_tokens=1024, prefix=None, schema=None):
         answer = "..."
         return answer
 
@@ -163,6 +565,157 @@ def test2():
     print(modelstack.query("What city was Benjamin Franklin born in?"))
 
 
+def test_multihost():
+    from lib.standin import StandInServer
+
+    def serve(name, loaded, **config):
+        # Each stand-in answers with its own name, so the test can see which host served a request.
+        return StandInServer(dict({'response': name, 'completion_tokens': 1, 'models': loaded}, **config)).start()
+
+    a = serve('a', [])
+    b = serve('b', ['tinyllama:1.1b'])
+    hosts = [a.url, b.url]
+    config = {'class': 'ollama-multi', 'hosts': hosts, 'model': 'tinyllama:1.1b', 'health_interval': 0}
+
+    modelstack = ModelStack.from_config(config)
+    assert sorted(modelstack.query('x' * 28) for i in range(4)) == ['a', 'a', 'b', 'b']
+    assert modelstack.report()['prompt_tokens'] == 28 and modelstack.report()['completion_tokens'] == 4
+
+    modelstack = ModelStack.from_config(dict(config, routing='loaded-model'))
+    modelstack.check_hosts()
+    assert [modelstack.query('x') for i in range(3)] == ['b', 'b', 'b']
+
+    # Prompts that share a session prefix stay on the host that has it cached.
+    modelstack = ModelStack.from_config(dict(config, session=True))
+    first = modelstack.query('x', prefix='GIVEN: doc 1')
+    assert [modelstack.query('x', prefix='GIVEN: doc 1') for i in range(3)] == [first] * 3
+
+    # A host that fails is ejected and its requests fail over.
+    failing = serve('c', ['tinyllama:1.1b'], error_rate=1.0)
+    modelstack = ModelStack.from_config(dict(config, hosts=[a.url, failing.url], eject_seconds=60))
+    assert [modelstack.query('x') for i in range(4)] == ['a', 'a', 'a', 'a']
+    assert not modelstack.hosts[1].is_healthy() and failing.stats['errors'] == 1
+    assert modelstack.pick_host() is modelstack.hosts[0]
+
+    # So is a host that goes away.
+    b.stop()
+    modelstack = ModelStack.from_config(dict(config, eject_seconds=60))
+    assert [modelstack.query('x') for i in range(3)] == ['a', 'a', 'a']
+    assert not modelstack.hosts[1].is_healthy()
+    a.stop()
+    failing.stop()
+
+
+def test_bedrock_retry():
+    import io
+    from botocore.exceptions import ClientError
+
+    class FakeClient:
+        def __init__(self, errors):
+            self.errors = errors
+            self.calls = 0
+        def invoke_model(self, **kwargs):
+            self.calls += 1
+            if self.errors:
+                raise ClientError({'Error': {'Code': self.errors.pop(0), 'Message': 'x'}}, 'InvokeModel')
+            usage = {'input_tokens': 12, 'cache_read_input_tokens': 30, 'output_tokens': 3}
+            return {'body': io.BytesIO(json.dumps({'content': [{'text': 'Boston'}], 'usage': usage}).encode())}
+
+    config = {'class': 'bedrock', 'model': 'm', 'retry': {'attempts': 3, 'base_delay': 0.01, 'throttle_delay': 0.01}}
+    modelstack = ModelStack.from_config(config)
+    modelstack.client = FakeClient(['ThrottlingException', 'ModelNotReadyException'])
+    usage = {}
+    assert modelstack.query("Where was Benjamin Franklin born?", usage=usage) == 'Boston'
+    assert modelstack.report()['throttles'] == 1 and modelstack.report()['retries'] == 2
+    assert usage == {'prompt_tokens': 42, 'completion_tokens': 3}
+    assert modelstack.report()['completion_tokens'] == 3
+
+    # Errors that will not go away are not retried, and every attempt failing raises instead of crashing later.
+    modelstack.client = FakeClient(['ValidationException'])
+    try:
+        modelstack.query("x")
+        assert False
+    except ClientError:
+        pass
+    assert modelstack.client.calls == 1
+    modelstack.client = FakeClient(['ThrottlingException'] * 3)
+    try:
+        modelstack.query("x")
+        assert False
+    except ClientError:
+        pass
+    assert modelstack.report()['failures'] == 2
+
+
+def test_structured():
+    import io
+
+    class FakeClient:
+        def invoke_model(self, **kwargs):
+            body = json.loads(kwargs['body'])
+            self.tool = body['tools'][0]
+            value = ['AWS', 'SQL']
+            if 'answer' in self.tool['input_schema']['properties']:
+                value = {'answer': value}
+            content = [{'type': 'tool_use', 'name': 'answer', 'input': value}]
+            return {'body': io.BytesIO(json.dumps({'content': content}).encode())}
+
+    modelstack = ModelStack.from_config({'class': 'bedrock', 'model': 'm'})
+    modelstack.client = FakeClient()
+    schema = {'type': 'array', 'items': {'type': 'string'}}
+    assert modelstack.query("List the skills.", schema=schema) == ['AWS', 'SQL']
+    assert modelstack.client.tool['input_schema']['properties']['answer'] == schema
+
+
+def test_memoize():
+    import io
+    import tempfile
+    from lib.cache import Cache
+
+    class FakeClient:
+        calls = 0
+
+        def invoke_model(self, **kwargs):
+            self.calls += 1
+            content = [{'type': 'text', 'text': f"answer {self.calls}"}]
+            return {'body': io.BytesIO(json.dumps({'content': content, 'usage': {'input_tokens': 5, 'output_tokens': 2}}).encode())}
+
+    modelstack = ModelStack.from_config({'class': 'bedrock', 'model': 'm', 'memoize': True})
+    modelstack.query.memo.cache = Cache(os.path.join(tempfile.mkdtemp(), 'cache.sqlite'))
+    modelstack.client = FakeClient()
+    usage = {}
+    assert modelstack.query("Hi", usage=usage) == "answer 1" and usage == {'prompt_tokens': 5, 'completion_tokens': 2}
+    usage = {}
+    assert modelstack.query("Hi", usage=usage) == "answer 1"
+    assert usage == {'prompt_tokens': 0, 'completion_tokens': 0, 'cached': True, 'cached_prompt_tokens': 5, 'cached_completion_tokens': 2}
+    assert modelstack.query("Hi", max_tokens=10) == "answer 2"
+    assert modelstack.client.calls == 2
+
+
+def test_stub():
+    modelstack = ModelStack.from_config({'class': 'stub', 'latency': 0, 'tokens_per_sec': 1e6})
+    usage = {}
+    assert modelstack.query("x" * 400, usage=usage) == "This is a stub answer."
+    assert usage == {'prompt_tokens': 100, 'completion_tokens': 100}
+    schema = {'type': 'object', 'properties': {'skills': {'type': 'array', 'items': {'type': 'string'}}, 'years': {'type': 'integer'}}}
+    assert modelstack.query("List the skills.", schema=schema) == {'skills': ['stub'], 'years': 0}
+
+    from lib.tracing import add_exporter, remove_exporter, MemoryExporter
+    memory = add_exporter(MemoryExporter())
+    modelstack.query("x" * 400, prefix="y" * 100)
+    remove_exporter(memory)
+    assert memory.spans[0]['name'] == 'llm.query' and memory.spans[0]['attributes'] == {
+        'stack': 'stub', 'model': 'StubModelStack', 'max_tokens': 1024, 'prompt_chars': 500, 'schema': False,
+        'prompt_tokens': 125, 'completion_tokens': 100}
+
+    # Hedged requests that lose the race still need a timeout, or their threads could wait forever.
+    assert modelstack.request_timeout() is None and modelstack.request_timeout(60) == 60
+    hedged = ModelStack.from_config({'class': 'stub', 'retry': {'hedge_percentile': 95}})
+    assert hedged.request_timeout() == HEDGE_TIMEOUT and hedged.request_timeout(60) == 60
+    hedged.retry.local.deadline_at = time.monotonic() + 10
+    assert 9 < hedged.request_timeout() <= 10
+
+
 if __name__ == "__main__":
     test1()
     test2()
@@ -0,0 +1,293 @@
+import os
+import json
+import time
+from lib.tools import readJson, writeJson, md5
+from lib.journal import replace_file
+from lib.skipindex import file_hash, normalize_path
+
+
+# Run a DAG of stages declared in jobs.yaml, only redoing the stages whose inputs changed:
+#
+#   pipeline:
+#     state: pipeline.state.json
+#     stages:
+#       summarize:
+#         run: summarize_resumes
+#         config: [jobs.resume]              # parts of jobs.yaml that change what the stage produces
+#         inputs: [*resume_files]            # files, folders, or {folder, extensions, exclude_patterns}
+#         outputs: [C:\Rob\RAG\Resumes\summarized.yaml]
+#       aggregate:
+#         run: aggregate_resumes
+#         inputs: [summarize]                # another stage: its outputs are this stage's inputs
+#         outputs: [C:\Rob\RAG\Resumes\aggregated.yaml]
+#
+# After a stage runs, the fingerprints of its inputs, outputs and config are saved in the state file.
+# A stage is stale when any of them differ from the saved ones, or an output is missing. A stage whose
+# upstream reran but produced identical outputs is not stale.
+#
+# A stage function is called as func(stage, records). When the stage's first upstream stage ran in the
+# same pipeline run, @records is whatever that stage's function returned, so the records go from one
+# stage to the next in memory instead of being read back from its output file. Otherwise it is None.
+
+
+
+
+def artifact_name(artifact):
+    "Inputs are paths, or folders given like a job's 'files' section: {folder, extensions, exclude_patterns}."
+    return artifact['folder'] if isinstance(artifact, dict) else artifact
+
+
+def folder_fingerprint(folder, extensions=(), exclude_patterns=()):
+    "A hash of the names, sizes and modification times of the matching files in @folder."
+    entries = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for file in sorted(files):
+            fn = os.path.join(root, file).replace('\\', '/')
+            if extensions and not file.endswith(tuple(extensions)):
+                continue
+            if any(pattern in fn for pattern in exclude_patterns):
+                continue
+            st = os.stat(fn)
+            entries.append([os.path.relpath(fn, folder).replace('\\', '/'), st.st_size, st.st_mtime])
+    return 'dir:' + md5(json.dumps(entries))
+
+
+def fingerprint(artifact, cache=None):
+    """
+    A file's content hash, or for a folder a hash of the names, sizes and modification times of the files in it.
+    None if the path does not exist. @cache maps a file to its last (mtime, size, hash) so unchanged files are not re-read.
+    """
+    if isinstance(artifact, dict):
+        if not os.path.isdir(artifact['folder']):
+            return None
+        return folder_fingerprint(artifact['folder'], artifact.get('extensions') or (), artifact.get('exclude_patterns') or ())
+    path = artifact
+    if os.path.isdir(path):
+        return folder_fingerprint(path)
+    if not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    key = normalize_path(path)
+    if cache is not None:
+        old = cache.get(key)
+        if old and old[0] == st.st_mtime and old[1] == st.st_size:
+            return old[2]
+    h = file_hash(path)
+    if cache is not None:
+        cache[key] = [st.st_mtime, st.st_size, h]
+    return h
+
+
+def config_value(config, dotted):
+    "Look up 'jobs.resume' in a nested dict."
+    o = config
+    for part in dotted.split('.'):
+        o = o.get(part) if isinstance(o, dict) else None
+    return o
+
+
+
+
+class Pipeline:
+    """
+    pipeline = Pipeline(jobfile['pipeline'], functions={'summarize_resumes': summarize_resumes, ...}, config=jobfile)
+    pipeline.run()                   # every stale stage
+    pipeline.run(['aggregate'])      # 'aggregate' and whatever it depends on, if stale
+    pipeline.run(force=True)         # everything
+    """
+
+    def __init__(self, spec, functions, config=None, state_path=None):
+        self.stages = spec.get('stages') or {}
+        self.functions = functions
+        self.config = config or {}
+        self.state_path = state_path or spec.get('state') or 'pipeline.state.json'
+        self.state = {'stages': {}, 'files': {}}
+        self.check()
+
+    def check(self):
+        for name, stage in self.stages.items():
+            if stage.get('run') not in self.functions:
+                raise ValueError(f"Pipeline stage '{name}' runs unknown function '{stage.get('run')}'")
+        self.order()
+
+    def upstream(self, name):
+        return [i for i in self.stages[name].get('inputs') or [] if isinstance(i, str) and i in self.stages]
+
+    def order(self, names=None):
+        "The stages in @names and everything they depend on, upstream first."
+        out = []
+        visiting = set()
+
+        def visit(name, path):
+            if name in out:
+                return
+            if name in visiting:
+                raise ValueError(f"Pipeline stages form a cycle: {' -> '.join(path + [name])}")
+            if name not in self.stages:
+                raise ValueError(f"Unknown pipeline stage '{name}'")
+            visiting.add(name)
+            for u in self.upstream(name):
+                visit(u, path + [name])
+            visiting.discard(name)
+            out.append(name)
+
+        for name in names or self.stages:
+            visit(name, [])
+        return out
+
+    def load(self):
+        if os.path.exists(self.state_path):
+            try:
+                self.state = readJson(self.state_path)
+            except Exception as e:
+                print(f"  Ignoring unreadable pipeline state {self.state_path}: {e}")
+        self.state.setdefault('stages', {})
+        self.state.setdefault('files', {})
+        return self
+
+    def save(self):
+        replace_file(self.state_path, lambda fn: writeJson(fn, self.state, pretty=False))
+
+    def input_paths(self, name):
+        paths = []
+        for i in self.stages[name].get('inputs') or []:
+            if isinstance(i, str) and i in self.stages:
+                paths.extend(self.stages[i].get('outputs') or [])
+            else:
+                paths.append(i)
+        return paths
+
+    def fingerprints(self, artifacts):
+        return {artifact_name(a): fingerprint(a, self.state['files']) for a in artifacts}
+
+    def config_fingerprint(self, name):
+        stage = self.stages[name]
+        values = [config_value(self.config, c) for c in stage.get('config') or []]
+        return md5(json.dumps([stage, values], sort_keys=True, default=str))
+
+    def stale(self, name):
+        "Why the stage has to run, or None if it is up to date."
+        stage = self.stages[name]
+        last = self.state['stages'].get(name)
+        if not last:
+            return 'never ran'
+        if last.get('config') != self.config_fingerprint(name):
+            return 'settings changed'
+        for path, fp in self.fingerprints(self.input_paths(name)).items():
+            if last.get('inputs', {}).get(path) != fp:
+                return f"input changed: {path}"
+        for path, fp in self.fingerprints(stage.get('outputs') or []).items():
+            if fp is None:
+                return f"output missing: {path}"
+            if last.get('outputs', {}).get(path) != fp:
+                return f"output changed: {path}"
+        return None
+
+    def run(self, names=None, force=False):
+        "Run the stale stages among @names (default: all) and their upstream stages; @force runs them all. Returns the names that ran."
+        self.load()
+        results = {}
+        ran = []
+        for name in self.order(names):
+            stage = self.stages[name]
+            reason = 'forced' if force else self.stale(name)
+            if not reason:
+                print(f"Stage {name}: up to date")
+                continue
+            print(f"Stage {name}: running ({reason})")
+            # Fingerprint the inputs before running, so a change made while the stage runs is seen next time.
+            inputs = self.fingerprints(self.input_paths(name))
+            upstream = self.upstream(name)
+            records = results.get(upstream[0]) if upstream else None
+            start = time.time()
+            results[name] = self.functions[stage['run']](stage, records)
+            self.state['stages'][name] = {
+                'config': self.config_fingerprint(name),
+                'inputs': inputs,
+                'outputs': self.fingerprints(stage.get('outputs') or []),
+                'seconds': round(time.time() - start, 3),
+                'finished': time.strftime('%Y-%m-%d %H:%M:%S'),
+            }
+            # Save after every stage, so a failure later on does not redo the stages that finished.
+            self.save()
+            ran.append(name)
+        return ran
+
+
+
+
+def test_pipeline():
+    import shutil
+    import tempfile
+    dir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(dir, 'src')
+        os.makedirs(src)
+        with open(os.path.join(src, 'a.txt'), 'w') as f:
+            f.write('apple')
+        calls = []
+
+        def count(stage, records):
+            calls.append(('count', records))
+            text = ''.join(open(os.path.join(src, fn)).read() for fn in sorted(os.listdir(src)) if fn.endswith('.txt'))
+            with open(stage['outputs'][0], 'w') as f:
+                f.write(str(len(text)))
+            return len(text)
+
+        def double(stage, records):
+            calls.append(('double', records))
+            if records is None:
+                records = int(open(os.path.join(dir, 'count.txt')).read())
+            with open(stage['outputs'][0], 'w') as f:
+                f.write(str(2 * records))
+            return 2 * records
+
+        spec = {'state': os.path.join(dir, 'state.json'), 'stages': {
+            'double': {'run': 'double', 'inputs': ['count'], 'outputs': [os.path.join(dir, 'double.txt')]},
+            'count': {'run': 'count', 'config': ['settings.unit'], 'inputs': [{'folder': src, 'extensions': ['.txt']}], 'outputs': [os.path.join(dir, 'count.txt')]},
+        }}
+        functions = {'count': count, 'double': double}
+        config = {'settings': {'unit': 'chars'}}
+
+        # First run: both stages, upstream first, and the count goes to 'double' in memory.
+        assert Pipeline(spec, functions, config).run() == ['count', 'double']
+        assert calls == [('count', None), ('double', 5)]
+
+        # Nothing changed: nothing runs.
+        assert Pipeline(spec, functions, config).run() == []
+
+        # A deleted output reruns only its stage, which reads its input from disk.
+        os.remove(os.path.join(dir, 'double.txt'))
+        calls.clear()
+        assert Pipeline(spec, functions, config).run() == ['double']
+        assert calls == [('double', None)]
+
+        # Files the input does not match do not count; a new input file reruns everything downstream of it.
+        with open(os.path.join(src, 'notes.log'), 'w') as f:
+            f.write('ignored')
+        assert Pipeline(spec, functions, config).run() == []
+        with open(os.path.join(src, 'b.txt'), 'w') as f:
+            f.write('kiwi')
+        assert Pipeline(spec, functions, config).run() == ['count', 'double']
+        assert open(os.path.join(dir, 'double.txt')).read() == '18'
+
+        # Changed settings rerun the stage; identical output means 'double' is still up to date.
+        config['settings']['unit'] = 'letters'
+        assert Pipeline(spec, functions, config).run() == ['count']
+
+        # Forcing one stage runs it again without its downstream stages.
+        assert Pipeline(spec, functions, config).run(['count'], force=True) == ['count']
+
+        spec['stages']['count']['inputs'] = ['double']
+        try:
+            Pipeline(spec, functions, config)
+            assert False
+        except ValueError as e:
+            assert 'cycle' in str(e)
+    finally:
+        shutil.rmtree(dir)
+
+
+if __name__ == "__main__":
+    test_pipeline()
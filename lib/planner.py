@@ -0,0 +1,170 @@
+import math
+from lib.tools import from_metric
+
+
+# Estimate what a job will cost before running it: tokens, wall time and, for priced models, dollars.
+#
+# Throughput and prices come from the 'estimates' section of jobs.yaml:
+#
+#   estimates:
+#     completion_tokens: 500        # expected answer length per prompt
+#     models:
+#       granite3.2:2b: {prompt_tokens_per_sec: 2000, completion_tokens_per_sec: 40}
+#       claude-3-haiku: {prompt_tokens_per_sec: 8000, completion_tokens_per_sec: 120, input_price: 0.25, output_price: 1.25}
+#
+# Prices are in dollars per million tokens. A model id matches the longest table key it contains, so
+# 'claude-3-haiku' covers 'anthropic.claude-3-haiku-20240307-v1:0'.
+
+DEFAULT_RATES = {'prompt_tokens_per_sec': 1000, 'completion_tokens_per_sec': 30, 'seconds_per_call': 0.5}
+CHARS_PER_TOKEN = 4
+
+
+
+
+def get_tokenizer(name='auto'):
+    """
+    Return a function that counts the tokens in a text.
+    'tiktoken' uses the cl100k_base encoding, which is close enough for estimates on most models;
+    'chars' assumes CHARS_PER_TOKEN characters per token. 'auto' uses tiktoken when it is installed.
+    """
+    if name in ['auto', 'tiktoken']:
+        try:
+            import tiktoken
+            encoding = tiktoken.get_encoding('cl100k_base')
+            return lambda text: len(encoding.encode(text, disallowed_special=()))
+        except ImportError:
+            if name == 'tiktoken':
+                raise
+    elif name != 'chars':
+        raise ValueError(f"Unsupported tokenizer: {name}")
+    return lambda text: math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def rates_for(model, table):
+    "The throughput and price entry for @model: an exact match, else the longest key contained in the model id."
+    table = table or {}
+    if model in table:
+        return dict(DEFAULT_RATES, **table[model])
+    keys = [k for k in table if k in (model or '')]
+    if keys:
+        return dict(DEFAULT_RATES, **table[max(keys, key=len)])
+    return dict(DEFAULT_RATES)
+
+
+
+
+class Plan:
+    """
+    Accumulates the prompts a job would send and turns them into an estimate.
+
+    plan = Plan('granite3.2:2b', context_window='128K', rates=rates_for(...), completion_tokens=500, concurrency=2)
+    plan.add('a.docx', [rendered_prompt_1, rendered_prompt_2])
+    print(format_plan(plan.summary()))
+    """
+
+    def __init__(self, model, context_window=None, rates=None, completion_tokens=500, concurrency=1, count_tokens=None):
+        self.model = model
+        self.context_window = from_metric(context_window) if context_window else None
+        self.rates = rates or dict(DEFAULT_RATES)
+        self.completion_tokens = int(completion_tokens)
+        self.concurrency = max(1, int(concurrency))
+        self.count_tokens = count_tokens or get_tokenizer()
+        self.files = 0
+        self.prompts = 0
+        self.prompt_tokens = 0
+        self.largest = []       # (tokens, filepath) of the largest prompts
+        self.too_large = []     # (tokens, filepath) of prompts that do not fit the context window
+        self.skipped = 0
+
+    def skip(self, n=1):
+        "Count files that need no work because the skip index has them."
+        self.skipped += n
+
+    def add(self, filepath, prompts):
+        self.files += 1
+        for prompt in prompts:
+            tokens = self.count_tokens(prompt)
+            self.prompts += 1
+            self.prompt_tokens += tokens
+            self.largest = sorted(self.largest + [(tokens, filepath)], reverse=True)[:5]
+            if self.context_window and tokens + self.completion_tokens > self.context_window:
+                self.too_large.append((tokens, filepath))
+
+    def summary(self):
+        r = self.rates
+        completion_tokens = self.prompts * self.completion_tokens
+        call_seconds = (self.prompt_tokens / r['prompt_tokens_per_sec']
+                        + completion_tokens / r['completion_tokens_per_sec']
+                        + self.prompts * r['seconds_per_call'])
+        cost = None
+        if 'input_price' in r or 'output_price' in r:
+            cost = (self.prompt_tokens * r.get('input_price', 0) + completion_tokens * r.get('output_price', 0)) / 1e6
+        return {
+            'model': self.model,
+            'files': self.files,
+            'skipped': self.skipped,
+            'prompts': self.prompts,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'context_window': self.context_window,
+            'too_large': self.too_large,
+            'largest': self.largest,
+            'call_seconds': call_seconds,
+            'concurrency': self.concurrency,
+            'wall_seconds': call_seconds / self.concurrency,
+            'cost': cost,
+        }
+
+
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    h, m, s = seconds // 3600, seconds // 60 % 60, seconds % 60
+    return f"{h}h{m:02d}m" if h else f"{m}m{s:02d}s"
+
+
+def format_plan(summary):
+    lines = [
+        f"{summary['model']}: {summary['files']} files to process ({summary['skipped']} already done), {summary['prompts']} prompts",
+        f"  tokens: {summary['prompt_tokens']} prompt + ~{summary['completion_tokens']} completion",
+        f"  time: ~{format_duration(summary['wall_seconds'])} with {summary['concurrency']} concurrent calls "
+        f"({format_duration(summary['call_seconds'])} of model time)",
+    ]
+    if summary['cost'] is not None:
+        lines.append(f"  cost: ~${summary['cost']:.2f}")
+    for tokens, filepath in summary['largest'][:3]:
+        lines.append(f"  largest prompt: {tokens} tokens  {filepath}")
+    if summary['too_large']:
+        lines.append(f"  {len(summary['too_large'])} prompts do not fit the {summary['context_window']} token context window:")
+        lines.extend(f"    {tokens} tokens  {filepath}" for tokens, filepath in summary['too_large'][:10])
+    return '\n'.join(lines)
+
+
+
+
+def test_planner():
+    table = {'claude-3-haiku': {'input_price': 0.25, 'output_price': 1.25, 'prompt_tokens_per_sec': 1000, 'completion_tokens_per_sec': 100, 'seconds_per_call': 0}}
+    rates = rates_for('anthropic.claude-3-haiku-20240307-v1:0', table)
+    assert rates['input_price'] == 0.25
+    assert rates_for('granite3.2:2b', table) == DEFAULT_RATES
+
+    count = get_tokenizer('chars')
+    assert count('x' * 10) == 3
+
+    plan = Plan('haiku', context_window='2K', rates=rates, completion_tokens=100, concurrency=2, count_tokens=count)
+    plan.add('a.docx', ['x' * 4000, 'x' * 400])
+    plan.add('b.docx', ['x' * 8000])
+    plan.skip()
+    summary = plan.summary()
+    assert summary['prompts'] == 3 and summary['prompt_tokens'] == 3100
+    assert summary['completion_tokens'] == 300
+    assert summary['too_large'] == [(2000, 'b.docx')]
+    # 3100 / 1000 + 300 / 100 seconds of model time, split over two concurrent calls.
+    assert abs(summary['wall_seconds'] - 3.05) < 1e-9
+    assert abs(summary['cost'] - (3100 * 0.25 + 300 * 1.25) / 1e6) < 1e-12
+    assert '1 already done' in format_plan(summary)
+
+
+if __name__ == "__main__":
+    test_planner()
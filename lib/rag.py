@@ -1,23 +1,32 @@
 from lib.modelstack import *
 from lib.vectordb import *
+from lib.tracing import span
 
 
 class Rag:
-    def __init__(self, collection_name, corpus_folder, model_config):
+    def __init__(self, collection_name, corpus_folder, model_config, vectordb=None):
+        "@vectordb is an already loaded VectorDb to use instead of the collection make_rag() keeps up to date."
         self.collection_name = collection_name
         self.corpus_folder = corpus_folder
         self.llm = ModelStack.from_config(model_config)
-        self.rag = make_rag(collection_name, corpus_folder)
+        self.rag = vectordb or make_rag(collection_name, corpus_folder)
 
-    def query(self, query):
-        nResults =  int(self.llm.num_tokens() / (1000/5))
-        context = self.rag.retrive_documents(query, n_results=nResults)
-        prompt = f"""
+    def query(self, query, timings=None):
+        """
+        Answer @query from the collection. @timings is an optional dict that receives the seconds spent in
+        'retrieval', 'rerank', 'packing' and 'generation'.
+        """
+        timings = {} if timings is None else timings
+        with span('rag.query', collection=self.collection_name, model=self.llm.name()):
+            nResults =  int(self.llm.num_tokens() / (1000/5))
+            context = self.rag.retrive_documents(query, n_results=nResults, timings=timings)
+            prompt = f"""
 QUERY: {query}
 
 CONTEXT: {context}
         """
-        answer = self.llm.query(prompt)
+            with Timer(timings, 'generation'):
+                answer = self.llm.query(prompt)
         return answer
 
 
@@ -0,0 +1,408 @@
+import re
+import json
+import yaml
+from lib.tools import fixJson, to_utf8
+
+
+# Salvage JSON or YAML from LLM answers that are almost right: wrapped in prose or code fences,
+# cut off mid-structure, or written with Python-style quotes and literals.
+#
+# Every function returns (object, changes) where changes is a list of human-readable notes about
+# what had to be repaired. An empty list means the answer parsed as-is.
+
+
+
+
+class RepairError(ValueError):
+    """Nothing parseable could be recovered from the answer."""
+    pass
+
+
+
+def strip_fence(text):
+    "Return the body of the first ``` fenced block, or the text unchanged if there is none."
+    start = text.find('```')
+    if start < 0:
+        return text, False
+    body = text.find('\n', start)
+    if body < 0:
+        return text, False
+    end = text.find('```', body)
+    if end < 0:
+        # The answer was cut off before the closing fence.
+        return text[body + 1:], True
+    return text[body + 1:end], True
+
+
+def scan(text):
+    """
+    Walk @text once, tracking strings and brackets.
+    Returns (stack, in_string, commas) where stack holds the unclosed brackets at the end,
+    and commas holds (position, depth) of every comma outside a string.
+    """
+    stack = []
+    commas = []
+    in_string = False
+    escaped = False
+    for i, c in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c in '{[':
+            stack.append(c)
+        elif c in '}]':
+            if stack:
+                stack.pop()
+        elif c == ',':
+            commas.append((i, len(stack)))
+    return stack, in_string, commas
+
+
+def close_structure(text):
+    "Append whatever quotes and brackets are needed to close a truncated JSON value."
+    stack, in_string, commas = scan(text)
+    if in_string:
+        text += '"'
+    s = text.rstrip()
+    if s.endswith(','):
+        s = s[:-1]
+    elif s.endswith(':'):
+        s += ' null'
+    closers = ''.join('}' if c == '{' else ']' for c in reversed(stack))
+    return s + closers, len(stack)
+
+
+def requote(text):
+    "Turn single-quoted strings into double-quoted ones and Python literals into JSON ones."
+    out = []
+    quote = None
+    escaped = False
+    i = 0
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if quote:
+            if escaped:
+                escaped = False
+                out.append("'" if c == "'" and quote == "'" else '\\' + c)
+            elif c == '\\':
+                escaped = True
+            elif c == quote:
+                quote = None
+                out.append('"')
+            elif c == '"' and quote == "'":
+                out.append('\\"')
+            else:
+                out.append(c)
+        elif c in '"\'':
+            quote = c
+            out.append('"')
+        else:
+            for py, js in (('True', 'true'), ('False', 'false'), ('None', 'null')):
+                if text.startswith(py, i) and not (i and text[i - 1].isalnum()) and not text[i + len(py):i + len(py) + 1].isalnum():
+                    out.append(js)
+                    i += len(py)
+                    break
+            else:
+                out.append(c)
+                i += 1
+            continue
+        i += 1
+    if escaped:
+        out.append('\\')
+    return ''.join(out)
+
+
+def drop_trailing_commas(text):
+    "Remove commas that directly precede a closing bracket."
+    out = []
+    in_string = False
+    escaped = False
+    for c in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c in '}]':
+            j = len(out) - 1
+            while j >= 0 and out[j].isspace():
+                j -= 1
+            if j >= 0 and out[j] == ',':
+                del out[j]
+        out.append(c)
+    return ''.join(out)
+
+
+def largest_json(text):
+    "Find the longest complete JSON object or array embedded in @text. Returns (obj, start, end) or None."
+    decoder = json.JSONDecoder()
+    best = None
+    i = 0
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if c in '{[':
+            try:
+                obj, end = decoder.raw_decode(text, i)
+            except ValueError:
+                i += 1
+                continue
+            if not best or end - i > best[2] - best[1]:
+                best = (obj, i, end)
+            # Anything inside this value is smaller, so continue after it.
+            i = end
+            continue
+        i += 1
+    return best
+
+
+def close_truncated(text):
+    """
+    Close a JSON value that was cut off. If the cut left a half-written member behind,
+    back up to earlier commas until the closed text parses. Returns (obj, dropped, closed) or None.
+    """
+    commas = scan(text)[2]
+    candidates = [len(text)] + [pos for pos, depth in reversed(commas)][:50]
+    for end in candidates:
+        closed, count = close_structure(text[:end])
+        try:
+            return json.loads(closed), len(text) - end, count
+        except ValueError:
+            continue
+    return None
+
+
+def repair_json(text):
+    """
+    Parse @text as JSON, repairing it if needed. Returns (obj, changes).
+    Raises RepairError if nothing can be salvaged.
+    """
+    changes = []
+    if not isinstance(text, str):
+        raise RepairError(f"Expected text, got {type(text)}")
+    try:
+        return fixJson(json.loads(text)), changes
+    except ValueError:
+        pass
+
+    text, fenced = strip_fence(text)
+    if fenced:
+        changes.append('stripped code fence')
+        try:
+            return fixJson(json.loads(text)), changes
+        except ValueError:
+            pass
+
+    starts = [i for i in (text.find('{'), text.find('[')) if i >= 0]
+    if not starts:
+        raise RepairError("No JSON object or array found in the answer.")
+    start = min(starts)
+
+    # A complete value that starts at the first bracket only needs the prose around it removed.
+    # A complete value further in may just be a piece of a truncated outer one, so it is kept as a fallback.
+    found = largest_json(text)
+    if found and found[1] == start:
+        obj, start, end = found
+        extra = len(text[:start].strip()) + len(text[end:].strip())
+        if extra:
+            changes.append(f'dropped {extra} characters of surrounding text')
+        return fixJson(obj), changes
+    fallback = list(changes)
+    if found:
+        obj, inner_start, inner_end = found
+        fallback.append(f'kept the largest complete value and dropped {len(text) - (inner_end - inner_start)} characters around it')
+
+    if text[:start].strip():
+        changes.append(f'dropped {len(text[:start].strip())} characters of leading text')
+    body = text[start:].rstrip()
+
+    # The character-level passes are only run when their pattern can occur at all.
+    if "'" in body or re.search(r'\b(True|False|None)\b', body):
+        fixed = requote(body)
+        if fixed != body:
+            changes.append('converted single quotes and Python literals to JSON')
+            body = fixed
+    if re.search(r',\s*[}\]]', body):
+        fixed = drop_trailing_commas(body)
+    else:
+        fixed = body
+    if fixed != body:
+        changes.append('removed trailing commas')
+        body = fixed
+
+    repaired = largest_json(body)
+    if repaired and repaired[1] == 0:
+        obj, start, end = repaired
+        if body[end:].strip():
+            changes.append(f'dropped {len(body[end:].strip())} characters of trailing text')
+        return fixJson(obj), changes
+
+    closed = close_truncated(body)
+    if closed:
+        obj, dropped, count = closed
+        if dropped:
+            changes.append(f'dropped {dropped} characters of a truncated member')
+        if count:
+            changes.append(f'closed {count} unterminated brackets')
+        return fixJson(obj), changes
+    if found:
+        return fixJson(found[0]), fallback
+    raise RepairError("Could not repair the JSON in the answer.")
+
+
+def looks_like_yaml_start(line):
+    s = line.strip()
+    if not s or s.startswith('#'):
+        return False
+    if s.startswith('- ') or s == '-' or s.startswith(('{', '[')):
+        return True
+    key = s.split(':', 1)[0]
+    return ':' in s and key and ' ' not in key.strip().strip('"\'')
+
+
+def repair_yaml(text):
+    """
+    Parse @text as YAML, repairing it if needed. Returns (obj, changes).
+    Only mappings and lists count as a result; prose that YAML reads as a plain string does not.
+    Raises RepairError if nothing can be salvaged.
+    """
+    changes = []
+    if not isinstance(text, str):
+        raise RepairError(f"Expected text, got {type(text)}")
+    text = to_utf8(text)
+
+    def load(s):
+        try:
+            o = yaml.safe_load(s)
+        except yaml.YAMLError:
+            return None
+        return o if isinstance(o, (dict, list)) else None
+
+    o = load(text)
+    if o is not None:
+        return fixJson(o), changes
+
+    body, fenced = strip_fence(text)
+    if fenced:
+        changes.append('stripped code fence')
+        o = load(body)
+        if o is not None:
+            return fixJson(o), changes
+
+    # Drop leading prose up to the first line that looks like YAML, then trailing lines until it parses.
+    # This runs before trying JSON: a flow list like [2019, 2020] inside a YAML answer is complete JSON too.
+    lines = body.splitlines()
+    first = next((i for i, line in enumerate(lines) if looks_like_yaml_start(line)), None)
+    if first is not None:
+        trimmed = lines[first:]
+        for end in range(len(trimmed), 0, -1):
+            o = load('\n'.join(trimmed[:end]))
+            if o is not None:
+                if first:
+                    changes.append(f'dropped {first} lines of leading text')
+                if end < len(trimmed):
+                    changes.append(f'dropped {len(trimmed) - end} lines of trailing text')
+                return fixJson(o), changes
+
+    # The answer may really be JSON. Unless nothing else in it looks like YAML, the JSON has to start where
+    # the prose ends or make up most of the answer, not be a value picked out of the middle of it.
+    try:
+        o, json_changes = repair_json(body)
+    except RepairError:
+        o = None
+    if isinstance(o, (dict, list)):
+        found = largest_json(body)
+        if first is None or '\n'.join(lines[first:]).lstrip().startswith(('{', '[')) \
+                or (found and found[2] - found[1] > len(body.strip()) / 2):
+            return o, changes + json_changes
+    if first is None:
+        raise RepairError("No YAML mapping or list found in the answer.")
+    raise RepairError("Could not repair the YAML in the answer.")
+
+
+def repair_answer(text, fmt):
+    "Repair an answer meant to be @fmt ('json' or 'yaml')."
+    if fmt == 'json':
+        return repair_json(text)
+    if fmt == 'yaml':
+        return repair_yaml(text)
+    raise ValueError(f"Unsupported format: {fmt}")
+
+
+
+
+def test_repair_json():
+    o, changes = repair_json('{"a": 1}')
+    assert o == {'a': 1} and changes == []
+
+    o, changes = repair_json('Here is the JSON:\n```json\n{"skills": ["AWS", "SQL"]}\n```\nHope that helps!')
+    assert o == {'skills': ['AWS', 'SQL']}
+    assert changes == ['stripped code fence']
+
+    o, changes = repair_json('Sure! {"skills": ["AWS"]} Let me know if you need more.')
+    assert o == {'skills': ['AWS']} and changes
+
+    o, changes = repair_json("{'name': 'Rob', 'active': True, 'manager': None, 'note': \"it's\"}")
+    assert o == {'name': 'Rob', 'active': True, 'manager': None, 'note': "it's"}
+
+    o, changes = repair_json('{"a": [1, 2, 3,], "b": 2,}')
+    assert o == {'a': [1, 2, 3], 'b': 2} and 'removed trailing commas' in changes
+
+    o, changes = repair_json('{"skills": ["AWS", "SQL"], "experience": [{"company": "Acme", "title": "Dev')
+    assert o == {'skills': ['AWS', 'SQL'], 'experience': [{'company': 'Acme', 'title': 'Dev'}]}
+    assert any('closed' in c for c in changes)
+
+    o, changes = repair_json('{"skills": ["AWS", "SQL"], "name"')
+    assert o == {'skills': ['AWS', 'SQL']}
+
+    o, changes = repair_json('{"when": "/Date(1234567890)/"}')
+    assert str(o['when']) == '2009-02-13 23:31:30'
+
+    try:
+        repair_json('I cannot help with that.')
+        assert False
+    except RepairError:
+        pass
+
+
+def test_repair_yaml():
+    o, changes = repair_yaml('name: Rob\nskills:\n- AWS\n')
+    assert o == {'name': 'Rob', 'skills': ['AWS']} and changes == []
+
+    o, changes = repair_yaml('Here is the resume:\n\n```yaml\nname: Rob\nskills:\n- AWS\n```\n')
+    assert o == {'name': 'Rob', 'skills': ['AWS']}
+
+    o, changes = repair_yaml('Here is the resume in YAML.\nname: Rob\nskills:\n- AWS\nI hope: this helps, and: more\n')
+    assert o['name'] == 'Rob' and o['skills'] == ['AWS']
+
+    o, changes = repair_yaml('{"name": "Rob", "skills": ["AWS"')
+    assert o == {'name': 'Rob', 'skills': ['AWS']}
+
+    # A flow list inside a YAML answer is valid JSON, but the answer is the whole mapping.
+    o, changes = repair_yaml('Here is the summary...\nname: Rob\ndates: [2019, 2020]\nskills:\n- AWS\n\nHope this helps')
+    assert o == {'name': 'Rob', 'dates': [2019, 2020], 'skills': ['AWS']}
+
+    o, changes = repair_yaml('Sure! {"skills": ["AWS"]} Let me know if you need more.')
+    assert o == {'skills': ['AWS']}
+
+    try:
+        repair_yaml('Sorry, I could not read the file.')
+        assert False
+    except RepairError:
+        pass
+
+
+if __name__ == "__main__":
+    test_repair_json()
+    test_repair_yaml()
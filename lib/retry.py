@@ -0,0 +1,349 @@
+import time
+import math
+import random
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+# Error codes that Bedrock (botocore ClientError) uses when it wants the caller to slow down or try again.
+THROTTLE_CODES = ['ThrottlingException', 'TooManyRequestsException', 'ServiceUnavailableException', 'ServiceQuotaExceededException']
+RETRYABLE_CODES = ['ModelNotReadyException', 'ModelTimeoutException', 'InternalServerException']
+
+
+
+
+class RetryableError(Exception):
+    """A transient failure: the same request may succeed if sent again."""
+    pass
+
+
+class ThrottledError(RetryableError):
+    """The server is overloaded or rate limiting us. Back off harder than for other errors."""
+    pass
+
+
+class DeadlineExceeded(TimeoutError):
+    """The call ran out of its deadline. Not retried."""
+    pass
+
+
+
+def error_code(e):
+    "Get the AWS error code out of a botocore ClientError, else None."
+    response = getattr(e, 'response', None)
+    if isinstance(response, dict):
+        return (response.get('Error') or {}).get('Code')
+    return None
+
+
+def is_throttle(e):
+    if isinstance(e, ThrottledError):
+        return True
+    if error_code(e) in THROTTLE_CODES:
+        return True
+    s = str(e).lower()
+    return 'throttl' in s or 'too many requests' in s
+
+
+def is_retryable(e):
+    if isinstance(e, DeadlineExceeded):
+        return False
+    if isinstance(e, (RetryableError, ConnectionError, TimeoutError)):
+        return True
+    if is_throttle(e):
+        return True
+    if error_code(e) in RETRYABLE_CODES:
+        return True
+    return 'timed out' in str(e).lower()
+
+
+def percentile(values, p):
+    "Nearest-rank percentile of @values, p in 0..100. None for an empty list."
+    if not values:
+        return None
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))
+    return values[k]
+
+
+
+
+class LatencyStats:
+    """Thread-safe counters and a sliding window of latencies for one model stack."""
+
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.calls = 0
+        self.failures = 0
+        self.throttles = 0
+        self.retries = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def record(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def percentile(self, p):
+        with self.lock:
+            values = list(self.latencies)
+        return percentile(values, p)
+
+    def samples(self):
+        with self.lock:
+            return len(self.latencies)
+
+    def report(self):
+        with self.lock:
+            values = list(self.latencies)
+            return {
+                'calls': self.calls,
+                'failures': self.failures,
+                'failure_rate': self.failures / self.calls if self.calls else 0.0,
+                'throttles': self.throttles,
+                'retries': self.retries,
+                'hedged': self.hedged,
+                'hedge_wins': self.hedge_wins,
+                'prompt_tokens': self.prompt_tokens,
+                'completion_tokens': self.completion_tokens,
+                'p50': percentile(values, 50),
+                'p95': percentile(values, 95),
+                'p99': percentile(values, 99),
+            }
+
+
+
+
+class RetryPolicy:
+    """
+    Jittered exponential backoff with an optional deadline and hedged requests.
+
+    Config (the 'retry' section of a model stack):
+        attempts: 3             # total tries per call
+        base_delay: 1           # seconds; the delay before try n is uniform(0, base_delay * 2**n)
+        max_delay: 30           # cap on a single delay
+        throttle_delay: 4       # base delay used instead when the server throttled us
+        deadline: 300           # seconds for the whole call, including retries; none by default
+        hedge_percentile: 95    # send a second request when the first is slower than this percentile
+        hedge_min_samples: 20   # latencies needed before hedging starts
+    """
+
+    def __init__(self, attempts=3, base_delay=1.0, max_delay=30.0, throttle_delay=None, deadline=None,
+                 hedge_percentile=None, hedge_min_samples=20, stats=None, sleep=time.sleep):
+        self.attempts = max(1, int(attempts))
+        self.base_delay = float(base_delay)
+        self.max_delay = float(max_delay)
+        self.throttle_delay = float(throttle_delay if throttle_delay is not None else base_delay * 4)
+        self.deadline = float(deadline) if deadline else None
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = int(hedge_min_samples)
+        self.stats = stats or LatencyStats()
+        self.sleep = sleep
+        self.local = threading.local()
+
+    @staticmethod
+    def from_config(config):
+        config = config or {}
+        return RetryPolicy(
+            attempts=config.get('attempts', 3),
+            base_delay=config.get('base_delay', 1.0),
+            max_delay=config.get('max_delay', 30.0),
+            throttle_delay=config.get('throttle_delay'),
+            deadline=config.get('deadline'),
+            hedge_percentile=config.get('hedge_percentile'),
+            hedge_min_samples=config.get('hedge_min_samples', 20),
+        )
+
+    def backoff(self, attempt, throttled=False):
+        base = self.throttle_delay if throttled else self.base_delay
+        return random.uniform(0, min(self.max_delay, base * 2 ** attempt))
+
+    def hedge_delay(self):
+        if not self.hedge_percentile or self.stats.samples() < self.hedge_min_samples:
+            return None
+        return self.stats.percentile(self.hedge_percentile)
+
+    def time_left(self):
+        """
+        Seconds left before the deadline of the call running on this thread, or None without a deadline.
+        Backends use it as the timeout of their request, so an abandoned request does not outlive its call.
+        """
+        deadline_at = getattr(self.local, 'deadline_at', None)
+        if deadline_at is None:
+            return None
+        return max(0.001, deadline_at - time.monotonic())
+
+    def run(self, func, deadline_at):
+        self.local.deadline_at = deadline_at
+        try:
+            return func()
+        finally:
+            self.local.deadline_at = None
+
+    def call(self, func):
+        """Call @func() until it succeeds, a non-retryable error is raised, or attempts or deadline run out."""
+        self.stats.count('calls')
+        deadline_at = time.monotonic() + self.deadline if self.deadline else None
+        for attempt in range(self.attempts):
+            try:
+                return self.call_once(func, deadline_at)
+            except Exception as e:
+                throttled = is_throttle(e)
+                if throttled:
+                    self.stats.count('throttles')
+                if not is_retryable(e) or attempt == self.attempts - 1:
+                    self.stats.count('failures')
+                    raise
+                delay = self.backoff(attempt, throttled)
+                if deadline_at and time.monotonic() + delay >= deadline_at:
+                    self.stats.count('failures')
+                    raise DeadlineExceeded(f"No time left to retry before the deadline. Last error: {e}") from e
+                print(f"  Retrying in {delay:.1f}s after error: {e}")
+                self.stats.count('retries')
+                self.sleep(delay)
+
+    def call_once(self, func, deadline_at=None):
+        hedge_delay = self.hedge_delay()
+        start = time.monotonic()
+        if not deadline_at and hedge_delay is None:
+            result = func()
+            self.stats.record(time.monotonic() - start)
+            return result
+
+        # A deadline or a hedge needs the call on a worker thread so we can stop waiting for it.
+        # A request that is abandoned keeps running in the background until its own timeout (time_left()),
+        # and its result is dropped. Each call gets its own threads, so abandoned requests never hold up
+        # other calls and no call waits in a queue while its deadline runs.
+        executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='retry')
+        try:
+            return self.wait_for(executor, func, start, deadline_at, hedge_delay)
+        finally:
+            executor.shutdown(wait=False)
+
+    def wait_for(self, executor, func, start, deadline_at, hedge_delay):
+        def remaining():
+            return None if deadline_at is None else max(0, deadline_at - time.monotonic())
+
+        pending = {executor.submit(self.run, func, deadline_at)}
+        hedged = False
+        error = None
+        while pending:
+            timeout = remaining()
+            if not hedged and hedge_delay is not None:
+                wait_hedge = max(0, start + hedge_delay - time.monotonic())
+                timeout = wait_hedge if timeout is None else min(timeout, wait_hedge)
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self.stats.record(time.monotonic() - start)
+                    if hedged and future is not first:
+                        self.stats.count('hedge_wins')
+                    return future.result()
+                error = future.exception()
+            if deadline_at and time.monotonic() >= deadline_at:
+                raise DeadlineExceeded(f"Call exceeded its deadline of {self.deadline}s")
+            if not hedged and hedge_delay is not None and pending and time.monotonic() - start >= hedge_delay:
+                first = next(iter(pending))
+                pending.add(executor.submit(self.run, func, deadline_at))
+                hedged = True
+                self.stats.count('hedged')
+        raise error
+
+
+
+
+def format_report(name, report):
+    def ms(v):
+        return '-' if v is None else f"{v * 1000:.0f}ms"
+    return (f"{name}: {report['calls']} calls, {report['failures']} failed ({report['failure_rate']:.1%}), "
+            f"{report['throttles']} throttled, {report['retries']} retries, {report['hedged']} hedged "
+            f"({report['hedge_wins']} won), {report['prompt_tokens']}+{report['completion_tokens']} tokens, "
+            f"p50 {ms(report['p50'])}, p95 {ms(report['p95'])}, p99 {ms(report['p99'])}")
+
+
+
+
+def test_retry():
+    errors = [ThrottledError("slow down"), RetryableError("503"), None]
+    delays = []
+
+    def flaky():
+        e = errors.pop(0)
+        if e:
+            raise e
+        return 'ok'
+
+    policy = RetryPolicy(attempts=3, base_delay=0.01, sleep=delays.append)
+    assert policy.call(flaky) == 'ok'
+    assert len(delays) == 2
+    report = policy.stats.report()
+    assert report['retries'] == 2 and report['throttles'] == 1 and report['failures'] == 0
+
+    # Non-retryable errors are raised immediately.
+    policy = RetryPolicy(attempts=3, sleep=delays.append)
+    try:
+        policy.call(lambda: 1 / 0)
+        assert False
+    except ZeroDivisionError:
+        pass
+    assert policy.stats.report()['failure_rate'] == 1.0
+
+    # A call that outlives its deadline is abandoned.
+    policy = RetryPolicy(attempts=1, deadline=0.05)
+    try:
+        policy.call(lambda: time.sleep(1))
+        assert False
+    except DeadlineExceeded:
+        pass
+
+    # The backend sees how long it may take, and requests that hang do not hold up the calls after them.
+    policy = RetryPolicy(attempts=1, deadline=0.5)
+    assert 0 < policy.call(policy.time_left) <= 0.5
+    assert policy.time_left() is None
+    hung = RetryPolicy(attempts=1, deadline=0.02)
+    for _ in range(10):
+        try:
+            hung.call(lambda: time.sleep(0.5))
+        except DeadlineExceeded:
+            pass
+    start = time.monotonic()
+    assert hung.call(lambda: 'ok') == 'ok' and time.monotonic() - start < 0.1
+
+
+def test_hedge():
+    latencies = [1.0, 0.01]
+
+    def slow_then_fast():
+        time.sleep(latencies.pop(0))
+        return 'done'
+
+    policy = RetryPolicy(hedge_percentile=50, hedge_min_samples=3)
+    for i in range(3):
+        policy.stats.record(0.02)
+    start = time.monotonic()
+    assert policy.call(slow_then_fast) == 'done'
+    assert time.monotonic() - start < 0.5
+    report = policy.stats.report()
+    assert report['hedged'] == 1 and report['hedge_wins'] == 1
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 99) == 99
+    assert percentile([], 50) is None
+
+
+if __name__ == "__main__":
+    test_percentile()
+    test_retry()
+    test_hedge()
@@ -0,0 +1,153 @@
+import os
+import json
+import hashlib
+from lib.tools import readJson, writeJson
+from lib.journal import replace_file
+
+
+
+
+def normalize_path(filepath):
+    "The key a file is indexed under: absolute, forward slashes, and case-folded where the OS ignores case."
+    return os.path.normcase(os.path.abspath(filepath)).replace('\\', '/')
+
+
+def file_hash(filepath):
+    h = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def prompt_key(job, prompt):
+    "Identifies a prompt by its content, so editing a prompt or adding a new one makes it run again."
+    h = hashlib.md5()
+    h.update(job.get('system_prompt', '').encode('utf-8'))
+    h.update(b'\0')
+    h.update(prompt.get('prompt', '').encode('utf-8'))
+    h.update(b'\0')
+    h.update(json.dumps(prompt.get('schema'), sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+
+
+
+class SkipIndex:
+    """
+    Which (file, prompt) pairs a job has already answered, keyed by normalized path.
+
+    Each entry remembers the file's content hash; when the file changes, all of its prompts run again.
+    The mtime and size are kept too, so unchanged files are not re-read to compute their hash.
+
+    The index is saved as a JSON snapshot next to the job target. The journal is the source of truth:
+    load() folds the journal's records into the snapshot, so work done after the last save is not lost.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+
+    def load(self, records=()):
+        if os.path.exists(self.path):
+            try:
+                self.entries = readJson(self.path).get('files', {})
+            except Exception as e:
+                print(f"  Rebuilding unreadable index {self.path}: {e}")
+                self.entries = {}
+        for record in records:
+            self.fold(record)
+        return self
+
+    def save(self):
+        if self.dirty:
+            replace_file(self.path, lambda fn: writeJson(fn, {'files': self.entries}, pretty=False))
+            self.dirty = False
+
+    def fold(self, record):
+        "Account for one journal record. Records carried over from older runs list several prompt keys."
+        filepath = record.get('filepath')
+        if not filepath:
+            return
+        keys = record.get('keys') or ([record['key']] if record.get('key') else [])
+        for key in keys:
+            self.mark(filepath, record.get('hash'), key)
+
+    def hash(self, filepath):
+        "The file's content hash, reusing the stored one when mtime and size have not changed."
+        st = os.stat(filepath)
+        entry = self.entries.get(normalize_path(filepath))
+        if entry and entry.get('hash') and entry.get('mtime') == st.st_mtime and entry.get('size') == st.st_size:
+            return entry['hash']
+        h = file_hash(filepath)
+        if entry and entry.get('hash') == h:
+            entry['mtime'] = st.st_mtime
+            entry['size'] = st.st_size
+            self.dirty = True
+        return h
+
+    def is_done(self, filepath, content_hash, key):
+        entry = self.entries.get(normalize_path(filepath))
+        if not entry:
+            return False
+        return entry['hash'] == content_hash and key in entry['prompts']
+
+    def mark(self, filepath, content_hash, key):
+        path = normalize_path(filepath)
+        entry = self.entries.get(path)
+        if not entry or entry['hash'] != content_hash:
+            entry = {'hash': content_hash, 'prompts': {}}
+            if os.path.exists(filepath):
+                st = os.stat(filepath)
+                entry['mtime'] = st.st_mtime
+                entry['size'] = st.st_size
+            self.entries[path] = entry
+        entry['prompts'][key] = True
+        self.dirty = True
+
+
+
+
+def test_skipindex():
+    import shutil
+    import tempfile
+    dir = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(dir, 'resume.txt')
+        with open(fn, 'w') as f:
+            f.write('version 1')
+        job = {'system_prompt': 'GIVEN: {{GIVEN}}'}
+        a = prompt_key(job, {'prompt': 'summarize'})
+        b = prompt_key(job, {'prompt': 'list skills'})
+
+        index = SkipIndex(os.path.join(dir, 'index.json'))
+        h = index.hash(fn)
+        assert not index.is_done(fn, h, a)
+        index.mark(fn, h, a)
+        assert index.is_done(fn, h, a)
+        assert index.is_done(fn.replace('/', os.sep), h, a)
+        assert not index.is_done(fn, h, b)
+        index.save()
+
+        # A changed file runs every prompt again.
+        with open(fn, 'w') as f:
+            f.write('version 2, longer')
+        index = SkipIndex(index.path).load()
+        h2 = index.hash(fn)
+        assert h2 != h and not index.is_done(fn, h2, a)
+
+        # Work recorded in the journal but not yet saved in the index still counts.
+        index = SkipIndex(index.path).load([{'filepath': fn, 'key': b, 'hash': h2, 'answer': {}}])
+        assert index.is_done(fn, h2, b)
+
+        # Results carried over from an older run cover the prompts they list.
+        index = SkipIndex(os.path.join(dir, 'legacy.json')).load([{'filepath': fn, 'keys': [a, b], 'hash': h2, 'answer': {}}])
+        assert index.is_done(fn, h2, a) and index.is_done(fn, h2, b)
+        assert not index.is_done(fn, 'changed', a)
+    finally:
+        shutil.rmtree(dir)
+
+
+if __name__ == "__main__":
+    test_skipindex()
@@ -1,6 +1,3 @@
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-
-
 class Splitter:
     def __init__(self):
         pass
@@ -12,6 +9,8 @@ class RecursiveCharacterText_Splitter(Splitter):
     def __init__(self, chunk_size=1000, chunk_overlap=200):
         """Grok: What is a good chunk size and overlap for a RAG system?"""
         super().__init__()
+        # langchain takes longer to import than everything else here, so only when a splitter is made.
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
         self.text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=chunk_size,
             chunk_overlap=chunk_overlap,
@@ -0,0 +1,392 @@
+import io
+import os
+import sys
+import json
+import math
+import time
+import random
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.modelstack import sample_value
+
+
+# Stand-ins for Ollama and Bedrock, so load, retry and scheduling code can be tested and benchmarked
+# without a GPU box or an AWS account.
+#
+#   with StandInServer({'latency': {'distribution': 'lognormal', 'median': 0.2, 'sigma': 0.5},
+#                       'tokens_per_sec': 50, 'throttle_rate': 0.05}) as server:
+#       stack = ModelStack.from_config({'class': 'ollama', 'host': server.url, 'model': 'granite3.2:2b'})
+#
+#   stack = ModelStack.from_config({'class': 'bedrock', 'model': 'm'})
+#   stack.client = FakeBedrockClient({'latency': 0.1, 'error_rate': 0.01})
+#
+# Config (all optional):
+#   latency             seconds before the first token: a number, or {distribution: fixed|uniform|lognormal|exponential, ...}
+#   prompt_tokens_per_sec   prompt reading speed, added to the latency (default: instant)
+#   tokens_per_sec      generation speed (default 100)
+#   completion_tokens   answer length in tokens (default 50), capped by the request's max_tokens
+#   response            'lorem' (default), 'echo' to answer with the prompt, or any other text to answer with
+#   error_rate          share of requests that fail with a server error (500 / InternalServerException)
+#   throttle_rate       share of requests that are throttled (429 / ThrottlingException)
+#   parallel            requests served at once, like OLLAMA_NUM_PARALLEL; the rest wait (default: no limit)
+#   models              models reported by /api/ps and /api/tags
+#   embedding_dim       length of /api/embed vectors (default 384)
+#   time_scale          multiplies every delay, e.g. 0 for tests that only check behaviour
+#   seed                the same seed, prompt and repetition always get the same latency, length and failure
+#
+# Token counts are estimated at 4 characters per token.
+
+CHARS_PER_TOKEN = 4
+LOREM = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et dolore magna aliqua".split()
+
+
+
+
+def draw_latency(spec, rng):
+    "Seconds from a latency spec: a number or {distribution: ..., ...}."
+    if spec is None:
+        return 0.0
+    if isinstance(spec, (int, float)):
+        return float(spec)
+    d = spec.get('distribution', 'fixed')
+    if d == 'fixed':
+        return float(spec.get('seconds', 0))
+    if d == 'uniform':
+        return rng.uniform(float(spec.get('min', 0)), float(spec['max']))
+    if d == 'lognormal':
+        return rng.lognormvariate(math.log(float(spec['median'])), float(spec.get('sigma', 0.5)))
+    if d == 'exponential':
+        return rng.expovariate(1 / float(spec['mean']))
+    raise ValueError(f"Unsupported latency distribution: {d}")
+
+
+def count_tokens(text):
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+
+
+class Behaviour:
+    "Decides how each request goes: its delay, length, answer and whether it fails."
+
+    def __init__(self, config=None):
+        self.config = config or {}
+        self.seed = self.config.get('seed', 0)
+        self.time_scale = float(self.config.get('time_scale', 1))
+        self.seen = {}
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'errors': 0, 'throttled': 0, 'in_flight': 0, 'max_in_flight': 0}
+        parallel = self.config.get('parallel')
+        self.slots = threading.Semaphore(int(parallel)) if parallel else None
+
+    def rng(self, prompt):
+        "A random generator for this prompt and repetition, so results do not depend on request order."
+        h = hashlib.md5(prompt.encode('utf-8')).hexdigest()
+        with self.lock:
+            n = self.seen.get(h, 0)
+            self.seen[h] = n + 1
+        return random.Random(f"{self.seed}:{h}:{n}")
+
+    def plan(self, prompt, max_tokens=None):
+        "{'status': 200, 429 or 500, 'delay': seconds to first token, 'completion_tokens', 'token_seconds'}"
+        rng = self.rng(prompt)
+        c = self.config
+        with self.lock:
+            self.stats['requests'] += 1
+        r = rng.random()
+        status = 200
+        if r < float(c.get('throttle_rate', 0)):
+            status = 429
+        elif r < float(c.get('throttle_rate', 0)) + float(c.get('error_rate', 0)):
+            status = 500
+        delay = draw_latency(c.get('latency'), rng)
+        if c.get('prompt_tokens_per_sec'):
+            delay += count_tokens(prompt) / float(c['prompt_tokens_per_sec'])
+        tokens = int(c.get('completion_tokens', 50))
+        if max_tokens:
+            tokens = min(tokens, int(max_tokens))
+        return {
+            'status': status,
+            'delay': delay * self.time_scale,
+            'completion_tokens': tokens,
+            'token_seconds': self.time_scale / float(c.get('tokens_per_sec', 100)),
+            'prompt_tokens': count_tokens(prompt),
+        }
+
+    def tokens(self, prompt, n, schema=None):
+        "The answer as a list of @n tokens (pieces of text that join into it)."
+        if schema:
+            return [json.dumps(sample_value(schema))]
+        response = self.config.get('response', 'lorem')
+        if response == 'echo':
+            text = prompt
+        elif response == 'lorem':
+            return [('' if i == 0 else ' ') + LOREM[i % len(LOREM)] for i in range(n)]
+        else:
+            text = response
+        size = max(1, math.ceil(len(text) / max(1, n)))
+        return [text[i:i + size] for i in range(0, len(text), size)] or ['']
+
+    def serve(self, plan, work):
+        "Hold a parallel slot (if limited) and count in-flight requests while @work runs."
+        if self.slots:
+            self.slots.acquire()
+        with self.lock:
+            self.stats['in_flight'] += 1
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.stats['in_flight'])
+        try:
+            return work()
+        finally:
+            with self.lock:
+                self.stats['in_flight'] -= 1
+            if self.slots:
+                self.slots.release()
+
+    def fail(self, status):
+        with self.lock:
+            self.stats['throttled' if status == 429 else 'errors'] += 1
+
+    def embedding(self, text):
+        "A deterministic unit vector for @text."
+        dim = int(self.config.get('embedding_dim', 384))
+        rng = random.Random(hashlib.md5(text.encode('utf-8')).hexdigest())
+        v = [rng.gauss(0, 1) for _ in range(dim)]
+        norm = math.sqrt(sum(x * x for x in v)) or 1
+        return [x / norm for x in v]
+
+
+
+
+def prompt_of(path, payload):
+    if path == '/api/chat':
+        return '\n'.join(m.get('content', '') for m in payload.get('messages') or [])
+    return payload.get('prompt', '')
+
+
+def ollama_max_tokens(payload):
+    options = payload.get('options') or {}
+    return options.get('num_predict') or payload.get('max_tokens')
+
+
+class OllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, o):
+        body = json.dumps(o).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        models = [{'name': m, 'model': m} for m in self.server.behaviour.config.get('models', [])]
+        if self.path in ['/api/ps', '/api/tags']:
+            self.reply(200, {'models': models})
+        else:
+            self.reply(404, {'error': f"unknown path {self.path}"})
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        behaviour = self.server.behaviour
+        if self.path == '/api/embed':
+            inputs = payload.get('input')
+            inputs = [inputs] if isinstance(inputs, str) else inputs or []
+            return self.reply(200, {'model': payload.get('model'), 'embeddings': [behaviour.embedding(t) for t in inputs]})
+        if self.path not in ['/api/generate', '/api/chat']:
+            return self.reply(404, {'error': f"unknown path {self.path}"})
+        prompt = prompt_of(self.path, payload)
+        plan = behaviour.plan(prompt, ollama_max_tokens(payload))
+        behaviour.serve(plan, lambda: self.generate(payload, prompt, plan))
+
+    def generate(self, payload, prompt, plan):
+        behaviour = self.server.behaviour
+        time.sleep(plan['delay'])
+        if plan['status'] != 200:
+            behaviour.fail(plan['status'])
+            message = 'server busy, too many requests' if plan['status'] == 429 else 'stand-in server error'
+            return self.reply(plan['status'], {'error': message})
+        tokens = behaviour.tokens(prompt, plan['completion_tokens'], payload.get('format') if isinstance(payload.get('format'), dict) else None)
+        chat = self.path == '/api/chat'
+        done = {
+            'model': payload.get('model'),
+            'done': True,
+            'done_reason': 'stop',
+            'prompt_eval_count': plan['prompt_tokens'],
+            'eval_count': plan['completion_tokens'],
+        }
+        if payload.get('stream', True) is False:
+            time.sleep(plan['token_seconds'] * plan['completion_tokens'])
+            text = ''.join(tokens)
+            return self.reply(200, dict(done, **({'message': {'role': 'assistant', 'content': text}} if chat else {'response': text})))
+
+        # Streaming: one JSON object per line and token, then a final one with the counts.
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        per_token = plan['token_seconds'] * plan['completion_tokens'] / max(1, len(tokens))
+        for token in tokens:
+            time.sleep(per_token)
+            part = {'model': payload.get('model'), 'done': False}
+            part.update({'message': {'role': 'assistant', 'content': token}} if chat else {'response': token})
+            self.write_chunk(part)
+        self.write_chunk(dict(done, **({'message': {'role': 'assistant', 'content': ''}} if chat else {'response': ''})))
+        self.wfile.write(b'0\r\n\r\n')
+
+    def write_chunk(self, o):
+        data = json.dumps(o).encode() + b'\n'
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b'\r\n')
+        self.wfile.flush()
+
+
+
+
+class StandInServer:
+    "An Ollama stand-in on a local port (0: any free port). Use as a context manager, or start() and stop()."
+
+    def __init__(self, config=None, host='127.0.0.1', port=0):
+        self.behaviour = Behaviour(config)
+        self.server = ThreadingHTTPServer((host, port), OllamaHandler)
+        self.server.daemon_threads = True
+        self.server.behaviour = self.behaviour
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def stats(self):
+        return dict(self.behaviour.stats)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+
+
+class FakeBedrockClient:
+    """
+    Stands in for boto3's bedrock-runtime client in a BedrockModelStack (set stack.client). invoke_model answers
+    in the Anthropic messages format, with tool use for schemas; failures raise botocore ClientErrors.
+    """
+
+    def __init__(self, config=None):
+        self.behaviour = Behaviour(config)
+
+    @property
+    def stats(self):
+        return dict(self.behaviour.stats)
+
+    def invoke_model(self, modelId, body, contentType='application/json', accept='application/json'):
+        params = json.loads(body)
+        system = ''.join(s.get('text', '') for s in params.get('system') or [])
+        prompt = system + ''.join(m['content'] if isinstance(m['content'], str) else json.dumps(m['content']) for m in params.get('messages') or [])
+        plan = self.behaviour.plan(prompt, params.get('max_tokens'))
+        return self.behaviour.serve(plan, lambda: self.respond(params, prompt, plan))
+
+    def respond(self, params, prompt, plan):
+        time.sleep(plan['delay'])
+        if plan['status'] != 200:
+            self.behaviour.fail(plan['status'])
+            from botocore.exceptions import ClientError
+            code = 'ThrottlingException' if plan['status'] == 429 else 'InternalServerException'
+            raise ClientError({'Error': {'Code': code, 'Message': 'stand-in failure'}}, 'InvokeModel')
+        time.sleep(plan['token_seconds'] * plan['completion_tokens'])
+        tools = params.get('tools') or []
+        if tools:
+            content = [{'type': 'tool_use', 'name': tools[0]['name'], 'input': sample_value(tools[0]['input_schema'])}]
+        else:
+            content = [{'type': 'text', 'text': ''.join(self.behaviour.tokens(prompt, plan['completion_tokens']))}]
+        usage = {'input_tokens': plan['prompt_tokens'], 'output_tokens': plan['completion_tokens']}
+        return {'body': io.BytesIO(json.dumps({'content': content, 'usage': usage, 'stop_reason': 'end_turn'}).encode())}
+
+
+
+
+def test_standin():
+    import requests
+    from lib.modelstack import ModelStack
+    config = {'latency': 0.01, 'tokens_per_sec': 10000, 'completion_tokens': 5, 'models': ['m'], 'seed': 7}
+    with StandInServer(config) as server:
+        stack = ModelStack.from_config({'class': 'ollama', 'host': server.url, 'model': 'm'})
+        usage = {}
+        assert stack.query("Why?", usage=usage) == "lorem ipsum dolor sit amet"
+        assert usage == {'prompt_tokens': 1, 'completion_tokens': 5}
+        stack = ModelStack.from_config({'class': 'ollama', 'host': server.url, 'model': 'm', 'session': True})
+        assert stack.query("Why?", prefix="GIVEN: x", schema={'type': 'object', 'properties': {'n': {'type': 'integer'}}}) == {'n': 0}
+
+        # Streaming, as Ollama does by default.
+        r = requests.post(f"{server.url}/api/generate", json={'model': 'm', 'prompt': 'Hi'}, stream=True)
+        parts = [json.loads(line) for line in r.iter_lines() if line]
+        assert ''.join(p['response'] for p in parts) == "lorem ipsum dolor sit amet" and parts[-1]['done']
+
+        r = requests.post(f"{server.url}/api/embed", json={'model': 'm', 'input': ['a', 'b']}).json()
+        assert len(r['embeddings']) == 2 and len(r['embeddings'][0]) == 384
+        assert requests.get(f"{server.url}/api/ps").json()['models'][0]['name'] == 'm'
+
+    # Throttling and errors are retried by the stack; the same seed fails the same requests.
+    config = {'time_scale': 0, 'throttle_rate': 0.2, 'error_rate': 0.1, 'response': 'echo', 'seed': 1}
+    retry = {'attempts': 10, 'base_delay': 0, 'throttle_delay': 0}
+    counts = []
+    for _ in range(2):
+        with StandInServer(config) as server:
+            stack = ModelStack.from_config({'class': 'ollama', 'host': server.url, 'model': 'm', 'retry': retry})
+            assert [stack.query(f"prompt {i}") for i in range(20)] == [f"prompt {i}" for i in range(20)]
+            counts.append(server.stats)
+    assert counts[0] == counts[1] and counts[0]['throttled'] + counts[0]['errors'] > 0
+
+    # Only 'parallel' requests are served at once.
+    from concurrent.futures import ThreadPoolExecutor
+    with StandInServer({'latency': 0.05, 'parallel': 2}) as server:
+        stack = ModelStack.from_config({'class': 'ollama', 'host': server.url, 'model': 'm'})
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            list(pool.map(stack.query, [f"p{i}" for i in range(6)]))
+        assert server.stats['max_in_flight'] == 2
+
+    # A call's deadline is also its request's timeout, so an abandoned request does not hold a thread.
+    from lib.retry import DeadlineExceeded
+    with StandInServer({'latency': 2}) as server:
+        stack = ModelStack.from_config({'class': 'ollama', 'host': server.url, 'model': 'm', 'retry': {'attempts': 1, 'deadline': 0.2}})
+        try:
+            stack.query("Hang")
+            assert False
+        except DeadlineExceeded:
+            pass
+        time.sleep(0.3)
+        assert not [t for t in threading.enumerate() if t.name.startswith('retry')]
+
+    stack = ModelStack.from_config({'class': 'bedrock', 'model': 'm', 'retry': retry})
+    stack.client = FakeBedrockClient({'time_scale': 0, 'throttle_rate': 0.3, 'response': 'Paris.', 'seed': 3})
+    assert [stack.query("Capital of France?") for _ in range(5)] == ["Paris."] * 5
+    assert stack.query("List.", schema={'type': 'array', 'items': {'type': 'string'}}) == ['stub']
+    assert stack.client.stats['throttled'] > 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        # python lib/standin.py 11434 '{"latency": {"distribution": "lognormal", "median": 0.5}, "tokens_per_sec": 40}'
+        server = StandInServer(json.loads(sys.argv[2]) if len(sys.argv) > 2 else {}, port=int(sys.argv[1]))
+        print(f"Ollama stand-in listening on {server.url}")
+        server.server.serve_forever()
+    else:
+        test_standin()
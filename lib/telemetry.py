@@ -0,0 +1,165 @@
+import time
+import threading
+from lib.journal import Journal
+from lib.retry import percentile
+
+
+# Per-task timings and token counts for long jobs, so a run shows whether extraction, the model or
+# writing results is the bottleneck.
+#
+# A task is one file of a job. Its stages fill in a metrics dict as the file moves through them:
+#
+#   {'filepath': 'a.docx', 'extract': 0.41, 'render': 0.002, 'parse': 0.01, 'write': 0.001,
+#    'calls': [{'backend': 'granite3.2:2b', 'seconds': 8.2, 'prompt_tokens': 2100, 'completion_tokens': 380}]}
+#
+# Telemetry.record() appends it to a JSON Lines metrics file and keeps it for the end-of-run summary.
+
+STAGES = ['extract', 'render', 'llm', 'parse', 'write']
+
+
+
+
+class Timer:
+    """
+    with Timer(metrics, 'extract'):
+        text = get_text(filepath)
+    """
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics[self.name] = self.metrics.get(self.name, 0.0) + time.perf_counter() - self.start
+
+
+def task_total(task):
+    "Seconds spent on the task in all stages, not counting time spent waiting for a worker."
+    return sum(task.get(stage, 0.0) for stage in STAGES if stage != 'llm') + sum(c['seconds'] for c in task.get('calls', []))
+
+
+
+
+class Telemetry:
+    def __init__(self, path=None, slowest=5):
+        self.journal = Journal(path) if path else None
+        self.slowest = slowest
+        self.tasks = []
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+
+    def record(self, task):
+        task = dict(task, total=round(task_total(task), 6))
+        with self.lock:
+            self.tasks.append(task)
+            if self.journal:
+                self.journal.append(task)
+
+    def summary(self):
+        with self.lock:
+            tasks = list(self.tasks)
+        seconds = time.monotonic() - self.start
+        calls = [c for task in tasks for c in task.get('calls', [])]
+        prompt_tokens = sum(c.get('prompt_tokens', 0) for c in calls)
+        completion_tokens = sum(c.get('completion_tokens', 0) for c in calls)
+        stages = {stage: 0.0 for stage in STAGES}
+        for task in tasks:
+            for stage in STAGES:
+                stages[stage] += task.get(stage, 0.0)
+            stages['llm'] += sum(c['seconds'] for c in task.get('calls', []))
+        backends = {}
+        for c in calls:
+            if c.get('cached'):
+                # Not a call to the backend, so not part of its latency.
+                continue
+            backends.setdefault(c.get('backend', '?'), []).append(c)
+        return {
+            'files': len(tasks),
+            'seconds': seconds,
+            'files_per_min': 60 * len(tasks) / seconds if seconds else 0.0,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            # Answers from the memoize cache (see ModelStack.memoize) spent no tokens.
+            'cached_calls': sum(1 for c in calls if c.get('cached')),
+            'tokens_per_sec': (prompt_tokens + completion_tokens) / seconds if seconds else 0.0,
+            'completion_tokens_per_sec': completion_tokens / seconds if seconds else 0.0,
+            # Busy time per stage, summed over workers; the largest one is the bottleneck.
+            'stages': stages,
+            'backends': {
+                name: {
+                    'calls': len(cs),
+                    'p50': percentile([c['seconds'] for c in cs], 50),
+                    'p95': percentile([c['seconds'] for c in cs], 95),
+                    'p99': percentile([c['seconds'] for c in cs], 99),
+                    'completion_tokens_per_sec': sum(c.get('completion_tokens', 0) for c in cs) / (sum(c['seconds'] for c in cs) or 1),
+                } for name, cs in backends.items()
+            },
+            'slowest': [(task['filepath'], task['total']) for task in sorted(tasks, key=lambda t: -t['total'])[:self.slowest]],
+        }
+
+    def close(self):
+        "Append the run's summary to the metrics file and return it."
+        summary = self.summary()
+        if self.journal:
+            self.journal.append({'summary': summary})
+            self.journal.close()
+        return summary
+
+
+
+
+def format_summary(summary):
+    def s(v):
+        return '-' if v is None else f"{v:.2f}s"
+    lines = [
+        f"{summary['files']} files in {summary['seconds']:.1f}s ({summary['files_per_min']:.1f} files/min), "
+        f"{summary['prompt_tokens']}+{summary['completion_tokens']} tokens ({summary['tokens_per_sec']:.1f} tokens/s, "
+        f"{summary['completion_tokens_per_sec']:.1f} generated/s)",
+        "Busy time: " + ', '.join(f"{stage} {s(v)}" for stage, v in summary['stages'].items()),
+    ]
+    if summary.get('cached_calls'):
+        lines.append(f"{summary['cached_calls']} answers came from the cache and are counted as 0 tokens")
+    for name, b in summary['backends'].items():
+        lines.append(f"{name}: {b['calls']} calls, p50 {s(b['p50'])}, p95 {s(b['p95'])}, p99 {s(b['p99'])}, "
+                     f"{b['completion_tokens_per_sec']:.1f} generated tokens/s while busy")
+    if summary['slowest']:
+        lines.append("Slowest files:")
+        lines.extend(f"  {s(seconds)}  {filepath}" for filepath, seconds in summary['slowest'])
+    return '\n'.join(lines)
+
+
+
+
+def test_telemetry():
+    import os
+    from lib.tools import getNewTemporaryFilePath
+    path = getNewTemporaryFilePath('metrics', '.jsonl')
+    telemetry = Telemetry(path, slowest=2)
+    for i in range(10):
+        task = {'filepath': f"{i}.docx", 'calls': [{'backend': 'm', 'seconds': 0.1 * (i + 1), 'prompt_tokens': 100, 'completion_tokens': 10}]}
+        if i == 9:
+            task['calls'].append({'backend': 'm', 'seconds': 0.0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cached': True})
+        with Timer(task, 'extract'):
+            pass
+        task['write'] = 0.8 if i == 3 else 0.0
+        telemetry.record(task)
+    summary = telemetry.close()
+    assert summary['files'] == 10
+    assert summary['prompt_tokens'] == 1000 and summary['completion_tokens'] == 100 and summary['cached_calls'] == 1
+    assert summary['backends']['m']['calls'] == 10
+    assert abs(summary['backends']['m']['p50'] - 0.5) < 1e-9
+    assert abs(summary['backends']['m']['p99'] - 1.0) < 1e-9
+    assert [f for f, _ in summary['slowest']] == ['3.docx', '9.docx']
+    assert 'Slowest files:' in format_summary(summary)
+
+    records = list(Journal(path).read())
+    assert len(records) == 11 and records[-1]['summary']['files'] == 10
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    test_telemetry()
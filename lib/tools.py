@@ -3,10 +3,22 @@ import json
 import io
 import re
 import os
+import threading
 import csv
 import yaml
 from yaml.representer import SafeRepresenter
-from ruamel.yaml import YAML
+
+# libyaml's C loader and emitter, when PyYAML was built with it. Same results, several times faster.
+try:
+    from yaml import CSafeLoader as FastLoader, CSafeDumper as FastDumper
+except ImportError:
+    from yaml import SafeLoader as FastLoader, SafeDumper as FastDumper
+
+# orjson reads and writes compact JSON much faster than the json module; it is optional.
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 
@@ -31,7 +43,8 @@ def from_metric(s):
 
 class DateTimeEncoder(json.JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, datetime.datetime):
+        # datetime.datetime is a datetime.date too. YAML answers hold plain dates, e.g. 'start: 2019-01-15'.
+        if isinstance(obj, (datetime.date, datetime.time)):
             return obj.isoformat()
         return super(DateTimeEncoder, self).default(obj)
 
@@ -47,26 +60,66 @@ def smart_str_representer(dumper, data):
     # Otherwise use plain style but allow folding if it's medium length
     return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='')
 
-class PrettyDumper(yaml.SafeDumper):
+# The smart representer runs in Python and the text is emitted by FastDumper. libyaml escapes two kinds of
+# characters that the pure-Python emitter writes as they are: NEL (U+0085) becomes "\N" and characters outside
+# the Basic Multilingual Plane (emoji) become "\U0001F600". Data holding them is written by SlowPrettyDumper,
+# so people still read the characters themselves.
+class PrettyDumper(FastDumper):
     pass
 
 PrettyDumper.add_representer(str, smart_str_representer)
 
 
+class SlowPrettyDumper(yaml.SafeDumper):
+    pass
+
+SlowPrettyDumper.add_representer(str, smart_str_representer)
+
+
+LIBYAML_ESCAPES = re.compile('[\x85\U00010000-\U0010FFFF]')
+
+
+def pretty_dumper(data):
+    "The dumper for writeYaml(pretty=True): the fast one unless libyaml would escape some of @data's text."
+    if FastDumper is yaml.SafeDumper:
+        return PrettyDumper
+    try:
+        # One pass in C over all the keys and strings, much cheaper than walking the data in Python.
+        text = json.dumps(data, ensure_ascii=False, cls=DateTimeEncoder)
+    except (TypeError, ValueError):
+        return SlowPrettyDumper
+    return SlowPrettyDumper if LIBYAML_ESCAPES.search(text) else PrettyDumper
+
+
 
 def readJson(file):
+    if orjson:
+        with open(file, "rb") as f:
+            return orjson.loads(f.read())
     with open(file) as f:
         return json.load(f)
 
-def writeJson(file, data):
+def writeJson(file, data, pretty=True):
+    """
+    @pretty writes indented JSON for people to read. pretty=False writes compact JSON, with orjson when
+    it is installed, for state files that only programs read.
+    """
+    if not pretty and orjson:
+        with open(file, "wb") as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS))
+        return
     with open(file, "w") as f:
-        json.dump(data, f, indent=2, cls=DateTimeEncoder)
+        if pretty:
+            json.dump(data, f, indent=2, cls=DateTimeEncoder)
+        else:
+            json.dump(data, f, separators=(',', ':'), cls=DateTimeEncoder)
 
 def readYaml(file):
     with open(file) as f:
-        return yaml.safe_load(f)
+        return yaml.load(f, Loader=FastLoader)
 
-def writeYaml(file, data):
+def writeYaml(file, data, pretty=True):
+    "@pretty picks block or plain string styles for readability. pretty=False is a little faster, for files only programs read."
     with open(file, "w") as f:
         yaml.dump(
             data,
@@ -75,7 +128,7 @@ def writeYaml(file, data):
             default_flow_style=False,
             allow_unicode=True,
             width=4096,
-            Dumper=PrettyDumper,
+            Dumper=pretty_dumper(data) if pretty else FastDumper,
             sort_keys=False
         )
 
@@ -211,6 +264,7 @@ def getYaml(relPath):
     if not relPath.endswith('.yaml'):
         relPath += '.yaml'
     path = findPath(relPath)    
+    from ruamel.yaml import YAML
     yaml = YAML()
     with open(path) as f:
         o = yaml.load(f)
@@ -353,56 +407,80 @@ def get_filename(key):
 
 
 def get_file(key):
+    return read_file(get_filename(key))
+
+
+def read_file(fn):
+    "The content of @fn, parsed if it is .json, or None if it is missing or unreadable."
+    if not os.path.exists(fn):
+        return None
     try:
-        fn = get_filename(key)
-        if os.path.exists(fn):
-            with open(fn, 'r', encoding='utf-8') as f:
-                if fn.endswith('.json'):
-                    return json.load(f)
-                else:
-                    return f.read()
+        with open(fn, 'r', encoding='utf-8') as f:
+            if fn.endswith('.json'):
+                return json.load(f)
+            else:
+                return f.read()
     except Exception as e:
-        pass
+        print(f"  Could not read {fn}: {e}")
     return None
 
 
 def put_file(key, data):
+    "Write to a temporary file and rename it over @key, so readers never see a half-written file."
     if isinstance(data, bytes):
         mode = "wb"
     else:
         mode = "w"
     fn = get_filename(key)
-    with open(fn, mode) as f:
+    tmp = f"{fn}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, mode, **({} if mode == "wb" else {'encoding': 'utf-8'})) as f:
         if fn.endswith('.json'):
             json.dump(data, f, indent=4, cls=DateTimeEncoder)
         else:
             f.write(data or '')
+    os.replace(tmp, fn)
 
 
-def get_cache(key):
+def get_cache(key, namespace='default', cache=None):
+    """
+    Read @key from the SQLite cache (lib/cache.py; @cache defaults to data/cache/cache.sqlite). Entries
+    written by older versions as files in the cache's folder are read once and moved into it, into
+    whichever @namespace now asks for them: those files had no namespace.
+    """
+    from lib.cache import default_cache
     if not '.' in key:
         key += '.json'
-    return get_file(f"data/cache/{key}")
+    cache = cache or default_cache()
+    data = cache.get(key, namespace=namespace)
+    if data is None:
+        data = read_file(os.path.join(os.path.dirname(cache.path), key))
+        if data is not None:
+            cache.put(key, data, namespace=namespace)
+    return data
 
 
-def put_cache(key, data):
+def put_cache(key, data, namespace='default', ttl=None, cache=None):
+    from lib.cache import default_cache
     if not '.' in key:
         key += '.json'
-    put_file(f"data/cache/{key}", data)
+    (cache or default_cache()).put(key, data, namespace=namespace, ttl=ttl)
 
 
 def cacheGet(fn, func, verbose=True):
     """
     Get the data from the cache if it exists, otherwise call the function to get the data.
+    Empty results are cached too; only a missing entry calls @func. See lib/memo.py for a decorator.
     """
     j = get_cache(fn)
-    if j:
-        print(f"  Cache hit: {fn}")
+    if j is not None:
+        if verbose:
+            print(f"  Cache hit: {fn}")
     else:
-        print(f"  Cache miss: {fn}")
+        if verbose:
+            print(f"  Cache miss: {fn}")
         j = func()
         put_cache(fn, j)
-    if not j:
+    if j is None and verbose:
         print(f"  Error: {fn}")
     return j
 
@@ -726,5 +804,38 @@ def test_getNewTemporaryFilePath():
     os.remove(fn)
 
 
+def test_cache():
+    import shutil
+    import tempfile
+    from lib.cache import Cache
+    dir = tempfile.mkdtemp()
+    try:
+        cache = Cache(os.path.join(dir, 'cache.sqlite'))
+        assert get_cache('zycache', namespace='test', cache=cache) is None
+        put_cache('zycache', {'a': [1, 2]}, namespace='test', cache=cache)
+        assert get_cache('zycache', namespace='test', cache=cache) == {'a': [1, 2]}
+
+        # A file left by an older version is found from any namespace, e.g. make_rag's 'ingest'.
+        put_file(os.path.join(dir, 'legacy.json'), {'last_updated': 1})
+        assert get_cache('legacy', namespace='test', cache=cache) == {'last_updated': 1}
+        os.remove(os.path.join(dir, 'legacy.json'))
+        assert get_cache('legacy', namespace='test', cache=cache) == {'last_updated': 1}
+        cache.close()
+    finally:
+        shutil.rmtree(dir)
+
+
+def test_writeYaml():
+    fn = getNewTemporaryFilePath('pretty', '.yaml')
+    data = {'name': 'Rob 😀', 'plain': 'ASCII'}
+    writeYaml(fn, data)
+    text = readText(fn)
+    assert '😀' in text and '\\U' not in text
+    assert readYaml(fn) == data
+    os.remove(fn)
+
+
 if __name__ == "__main__":
-    test_getNewTemporaryFilePath()
\ No newline at end of file
+    test_getNewTemporaryFilePath()
+    test_cache()
+    test_writeYaml()
\ No newline at end of file
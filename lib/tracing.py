@@ -0,0 +1,374 @@
+import os
+import json
+import time
+import random
+import atexit
+import threading
+from lib.journal import Journal
+
+
+# Spans for finding where the time of a slow call went: collection.query, reranking, packing the context or
+# the LLM.
+#
+#   with span('vectordb.rerank', documents=len(documents)) as s:
+#       ...
+#       s.set(top_k=len(ranked))
+#
+#   @traced('corpus.get_text')
+#   def get_text(filepath): ...
+#
+# Spans nest per thread: a span opened inside another becomes its child and shares its trace id. Finished spans
+# go to the exporters added with add_exporter(), or set up from the environment when this module is imported:
+#
+#   TRACE_FILE=traces.jsonl                             one JSON object per span (JsonlExporter)
+#   OTEL_EXPORTER_OTLP_ENDPOINT=http://localhost:4318   OTLP/HTTP JSON, for Jaeger, Tempo or an OpenTelemetry collector
+#
+# With no exporters, span() returns one shared do-nothing span, so leaving the hooks in costs about a
+# function call.
+
+SERVICE = 'python-ollama-example'
+
+_exporters = []
+_local = threading.local()
+
+
+
+
+class Span:
+    __slots__ = ['name', 'trace_id', 'span_id', 'parent_id', 'attributes', 'start', 'end', 'error', 'parent', 'counter']
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.error = None
+        self.end = None
+
+    def set(self, **attributes):
+        "Add attributes known only once the work is done, e.g. how many chunks it produced."
+        self.attributes.update(attributes)
+        return self
+
+    def __enter__(self):
+        self.parent = getattr(_local, 'span', None)
+        if self.parent:
+            self.trace_id = self.parent.trace_id
+            self.parent_id = self.parent.span_id
+        else:
+            self.trace_id = f"{random.getrandbits(128):032x}"
+            self.parent_id = None
+        self.span_id = f"{random.getrandbits(64):016x}"
+        _local.span = self
+        self.start = time.time_ns()
+        self.counter = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.counter
+        self.end = self.start + int(seconds * 1e9)
+        if exc_type:
+            self.error = f"{exc_type.__name__}: {exc_value}"
+        _local.span = self.parent
+        self.parent = None
+        export(self)
+
+    @property
+    def seconds(self):
+        return (self.end - self.start) / 1e9
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start': self.start / 1e9,
+            'seconds': round(self.seconds, 6),
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+class NoSpan:
+    "What span() returns when tracing is off."
+
+    def set(self, **attributes):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+def span(name, **attributes):
+    "A span to use in a with statement; @attributes are recorded with it."
+    if not _exporters:
+        return NO_SPAN
+    return Span(name, attributes)
+
+
+def traced(name=None, attributes=None):
+    """
+    Decorator that runs each call in a span called @name (the function's name by default).
+    @attributes is an optional function of the call's arguments that returns the span's attributes.
+    """
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        def wrapper(*args, **kwargs):
+            if not _exporters:
+                return func(*args, **kwargs)
+            with Span(span_name, attributes(*args, **kwargs) if attributes else {}):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.__wrapped__ = func
+        return wrapper
+    return decorator
+
+
+def current_span():
+    "The innermost open span on this thread, or a do-nothing span."
+    return getattr(_local, 'span', None) or NO_SPAN
+
+
+
+
+def enabled():
+    return bool(_exporters)
+
+
+def add_exporter(exporter):
+    _exporters.append(exporter)
+    return exporter
+
+
+def remove_exporter(exporter):
+    "Stop sending spans to @exporter and flush what it has buffered."
+    if exporter in _exporters:
+        _exporters.remove(exporter)
+    try:
+        exporter.close()
+    except Exception as e:
+        print(f"  Tracing: {type(exporter).__name__} failed: {e}")
+
+
+def export(span):
+    for exporter in list(_exporters):
+        try:
+            exporter.export(span)
+        except Exception as e:
+            # Tracing never breaks the work it traces.
+            print(f"  Tracing: {type(exporter).__name__} failed: {e}")
+
+
+def shutdown():
+    "Flush and close every exporter. Runs at exit."
+    while _exporters:
+        remove_exporter(_exporters[-1])
+
+
+
+
+class MemoryExporter:
+    "Keeps finished spans in a list, for tests and for summaries at the end of a run."
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span.to_dict())
+
+    def close(self):
+        pass
+
+
+class JsonlExporter:
+    "Appends one JSON object per finished span to @path."
+
+    def __init__(self, path):
+        self.journal = Journal(path)
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        with self.lock:
+            self.journal.append(span.to_dict())
+
+    def close(self):
+        with self.lock:
+            self.journal.close()
+
+
+class OtlpExporter:
+    """
+    Sends spans in batches of @batch_size to an OpenTelemetry collector (or Jaeger, Tempo, ...) over OTLP/HTTP
+    with JSON bodies, so the opentelemetry packages are not needed. @endpoint is the collector's base url,
+    e.g. http://localhost:4318; /v1/traces is added unless it is already there.
+    """
+
+    def __init__(self, endpoint, service=SERVICE, batch_size=100, headers=None, timeout=10):
+        self.url = endpoint if endpoint.rstrip('/').endswith('/v1/traces') else endpoint.rstrip('/') + '/v1/traces'
+        self.service = service
+        self.batch_size = batch_size
+        self.headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        self.timeout = timeout
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        with self.lock:
+            self.spans.append(span)
+            if len(self.spans) < self.batch_size:
+                return
+            spans, self.spans = self.spans, []
+        self.send(spans)
+
+    def send(self, spans):
+        import requests
+        response = requests.post(self.url, data=json.dumps(otlp_body(spans, self.service)), headers=self.headers, timeout=self.timeout)
+        if response.status_code >= 300:
+            raise Exception(f"{self.url} answered {response.status_code}: {response.text[:200]}")
+
+    def close(self):
+        with self.lock:
+            spans, self.spans = self.spans, []
+        if spans:
+            self.send(spans)
+
+
+def otlp_value(v):
+    if isinstance(v, bool):
+        return {'boolValue': v}
+    if isinstance(v, int):
+        return {'intValue': str(v)}
+    if isinstance(v, float):
+        return {'doubleValue': v}
+    if isinstance(v, str):
+        return {'stringValue': v}
+    return {'stringValue': json.dumps(v, default=str)}
+
+
+def otlp_body(spans, service=SERVICE):
+    "An OTLP ExportTraceServiceRequest, in its JSON form, for @spans."
+    return {'resourceSpans': [{
+        'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': service}}]},
+        'scopeSpans': [{
+            'scope': {'name': 'lib.tracing'},
+            'spans': [{
+                'traceId': s.trace_id,
+                'spanId': s.span_id,
+                'parentSpanId': s.parent_id or '',
+                'name': s.name,
+                'kind': 1,
+                'startTimeUnixNano': str(s.start),
+                'endTimeUnixNano': str(s.end),
+                'attributes': [{'key': k, 'value': otlp_value(v)} for k, v in s.attributes.items() if v is not None],
+                'status': {'code': 2, 'message': s.error} if s.error else {'code': 1},
+            } for s in spans],
+        }],
+    }]}
+
+
+
+
+def configure_from_env():
+    if os.environ.get('TRACE_FILE'):
+        add_exporter(JsonlExporter(os.environ['TRACE_FILE']))
+    if os.environ.get('OTEL_EXPORTER_OTLP_ENDPOINT'):
+        add_exporter(OtlpExporter(os.environ['OTEL_EXPORTER_OTLP_ENDPOINT'], service=os.environ.get('OTEL_SERVICE_NAME', SERVICE)))
+
+
+configure_from_env()
+atexit.register(shutdown)
+
+
+
+
+def test_tracing():
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from lib.tools import getNewTemporaryFilePath
+
+    # Off: the shared do-nothing span, and nothing recorded.
+    assert span('a', n=1) is NO_SPAN and current_span() is NO_SPAN
+
+    memory = add_exporter(MemoryExporter())
+    try:
+        with span('outer', model='m') as outer:
+            with span('inner', chunks=3) as inner:
+                inner.set(tokens=7)
+                assert current_span() is inner
+            try:
+                with span('failing'):
+                    raise ValueError("bad")
+            except ValueError:
+                pass
+            outer.set(done=True)
+
+        @traced('twice', attributes=lambda x: {'x': x})
+        def twice(x):
+            return 2 * x
+        assert twice(4) == 8 and twice.__wrapped__(4) == 8
+    finally:
+        remove_exporter(memory)
+
+    inner, failing, outer, called = memory.spans
+    assert [s['name'] for s in memory.spans] == ['inner', 'failing', 'outer', 'twice']
+    assert inner['parent_id'] == outer['span_id'] and inner['trace_id'] == outer['trace_id']
+    assert outer['parent_id'] is None and called['trace_id'] != outer['trace_id']
+    assert inner['attributes'] == {'chunks': 3, 'tokens': 7} and outer['attributes'] == {'model': 'm', 'done': True}
+    assert failing['error'] == "ValueError: bad" and called['attributes'] == {'x': 4}
+    assert outer['seconds'] >= inner['seconds'] >= 0
+    assert span('a') is NO_SPAN
+
+    # Spans on another thread start their own trace.
+    memory = add_exporter(MemoryExporter())
+    with span('main'):
+        t = threading.Thread(target=lambda: span('worker').__enter__().__exit__(None, None, None))
+        t.start()
+        t.join()
+    remove_exporter(memory)
+    assert memory.spans[0]['name'] == 'worker' and memory.spans[0]['parent_id'] is None
+
+    path = getNewTemporaryFilePath('traces', '.jsonl')
+    jsonl = add_exporter(JsonlExporter(path))
+    with span('written', n=1):
+        pass
+    remove_exporter(jsonl)
+    assert [r['name'] for r in Journal(path).read()] == ['written']
+    os.remove(path)
+
+    received = []
+
+    class Collector(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            received.append((self.path, json.loads(self.rfile.read(int(self.headers['Content-Length'])))))
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'{}')
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Collector)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    otlp = add_exporter(OtlpExporter(f"http://127.0.0.1:{server.server_address[1]}", batch_size=2))
+    for i in range(3):
+        with span('sent', i=i, ratio=0.5, tags=['x']):
+            pass
+    remove_exporter(otlp)
+    server.shutdown()
+    server.server_close()
+    assert [path for path, _ in received] == ['/v1/traces', '/v1/traces']
+    spans = [s for _, body in received for s in body['resourceSpans'][0]['scopeSpans'][0]['spans']]
+    assert len(spans) == 3 and spans[2]['attributes'] == [
+        {'key': 'i', 'value': {'intValue': '2'}}, {'key': 'ratio', 'value': {'doubleValue': 0.5}}, {'key': 'tags', 'value': {'stringValue': '["x"]'}}]
+    assert int(spans[0]['endTimeUnixNano']) >= int(spans[0]['startTimeUnixNano']) and spans[0]['status'] == {'code': 1}
+
+
+if __name__ == "__main__":
+    test_tracing()
@@ -3,14 +3,16 @@ import datetime
 from lib.splitter import *
 from lib.tools import *
 from lib.corpus import *
-import chromadb
-from chromadb.config import Settings
+from lib.memo import memoize
+from lib.telemetry import Timer
+from lib.tracing import span
 
 file_extensions = [".docx", ".pdf", ".txt", ".md", ".rst"]
 
 
 def read_corpus_document(filepath):
     if filepath.endswith(".pdf"):
+        import pypdf
         return pypdf.PdfReader(filepath).pages[0].extract_text()
     elif filepath.endswith(".docx"):
         return docx_to_text(filepath)
@@ -24,6 +26,8 @@ class VectorDb:
         self.collection_name = collection_name
         self.corpus = corpus
         self.splitter = splitter
+        self.reranking = True
+        self.ingested = {'documents': 0, 'chunks': 0}
 
     def add_chunk(self, chunk, filepath, chunk_index):
         if not hasattr(self, 'chunk_batch') or not self.chunk_batch:
@@ -38,11 +42,15 @@ class VectorDb:
 
 
     def add_document(self, filepath):
-        text = self.corpus.get_text(filepath)
-        chunks = self.splitter.get_chunks(text)
-        for chunk_index, chunk in enumerate(chunks):
-            self.add_chunk(chunk, filepath, chunk_index)
-        self.commit_batch(threshold=100)
+        with span('vectordb.add_document', filepath=filepath) as s:
+            text = self.corpus.get_text(filepath)
+            chunks = self.splitter.get_chunks(text)
+            s.set(chars=len(text), chunks=len(chunks))
+            self.ingested['documents'] += 1
+            self.ingested['chunks'] += len(chunks)
+            for chunk_index, chunk in enumerate(chunks):
+                self.add_chunk(chunk, filepath, chunk_index)
+            self.commit_batch(threshold=100)
 
 
     def commit_batch(self, threshold=0):
@@ -57,23 +65,27 @@ class VectorDb:
         @return the maximum last updated time of the files in the corpus.
         """
 
-        # Pre-scan the corpus to find the maximum last updated time
-        m = 0
-        for filepath in self.corpus.enumerate_files(corpus_folder):
-            file_updated = os.path.getmtime(filepath)
-            if file_updated > m:
-                m = file_updated
-        sMaxUpdate = datetime.datetime.fromtimestamp(m).isoformat()
-
-        max_updated = 0
-        for filepath in self.corpus.enumerate_files(corpus_folder):
-            file_updated = os.path.getmtime(filepath)
-            if file_updated > max_updated:
-                max_updated = file_updated
-            if file_updated > last_updated:
-                self.add_document(filepath)
-
-        self.commit_batch()
+        with span('vectordb.load_corpus', collection=self.collection_name, corpus_folder=corpus_folder) as s:
+            ingested = dict(self.ingested)
+
+            # Pre-scan the corpus to find the maximum last updated time
+            m = 0
+            for filepath in self.corpus.enumerate_files(corpus_folder):
+                file_updated = os.path.getmtime(filepath)
+                if file_updated > m:
+                    m = file_updated
+            sMaxUpdate = datetime.datetime.fromtimestamp(m).isoformat()
+
+            max_updated = 0
+            for filepath in self.corpus.enumerate_files(corpus_folder):
+                file_updated = os.path.getmtime(filepath)
+                if file_updated > max_updated:
+                    max_updated = file_updated
+                if file_updated > last_updated:
+                    self.add_document(filepath)
+
+            self.commit_batch()
+            s.set(documents=self.ingested['documents'] - ingested['documents'], chunks=self.ingested['chunks'] - ingested['chunks'])
         return max_updated
 
     def get_reranker(self):
@@ -89,8 +101,15 @@ class VectorDb:
         if self.device == "cuda":
             modelName = 'BAAI/bge-reranker-large'
         self.reranker = FlagReranker(modelName, device=self.device, use_fp16=True)
+        self.reranker_name = modelName
         return self.reranker
 
+    @memoize('rerank', key=lambda self, query, documents: [self.reranker_name, query, documents], maxsize=128)
+    def score_documents(self, query, documents):
+        "Cross-encoder scores of @documents for @query, cached so a repeated query is not scored again."
+        pairs = [[query, doc] for doc in documents]
+        return [float(score) for score in self.reranker.compute_score(pairs, batch_size=32)]
+
 
 
 
@@ -103,6 +122,8 @@ class ChromaVectorDb(VectorDb):
         self.collection_path = os.path.abspath(collection_path)
         self.collection_dir = os.path.dirname(collection_path)
         self.collection_name = os.path.basename(collection_path)
+        import chromadb
+        from chromadb.config import Settings
         self.client = chromadb.Client(Settings(
             anonymized_telemetry=False,
             is_persistent=True,
@@ -120,57 +141,64 @@ class ChromaVectorDb(VectorDb):
     
     def commit_batch(self, threshold=0):
         if hasattr(self, 'chunk_batch') and self.chunk_batch and len(self.chunk_batch['chunks']) >= threshold:
-            self.collection.add(
-                documents=self.chunk_batch['chunks'],
-                metadatas=self.chunk_batch['metadatas'],
-                ids=self.chunk_batch['ids']
-            )
+            with span('vectordb.commit_batch', collection=self.collection_name, chunks=len(self.chunk_batch['chunks'])):
+                self.collection.add(
+                    documents=self.chunk_batch['chunks'],
+                    metadatas=self.chunk_batch['metadatas'],
+                    ids=self.chunk_batch['ids']
+                )
             self.chunk_batch = None
 
 
 
 
-    def retrive_documents(self, query, n_results=80):
-        """Query the vector database and generate an answer using the LLM"""
-        
-        numEntries = self.collection.count()
+    def retrive_documents(self, query, n_results=80, top_k=12, timings=None):
+        """
+        Retrieve the @n_results chunks closest to @query, re-rank them with a cross-encoder and pack the best
+        @top_k into a context for the LLM.
+        @timings is an optional dict that receives the seconds spent in 'retrieval', 'rerank' and 'packing'.
+        """
+        timings = {} if timings is None else timings
+        with span('vectordb.retrive_documents', collection=self.collection_name, n_results=n_results, top_k=top_k):
+            # Retrieve a generous amount of relevant documents (cheap and fast)
+            with Timer(timings, 'retrieval'), span('vectordb.query', n_results=n_results) as q:
+                results = self.collection.query(query_texts=[query], n_results=n_results)
+                q.set(documents=len(results['documents'][0]) if results['documents'] else 0)
+
+            if not results['documents'] or not results['documents'][0]:
+                return "No relevant documents found."
+
+            # Re-rank them with a cross-encoder
+            with Timer(timings, 'rerank'):
+                ranked = self.rerank(query, results['documents'][0], results['metadatas'][0], top_k)
+
+            # Build context from retrieved documents
+            with Timer(timings, 'packing'), span('vectordb.pack_context', documents=len(ranked)) as p:
+                context = pack_context(ranked)
+                p.set(chars=len(context))
+        return context
 
-        # Retrieve a generous amount of relevant documents (cheap and fast)
-        results = self.collection.query(
-            query_texts=[query],
-            n_results=n_results
-        )
-        
-        if not results['documents'] or not results['documents'][0]:
-            return "No relevant documents found."
-        
-        # Re-rank them with a cross-encoder
-        reranker = self.get_reranker()
 
-        def rerank_with_bge(query: str, documents, top_k: int = 12):
-            pairs = [[query, doc] for doc in documents]
-            scores = reranker.compute_score(pairs, batch_size=32)
-            # scores is a list of floats
-            ranked = sorted(zip(documents, scores), key=lambda x: x[1], reverse=True)
-            return [doc for doc, score in ranked[:top_k]]
+    def rerank(self, query, documents, metadatas, top_k=12):
+        "The @top_k (document, metadata) pairs by cross-encoder score, or the first @top_k when reranking is off."
+        if not self.reranking:
+            return list(zip(documents, metadatas))[:top_k]
+        with span('vectordb.rerank', documents=len(documents), top_k=top_k) as s:
+            self.get_reranker()
+            s.set(reranker=self.reranker_name)
+            scores = self.score_documents(query, documents)
+            ranked = sorted(zip(documents, metadatas, scores), key=lambda x: x[2], reverse=True)
+        return [(doc, metadata) for doc, metadata, score in ranked[:top_k]]
 
-        # Usage
-        raw_results = self.collection.query(query_texts=[query], n_results=80)['documents'][0]
-        top_reranked = rerank_with_bge(query, raw_results, top_k=12)        
 
-        results['documents'][0] = top_reranked
-        results['metadatas'][0] = [metadata for metadata in results['metadatas'][0]]
 
 
-        # Build context from retrieved documents
-        context_parts = []
-        for doc, metadata in zip(results['documents'][0], results['metadatas'][0]):
-            filename = metadata.get('filename', 'Unknown')
-            context_parts.append(f"From {filename}:\n{doc}\n")
-        
-        context = "\n---\n".join(context_parts)
-        
-        return context
+def pack_context(ranked):
+    context_parts = []
+    for doc, metadata in ranked:
+        filename = metadata.get('filename', 'Unknown')
+        context_parts.append(f"From {filename}:\n{doc}\n")
+    return "\n---\n".join(context_parts)
 
 
 
@@ -181,13 +209,13 @@ def make_rag(collection_name, corpus_folder):
     splitter = RecursiveCharacterText_Splitter(chunk_size=1000, chunk_overlap=200)
     rag = ChromaVectorDb(corpus, splitter, collection_path=f"data/chroma_db/{collection_name}")
 
-    cache = get_cache("chroma_rag.json")
-    collections = cache.get("collections", {})
-    collection = collections.get(collection_name, {})
+    cache = get_cache("chroma_rag.json", namespace="ingest") or {}
+    collections = cache.setdefault("collections", {})
+    collection = collections.setdefault(collection_name, {})
     last_updated = collection.get("last_updated", 0)
     last_updated = rag.load_corpus(corpus_folder, last_updated)
     collection["last_updated"] = last_updated
-    put_cache("chroma_rag.json", cache)
+    put_cache("chroma_rag.json", cache, namespace="ingest")
     return rag
 
 